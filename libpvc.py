@@ -13,15 +13,65 @@ import configparser
 # For using SHA-1 function
 import hashlib
 
+# For the priority queue of history walks
+import heapq
+import itertools
+
+# For compact tables of tree entry offsets
+import array
+
+# For memory-mapping packfiles and their indexes
+import mmap
+
 # For filesystem abstractions
 import os
 
 # For Regular Expressions
 import re
 
+# For decoding binary packfile structures
+import struct
+
+# For reading file metadata into the index
+import stat
+
 # For accessing the command line arguments
 import sys
 
+# For writing objects under a temporary name first
+import tempfile
+
+# For the asyncio API
+import asyncio
+
+# For checking out files from several threads
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+# For hashing files from several processes
+from concurrent.futures import ProcessPoolExecutor
+
+# For timing long operations
+import time
+
+# For the daemon: its socket, the output of the commands it
+# runs and the errors they raise
+import io
+import signal
+import socket
+import traceback
+
+# For the benchmarks: synthetic repositories, timing pvc
+# as a command and storing the results
+import json
+import random
+import shutil
+import subprocess
+
+# For merging the lines of files
+import difflib
+
 # For compression
 import zlib
 
@@ -32,6 +82,23 @@ import zlib
 argparser = argparse.ArgumentParser(
     description="The Comment Tracker"
 )
+argparser.add_argument("--trace-perf",
+    metavar="file",
+    dest="trace_perf",
+    default=None,
+    help="Count and time object reads and writes, ref \
+        resolutions, directory scans and parsing, and write \
+        the results to file (- for the standard error) on \
+        exit.  Defaults to $PVC_TRACE_PERF.")
+
+argparser.add_argument("--trace-perf-format",
+    dest="trace_perf_format",
+    choices=["summary", "chrome"],
+    default=None,
+    help="Write a JSON summary, or a Chrome trace-event \
+        file with every call.  Defaults to \
+        $PVC_TRACE_PERF_FORMAT, then summary.")
+
 # Add subparsers to parse commands
 argsubparsers = argparser.add_subparsers(
     title="Commands", dest="command"
@@ -51,18 +118,173 @@ argsp.add_argument("path",
 
 # }}
 
+# Add add command argument {{
+
+argsp = argsubparsers.add_parser("add",
+    help="Add file contents to the index")
+
+argsp.add_argument("-j",
+    dest="jobs",
+    type=int,
+    default=None,
+    help="Number of processes hashing files \
+        (default: one per CPU)")
+
+argsp.add_argument("path",
+    nargs="+",
+    help="Files to add, directories are added recursively")
+
+# }}
+
+# Add rm command argument {{
+
+argsp = argsubparsers.add_parser("rm",
+    help="Remove files from the worktree and from the index")
+
+argsp.add_argument("--cached",
+    action="store_true",
+    help="Only remove from the index")
+
+argsp.add_argument("-f", "--force",
+    dest="force",
+    action="store_true",
+    help="Remove files even if they were modified")
+
+argsp.add_argument("-r",
+    dest="recursive",
+    action="store_true",
+    help="Remove directories recursively")
+
+argsp.add_argument("path",
+    nargs="+",
+    help="Files to remove")
+
+# }}
+
+# Add bench command argument {{
+
+argsp = argsubparsers.add_parser("bench",
+    help="Time pvc's internals on this repository")
+
+argsp.add_argument("suite",
+    choices=["kvlm", "commands", "fast-import"],
+    help="What to time: kvlm parses and serializes every \
+        commit and tag reachable from the refs, commands \
+        generates a repository of the shape below and times \
+        pvc commands on it, cold and warm, and fast-import \
+        imports a stream of that shape into a pack and into \
+        loose objects")
+
+argsp.add_argument("--rounds",
+    type=int,
+    default=5,
+    help="Times to repeat each measure, the best is kept")
+
+argsp.add_argument("--files",
+    type=int,
+    default=2000,
+    help="Number of files of the generated repository")
+
+argsp.add_argument("--depth",
+    type=int,
+    default=3,
+    help="Depth of the directories the files are in")
+
+argsp.add_argument("--fanout",
+    type=int,
+    default=4,
+    help="Number of subdirectories of each directory")
+
+argsp.add_argument("--blob-size",
+    metavar="MIN:MAX",
+    dest="blob_size",
+    default="100:20000",
+    help="Range of the file sizes, spread evenly over \
+        orders of magnitude")
+
+argsp.add_argument("--commits",
+    type=int,
+    default=100,
+    help="Number of commits of the generated repository")
+
+argsp.add_argument("--branches",
+    type=int,
+    default=0,
+    help="Number of topic branches commits go to, and \
+        that get merged back (default: a linear history)")
+
+argsp.add_argument("--seed",
+    type=int,
+    default=0,
+    help="Seed of the generator, the same seed and shape \
+        giving the same repository")
+
+argsp.add_argument("--pack",
+    action="store_true",
+    help="Pack the generated repository like gc does")
+
+argsp.add_argument("--dir",
+    default=None,
+    help="Generate the repository there and keep it \
+        (default: a temporary directory)")
+
+argsp.add_argument("--json",
+    metavar="file",
+    default=None,
+    help="Write the results to this file")
+
+argsp.add_argument("--compare",
+    metavar="baseline",
+    default=None,
+    help="Fail on commands slower than in this file, \
+        written by --json")
+
+argsp.add_argument("--threshold",
+    type=float,
+    default=10,
+    help="Slowdown in percent over which --compare fails")
+
+# }}
+
 # Add cat-file command argument {{
 
 argsp = argsubparsers.add_parser("cat-file",
     help="Provide content of repository objects")
 
+argsp.add_argument("-t",
+    dest="show_type",
+    action="store_true",
+    help="Show the object type instead of its content")
+
+argsp.add_argument("-s",
+    dest="show_size",
+    action="store_true",
+    help="Show the object size instead of its content")
+
+argsp.add_argument("--batch",
+    action="store_true",
+    help="Print the header and content of each object \
+        named on stdin")
+
+argsp.add_argument("--batch-check",
+    dest="batch_check",
+    action="store_true",
+    help="Print the header of each object named on stdin")
+
+argsp.add_argument("--buffer",
+    action="store_true",
+    help="Don't flush the output after each batch object")
+
+# The type is optional with -t, -s and the batch modes, so
+# it is checked in cmd_cat_file rather than here.
 argsp.add_argument("type",
     metavar="type",
-    choices=["blob", "commit", "tag", "tree"],
-    help="Specify the type")
+    nargs="?",
+    help="Specify the type (blob, commit, tag or tree)")
 
 argsp.add_argument("object",
     metavar="object",
+    nargs="?",
     help="The object to display")
 
 # }}
@@ -86,7 +308,20 @@ argsp.add_argument("-w",
     action="store_true",
     help="Actually write the object into the database")
 
+argsp.add_argument("--stdin-paths",
+    dest="stdin_paths",
+    action="store_true",
+    help="Read file names from stdin, one per line")
+
+argsp.add_argument("-j",
+    dest="jobs",
+    type=int,
+    default=None,
+    help="Number of processes hashing files with \
+        --stdin-paths (default: one per CPU)")
+
 argsp.add_argument("path",
+    nargs="?",
     help="Read object from <file>")
 
 # }}
@@ -96,9 +331,54 @@ argsp.add_argument("path",
 argsp = argsubparsers.add_parser("log", 
     help="Display history of a given commit.")
 argsp.add_argument("commit",
-    default="HEAD",
+    default=["HEAD"],
+    nargs="*",
+    help="Commits to start at.  ^A or A..B leave \
+        out the commits reachable from A.")
+argsp.add_argument("-n", "--max-count",
+    dest="max_count",
+    type=int,
+    default=None,
+    help="Show at most this many commits")
+argsp.add_argument("--since",
+    default=None,
+    help="Only show commits newer than this date")
+argsp.add_argument("--topo-order",
+    dest="order",
+    action="store_const",
+    const="topo",
+    default="date",
+    help="Never show a parent before all its children")
+argsp.add_argument("--date-order",
+    dest="order",
+    action="store_const",
+    const="date",
+    help="Show the newest commits first (default)")
+argsp.add_argument("--pretty",
+    choices=["graphviz", "oneline"],
+    default="graphviz",
+    help="Print a Graphviz graph (default), or one line \
+        per commit")
+
+# }}
+
+# Add diff-tree command argument {{
+
+argsp = argsubparsers.add_parser("diff-tree",
+    help="Compare the content and mode of two trees")
+
+argsp.add_argument("-r",
+    dest="recursive",
+    action="store_true",
+    help="Recurse into sub-trees")
+
+argsp.add_argument("a",
+    help="The old tree, or a commit to compare with its \
+        parent")
+
+argsp.add_argument("b",
     nargs="?",
-    help="Commit to start at.")
+    help="The new tree")
 
 # }}
 
@@ -106,27 +386,53 @@ argsp.add_argument("commit",
 
 argsp = argsubparsers.add_parser("ls-tree", 
     help="Pretty-print a tree object.")
+argsp.add_argument("-r",
+    dest="recursive",
+    action="store_true",
+    help="Recurse into sub-trees")
+argsp.add_argument("-l",
+    dest="long",
+    action="store_true",
+    help="Show the size of blobs")
 argsp.add_argument("object",
     help="The object to show.")
 
 def cmd_ls_tree(args):
     repo = repo_find()
-    obj = object_read(repo, object_find(repo, args.object, 
-        fmt=b'tree'))
+    ls_tree(repo, object_find(repo, args.object, fmt=b'tree'),
+        recursive=args.recursive, long=args.long)
+
+def ls_tree(repo, sha, recursive=False, long=False, prefix=b''):
+    obj = object_read(repo, sha)
 
     for item in obj.items:
-        print("{0} {1} {2}\t{3}".format(
-            "0" * (6 - len(item.mode)) 
-            + item.mode.decode("ascii"),
-
-            # Git's ls-tree displays the type
-            # of the object pointed to. 
-            # We can do that too :)
-            object_read(repo, item.sha).fmt.decode("ascii"),
+        mode = b"0" * (6 - len(item.mode)) + item.mode
+
+        # Git's ls-tree displays the type
+        # of the object pointed to. 
+        # The mode is enough to tell it,
+        # no need to read the object.
+        fmt = tree_leaf_fmt(item.mode)
+
+        if recursive and fmt == b'tree':
+            ls_tree(repo, item.sha, recursive, long,
+                prefix + item.path + b'/')
+            continue
+
+        size = ""
+        if long:
+            if fmt == b'blob':
+                size = " {0:>7}".format(
+                    object_header(repo, item.sha)[1])
+            else:
+                size = " {0:>7}".format("-")
+
+        print("{0} {1} {2}{3}\t{4}".format(
+            mode.decode("ascii"),
+            fmt.decode("ascii"),
             item.sha,
-            item.path.decode("ascii")))
-
-# }}
+            size,
+            (prefix + item.path).decode("utf8", "replace")))
 
 # Add checkout command functionality {{
 
@@ -156,12 +462,77 @@ argsp.add_argument("commit",
 argsp.add_argument("path",
     help="The EMPTY directory to checkout on.")
 
+argsp.add_argument("-j",
+    dest="jobs",
+    type=int,
+    default=1,
+    help="Number of threads writing files")
+
 # }}
 
 # Add show-ref command argument
 argsp = argsubparsers.add_parser("show-ref", 
     help="List references.")
 
+# Add status command argument {{
+
+argsp = argsubparsers.add_parser("status",
+    help="Show the working tree status")
+
+argsp.add_argument("--refresh",
+    action="store_true",
+    help="Save the stat data of unchanged files to the index")
+
+argsp.add_argument("-j",
+    dest="jobs",
+    type=int,
+    default=None,
+    help="Number of threads scanning directories \
+        (default: one per CPU)")
+
+# }}
+
+# Add commit command argument {{
+
+argsp = argsubparsers.add_parser("commit",
+    help="Record the index as a new commit")
+
+argsp.add_argument("-m",
+    metavar="message",
+    dest="message",
+    required=True,
+    help="The commit message")
+
+# }}
+
+# Add merge command argument {{
+
+argsp = argsubparsers.add_parser("merge",
+    help="Join the history of a commit with HEAD")
+
+argsp.add_argument("--apply",
+    action="store_true",
+    help="Update the index and the worktree with the merge, \
+        and commit it if it has no conflicts.  Without it, \
+        only the merged tree is written and printed.")
+
+argsp.add_argument("-m",
+    metavar="message",
+    dest="message",
+    help="The message of the merge commit")
+
+argsp.add_argument("commit",
+    help="The commit to merge")
+
+# }}
+
+# Add write-tree command argument {{
+
+argsp = argsubparsers.add_parser("write-tree",
+    help="Create tree objects from the index")
+
+# }}
+
 # Add tag command argument {{
 
 argsp = argsubparsers.add_parser(
@@ -173,6 +544,11 @@ argsp.add_argument("-a",
     dest="create_tag_object",
     help="Whether to create a tag object")
 
+argsp.add_argument("-m",
+    dest="message",
+    default=None,
+    help="The message of the tag object")
+
 argsp.add_argument("name",
     nargs="?",
     help="The new tag's name")
@@ -201,6 +577,126 @@ argsp.add_argument("name",
 
 # }}
 
+# Add commit-graph command argument {{
+
+argsp = argsubparsers.add_parser("commit-graph",
+    help="Write the commit-graph file")
+
+argsp.add_argument("action",
+    choices=["write"],
+    help="What to do with the commit-graph")
+
+# }}
+
+# Add oid-index command argument {{
+
+argsp = argsubparsers.add_parser("oid-index",
+    help="Write the sorted index of all object IDs")
+
+argsp.add_argument("action",
+    choices=["write"],
+    help="What to do with the object index")
+
+# }}
+
+# Add daemon command argument {{
+
+argsp = argsubparsers.add_parser("daemon",
+    help="Serve pvc commands over a Unix socket, keeping \
+        repositories loaded between them")
+
+argsp.add_argument("--socket",
+    default=None,
+    help="Where to listen (default: $PVC_DAEMON, or \
+        pvc-<uid>.sock in the temporary directory).  Clients \
+        send their commands there when PVC_DAEMON is set \
+        to it.")
+
+argsp.add_argument("--cache-mb",
+    dest="cache_mb",
+    type=int,
+    default=256,
+    help="Size of the object cache of each repository")
+
+# }}
+
+# Add pack-refs command argument {{
+
+argsp = argsubparsers.add_parser("pack-refs",
+    help="Pack refs into .git/packed-refs")
+
+argsp.add_argument("--all",
+    dest="all_refs",
+    action="store_true",
+    help="Pack all refs, not only tags and packed refs")
+
+argsp.add_argument("--no-prune",
+    dest="prune",
+    action="store_false",
+    help="Keep the loose files of the packed refs")
+
+# }}
+
+# Add repack and gc command arguments {{
+
+for command in ("repack", "gc"):
+    argsp = argsubparsers.add_parser(command,
+        help="Pack the reachable objects and remove the \
+            redundant loose objects and packs")
+
+    argsp.add_argument("--window",
+        type=int,
+        default=10,
+        help="How many objects to try as delta bases")
+
+    argsp.add_argument("--depth",
+        type=int,
+        default=50,
+        help="Maximum length of delta chains")
+
+# }}
+
+# Add fast-import command argument {{
+
+argsp = argsubparsers.add_parser("fast-import",
+    help="Import a Git fast-import stream, read from the \
+        standard input, into a single pack")
+
+argsp.add_argument("--import-marks",
+    dest="import_marks",
+    metavar="file",
+    default=None,
+    help="Load the marks of a previous import, so that the \
+        stream can refer to its objects")
+
+argsp.add_argument("--import-marks-if-exists",
+    dest="import_marks_if_exists",
+    metavar="file",
+    default=None,
+    help="Like --import-marks, but a missing file is no error")
+
+argsp.add_argument("--export-marks",
+    dest="export_marks",
+    metavar="file",
+    default=None,
+    help="Write the marks to this file at the end of the \
+        import and at each checkpoint")
+
+argsp.add_argument("--loose",
+    action="store_true",
+    help="Write loose objects rather than a pack")
+
+argsp.add_argument("--force",
+    action="store_true",
+    help="Update branches even when their new commit doesn't \
+        contain the old one")
+
+argsp.add_argument("--quiet",
+    action="store_true",
+    help="Don't print the statistics of the import")
+
+# }}
+
 # }}}
 
 # Git Objects {{{
@@ -210,11 +706,21 @@ class GitRepository(object):
     worktree = None
     gitdir = None
     conf = None
+    packs = None
+    object_cache = None
+    commit_graph = None
+    refs = None
+    oid_index = None
 
-    def __init__(self, path, force=False):
+    def __init__(self, path, force=False, cache_bytes=0):
         self.worktree = path
         self.gitdir = os.path.join(path, ".git")
 
+        # Parsed objects are only cached on demand, since
+        # most commands read each object once.
+        if cache_bytes:
+            self.object_cache = GitObjectCache(cache_bytes)
+
         if not (force or os.path.isdir(self.gitdir)):
             raise Exception("Not a git repository %s"%path)
 
@@ -270,6 +776,92 @@ class GitBlob(GitObject):
     def deserialize(self, data):
         self.blobdata = data
 
+# The headers and message of a commit or a tag, as a
+# mapping from header names to values, the message being
+# under b''.  A header found more than once maps to the list
+# of its values.
+#
+# Parsing only records where each value starts and ends in
+# the raw data: values are sliced, with continuation lines
+# unfolded, when they are first asked for, which for most
+# commits read is only the tree, the parents and the
+# committer.  Until it is modified, the object serializes
+# back to its raw data, byte for byte.
+class GitKvlm(object):
+    __slots__ = {
+        "raw": "The serialized object",
+        "spans": "Header names to the (start, end) of their values in raw, None for headers set later",
+        "values": "The values asked for or set so far",
+        "message": "Where the message starts in raw, None if there is none",
+        "modified": "Whether raw is out of date",
+    }
+
+    def __init__(self, raw=None):
+        self.raw = raw
+        self.spans = dict()
+        self.values = dict()
+        self.message = None
+        self.modified = raw is None
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+
+        if key == b'':
+            if self.message is None:
+                raise KeyError(key)
+            value = self.raw[self.message:]
+        else:
+            value = [ self.raw[start:end].replace(b'\n ', b'\n')
+                      for start, end in self.spans[key] ]
+            if len(value) == 1:
+                value = value[0]
+
+        self.values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key == b'':
+            self.message = self.message or 0
+        elif key not in self.spans:
+            self.spans[key] = None
+        self.values[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        if key == b'':
+            if self.message is None:
+                raise KeyError(key)
+            self.message = None
+        else:
+            del self.spans[key]
+        self.values.pop(key, None)
+        self.modified = True
+
+    def __contains__(self, key):
+        if key == b'':
+            return self.message is not None
+        return key in self.spans
+
+    def __iter__(self):
+        yield from self.spans
+        if self.message is not None:
+            yield b''
+
+    def __len__(self):
+        return len(self.spans) + (self.message is not None)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [ (key, self[key]) for key in self ]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
 # GitObject for type Commit
 class GitCommit(GitObject):
     fmt=b'commit'
@@ -280,23 +872,125 @@ class GitCommit(GitObject):
     def serialize(self):
         return kvlm_serialize(self.kvlm)
 
+# The type of the object a tree entry points to
+def tree_leaf_fmt(mode):
+    if mode.startswith(b'4'):
+        return b'tree'
+    if mode == b'160000':
+        # Submodules point to commits of other repositories
+        return b'commit'
+    return b'blob'
+
 # Object for Tree Leaf
 # Represents a Tree object in Git
 class GitTreeLeaf(object):
-    def __init__(self, mode, path, sha):
+    __slots__ = ("mode", "path", "binsha")
+
+    def __init__(self, mode, path, binsha):
         self.mode = mode
         self.path = path
-        self.sha = sha
+        self.binsha = binsha
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
+# A difference between two trees: status is A (added), D
+# (deleted), M (modified) or T (type changed, a file that
+# became a symbolic link for example), old and new are the
+# GitTreeLeaf on each side, None where there is none.
+class GitTreeChange(object):
+    __slots__ = ("status", "path", "old", "new")
+
+    def __init__(self, status, path, old, new):
+        self.status = status
+        self.path = path
+        self.old = old
+        self.new = new
+
+# A path a three-way tree merge couldn't resolve: kind is
+# "content" (both sides changed the same lines), "add/add",
+# "modify/delete" or "type" (a file on one side, a directory
+# or a symbolic link on the other for example).  base, ours
+# and theirs are the GitTreeLeaf on each side, None where
+# there is none.
+class GitMergeConflict(object):
+    __slots__ = ("kind", "path", "base", "ours", "theirs")
+
+    def __init__(self, kind, path, base, ours, theirs):
+        self.kind = kind
+        self.path = path
+        self.base = base
+        self.ours = ours
+        self.theirs = theirs
 
 # GitObject for type Tree
+#
+# A tree keeps its serialized data as it is: leaves are only
+# built when they are asked for, and the offsets of the
+# entries, four bytes each, only when an entry is looked up
+# by position or name.  Most trees are just walked once.
 class GitTree(GitObject):
     fmt=b'tree'
+    raw = b''
+    _offsets = None
 
     def deserialize(self, data):
-        self.items = tree_parse(data)
+        self.raw = data
+        self._offsets = None
 
     def serialize(self):
-        return tree_serialize(self)
+        return self.raw
+
+    @property
+    def items(self):
+        return self
+
+    @items.setter
+    def items(self, items):
+        self.deserialize(tree_serialize(items))
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = tree_parse(self.raw)
+        return self._offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return tree_parse_one(self.raw, self.offsets[i])[1]
+
+    def __iter__(self):
+        raw = self.raw
+        find = raw.find
+        pos = 0
+        while pos < len(raw):
+            x = find(b' ', pos)
+            y = find(b'\x00', x)
+            if x < 0 or y < 0:
+                raise Exception("Malformed tree")
+            yield GitTreeLeaf(raw[pos:x], raw[x+1:y], raw[y+1:y+21])
+            pos = y + 21
+
+    def find(self, name):
+        # The leaf called name, or None.  Entries are sorted
+        # as if directories had a trailing slash, so name
+        # is looked for as a file, then as a directory.
+        for key in (name, name + b'/'):
+            lo, hi = 0, len(self.offsets)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if tree_sort_key(self.raw, self.offsets[mid]) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(self.offsets):
+                leaf = self[lo]
+                if leaf.path == name:
+                    return leaf
+        return None
 
 # GitObject for type Tag
 # Almost same as GitCommit
@@ -304,38 +998,225 @@ class GitTag(GitCommit):
     fmt = b'tag'
 
 
+# Object Cache {{
+
+# Least recently used cache of parsed objects, keyed by SHA
+# and bounded by an estimate of their size in bytes.
+# Commits, tags and trees are always cached; blobs only when
+# they are small.  Cached objects are shared between callers
+# and must not be modified.
+class GitObjectCache(object):
+    max_bytes = None
+    """Budget for the estimated size of the cached objects"""
+    max_blob_size = 64 * 1024
+    """Larger blobs are never cached"""
+    size = 0
+    """Estimated size of the cached objects"""
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, max_bytes, max_blob_size=None):
+        self.max_bytes = max_bytes
+        if max_blob_size is not None:
+            self.max_blob_size = max_blob_size
+        self.objects = collections.OrderedDict()
+
+    def get(self, sha):
+        entry = self.objects.get(sha)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.objects.move_to_end(sha)
+        return entry[0]
+
+    def put(self, sha, obj, length):
+        # length is the size of the object's serialized data
+        if sha in self.objects:
+            self.objects.move_to_end(sha)
+            return
+        if obj.fmt == b'blob' and length > self.max_blob_size:
+            return
+
+        # Parsed trees cost an offset per entry on top of
+        # their data.
+        size = length + 64
+        if obj.fmt == b'tree':
+            size += 4 * len(obj.items)
+        if size > self.max_bytes:
+            return
+
+        self.objects[sha] = (obj, size, length)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, old, _) = self.objects.popitem(last=False)
+            self.size -= old
+            self.evictions += 1
+
+    def invalidate(self, sha):
+        entry = self.objects.pop(sha, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def stats(self):
+        return {
+            "objects": len(self.objects),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# }}
+
 # Git Index File Entry {{
 
+# There is one of these per file of the worktree, so they
+# are kept small: the stat data and the SHA stay packed as
+# they are in the index file and are only decoded when
+# asked for, and attributes live in slots rather than in an
+# instance dict.  An index of a million files loads in a
+# fraction of the memory and time it would take otherwise.
+INDEX_STAT = struct.Struct(">10I")
+
 class GitIndexEntry(object):
-    ctime = None
-    """The last time a file's metadata changed.  This is a tuple (seconds, nanoseconds)"""
-
-    mtime = None
-    """The last time a file's data changed.  This is a tuple (seconds, nanoseconds)"""
-
-    dev = None
-    """The ID of device containing this file"""
-    ino = None
-    """The file's inode number"""
-    mode_type = None
-    """The object type, either b1000 (regular), b1010 (symlink), b1110 (gitlink). """
-    mode_perms = None
-    """The object permissions, an integer."""
-    uid = None
-    """User ID of owner"""
-    gid = None
-    """Group ID of ownner (according to stat 2.  Isn'th)"""
-    size = None
-    """Size of this object, in bytes"""
-    obj = None
-    """The object's hash as a hex string"""
-    flag_assume_valid = None
-    flag_extended = None
-    flag_stage = None
-    flag_name_length = None
-    """Length of the name if < 0xFFF (yes, three Fs), -1 otherwise"""
-
-    name = None
+    __slots__ = {
+        "raw": "ctime, mtime, dev, ino, mode, uid, gid and size as 32 bits integers, then the SHA, as in the index file",
+        "flags": "The flags, but for the name length, with the v3 extended flags in the upper 16 bits",
+        "name": "The path of the file from the worktree, as bytes",
+    }
+
+    def __init__(self, name, raw, flags=0):
+        self.name = name
+        self.raw = raw
+        self.flags = flags
+
+    @property
+    def ctime(self):
+        """The last time a file's metadata changed.  This is a tuple (seconds, nanoseconds)"""
+        return struct.unpack_from(">II", self.raw, 0)
+
+    @property
+    def mtime(self):
+        """The last time a file's data changed.  This is a tuple (seconds, nanoseconds)"""
+        return struct.unpack_from(">II", self.raw, 8)
+
+    @property
+    def dev(self):
+        """The ID of device containing this file"""
+        return struct.unpack_from(">I", self.raw, 16)[0]
+
+    @property
+    def ino(self):
+        """The file's inode number"""
+        return struct.unpack_from(">I", self.raw, 20)[0]
+
+    @property
+    def mode_type(self):
+        """The object type, either b1000 (regular), b1010 (symlink), b1110 (gitlink). """
+        return struct.unpack_from(">I", self.raw, 24)[0] >> 12
+
+    @property
+    def mode_perms(self):
+        """The object permissions, an integer."""
+        return struct.unpack_from(">I", self.raw, 24)[0] & 0o777
+
+    @property
+    def mode(self):
+        """The mode as in a tree, b'100644' for example"""
+        return "{0:o}".format(
+            struct.unpack_from(">I", self.raw, 24)[0]).encode()
+
+    @property
+    def uid(self):
+        """User ID of owner"""
+        return struct.unpack_from(">I", self.raw, 28)[0]
+
+    @property
+    def gid(self):
+        """Group ID of owner (according to stat 2)"""
+        return struct.unpack_from(">I", self.raw, 32)[0]
+
+    @property
+    def size(self):
+        """Size of this object, in bytes"""
+        return struct.unpack_from(">I", self.raw, 36)[0]
+
+    @property
+    def sha(self):
+        """The object's hash as 20 bytes"""
+        return self.raw[40:]
+
+    @sha.setter
+    def sha(self, sha):
+        self.raw = self.raw[:40] + sha
+
+    @property
+    def obj(self):
+        """The object's hash as a hex string"""
+        return self.raw[40:].hex()
+
+    @property
+    def flag_assume_valid(self):
+        return bool(self.flags & 0x8000)
+
+    @property
+    def flag_extended(self):
+        """Whether the entry needs the v3 extended flags"""
+        return bool(self.flags >> 16)
+
+    @property
+    def flag_stage(self):
+        return (self.flags >> 12) & 3
+
+    @flag_stage.setter
+    def flag_stage(self, stage):
+        self.flags = self.flags & ~0x3000 | stage << 12
+
+    @property
+    def flag_skip_worktree(self):
+        return bool(self.flags & 0x40000000)
+
+    @property
+    def flag_intent_to_add(self):
+        return bool(self.flags & 0x20000000)
+
+    @property
+    def flag_name_length(self):
+        """Length of the name if < 0xFFF (yes, three Fs), -1 otherwise"""
+        return len(self.name) if len(self.name) < 0xFFF else -1
+
+# Git's cached tree: the SHA of the tree object of every
+# directory of the index, and how many entries it covers,
+# so that writing a tree only serializes the directories
+# whose entries changed.
+class GitCacheTree(object):
+    count = None
+    """Number of index entries under this directory, -1 if the cached SHA is stale"""
+    sha = None
+    """Binary SHA of the tree, None if it was never written"""
+    subtrees = None
+    """The cached subdirectories, by name"""
+
+    def __init__(self, count=-1, sha=None):
+        self.count = count
+        self.sha = sha
+        self.subtrees = dict()
+
+# The whole index file: its entries sorted by name and stage
+class GitIndex(object):
+    version = None
+    entries = None
+    tree = None
+    """The root GitCacheTree, from the TREE extension"""
+
+    def __init__(self, version=2, entries=None, tree=None):
+        self.version = version
+        self.entries = entries if entries is not None else list()
+        self.tree = tree
 
 # }}
 
@@ -372,11 +1253,17 @@ def repo_dir(repo, *path, mkdir=False):
     else:
         return None
 
-def repo_find(path=".", required=True):
+# The GitDaemon serving commands, None outside of pvc daemon.
+# The repositories it finds are kept loaded.
+daemon = None
+
+def repo_find(path=".", required=True, cache_bytes=0):
     path = os.path.realpath(path)
 
     if os.path.isdir(os.path.join(path, ".git")):
-        return GitRepository(path)
+        if daemon is not None:
+            return daemon_repo(daemon, path)
+        return GitRepository(path, cache_bytes=cache_bytes)
 
     # If we haven't returned, recurse in parent, if w
     parent = os.path.realpath(os.path.join(path, ".."))
@@ -391,7 +1278,7 @@ def repo_find(path=".", required=True):
             return None
 
     # Recursive case
-    return repo_find(parent, required)
+    return repo_find(parent, required, cache_bytes)
 
 # }}
 
@@ -403,7 +1290,7 @@ def repo_create(path):
     if os.path.exists(repo.worktree):
         if not os.path.isdir(repo.worktree):
             raise Exception("%s is not a directory!" % path)
-        if not os.listdir(repo.worktree):
+        if os.listdir(repo.worktree):
             raise Exception("%s is not empty!" % path)
     else:
         os.makedirs(repo.worktree)
@@ -428,6 +1315,11 @@ def repo_create(path):
         config = repo_default_config()
         config.write(f)
 
+    # An empty repository has a complete object index, the
+    # fan-out directories of objects written later being
+    # listed until it is rewritten.
+    oid_index_write(repo)
+
     return repo
 
 def repo_default_config():
@@ -449,39 +1341,215 @@ def object_read(repo, sha):
     # Return a GitObject whose exact type depends on the
     # object itself.
 
-    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    cache = repo.object_cache
+    if cache is not None:
+        obj = cache.get(sha)
+        if obj is not None:
+            return obj
 
-    with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    fmt, data = object_read_raw(repo, sha)
+    obj = object_class(fmt, sha)(repo, data)
 
-        # Read object type
-        x = raw.find(b' ')
-        fmt = raw[0:x]
+    if cache is not None:
+        cache.put(sha, obj, len(data))
 
-        # Read and validate object size
-        y = raw.find(b'\x00', x)
-        size = int(raw[x:y].decode("ascii"))
+    return obj
 
-        if size != len(raw)-y-1:
-            raise Exception(
-                "Malformed object {0}: bad length".format(
-                    sha
-                )
+# Pick the GitObject subclass for fmt
+def object_class(fmt, sha=None):
+    if   fmt==b'commit' : return GitCommit
+    elif fmt==b'tree'   : return GitTree
+    elif fmt==b'tag'    : return GitTag
+    elif fmt==b'blob'   : return GitBlob
+    else:
+        raise Exception(
+            "Unknown type {0} for object {1}".format(
+                fmt.decode("ascii"), sha
             )
-        # Pick a constructor
-        if   fmt==b'commit' : c=GitCommit
-        elif fmt==b'tree'   : c=GitTree
-        elif fmt==b'tag'    : c=GitTag
-        elif fmt==b'blob'   : c=GitBlob
-        else:
+        )
+
+def object_read_raw(repo, sha):
+    # Read the type and the contents of an object, looking
+    # into the packfiles first and into the loose objects
+    # after that, the same way Git does.
+    binsha = bytes.fromhex(sha)
+
+    for pack in pack_list(repo):
+        offset = pack.find_offset(binsha)
+        if offset is not None:
+            return pack.read(repo, offset)
+
+    raw = object_read_loose(repo, sha)
+    if raw is not None:
+        return raw
+
+    # A packfile may have been written since we listed them
+    # (by a repack, for example), so have a second look.
+    for pack in pack_list(repo, refresh=True):
+        offset = pack.find_offset(binsha)
+        if offset is not None:
+            return pack.read(repo, offset)
+
+    raise Exception("Object {0} not found".format(sha))
+
+def object_exists(repo, sha):
+    # Whether repo has the object, packed or loose
+    binsha = bytes.fromhex(sha)
+
+    # The object index is trusted for packed objects, but
+    # loose objects may have been removed behind its back.
+    loose = repo_path(repo, "objects", sha[0:2], sha[2:])
+    index = oid_index(repo)
+    if index:
+        if index.lookup(binsha) == OID_INDEX_PACKED:
+            return True
+        if os.path.exists(loose):
+            return True
+        return any(pack.find_offset(binsha) is not None
+                   for pack in index.uncovered)
+
+    for pack in pack_list(repo):
+        if pack.find_offset(binsha) is not None:
+            return True
+    return os.path.exists(loose)
+
+def object_header(repo, sha):
+    # Read the type and the size of an object without
+    # inflating all of it.  Returns (fmt, size).
+    cache = repo.object_cache
+    if cache is not None and sha in cache.objects:
+        obj, _, length = cache.objects[sha]
+        return obj.fmt, length
+
+    binsha = bytes.fromhex(sha)
+
+    for pack in pack_list(repo):
+        offset = pack.find_offset(binsha)
+        if offset is not None:
+            return pack.header(repo, offset)
+
+    path = repo_path(repo, "objects", sha[0:2], sha[2:])
+    if os.path.exists(path):
+        return object_header_loose(path, sha)
+
+    for pack in pack_list(repo, refresh=True):
+        offset = pack.find_offset(binsha)
+        if offset is not None:
+            return pack.header(repo, offset)
+
+    raise Exception("Object {0} not found".format(sha))
+
+def object_stream(repo, sha):
+    # Open an object for reading its contents in chunks of
+    # at most OBJECT_CHUNK_SIZE bytes.  Returns (fmt, size,
+    # chunks), where chunks is a generator which checks the
+    # size once it is exhausted.
+    binsha = bytes.fromhex(sha)
+
+    for pack in pack_list(repo):
+        offset = pack.find_offset(binsha)
+        if offset is not None:
+            return pack.stream(repo, offset)
+
+    path = repo_path(repo, "objects", sha[0:2], sha[2:])
+    if os.path.exists(path):
+        return object_stream_loose(path, sha)
+
+    for pack in pack_list(repo, refresh=True):
+        offset = pack.find_offset(binsha)
+        if offset is not None:
+            return pack.stream(repo, offset)
+
+    raise Exception("Object {0} not found".format(sha))
+
+def object_stream_loose(path, sha):
+    f = open(path, "rb")
+    d = zlib.decompressobj()
+
+    # Inflate the header, and whatever comes with it
+    head = b''
+    while b'\x00' not in head:
+        buf = d.unconsumed_tail or f.read(256)
+        if not buf or d.eof:
+            f.close()
             raise Exception(
-                "Unknown type %s for object %s".format(
-                    fmt.decode("ascii"), sha
-                )
+                "Malformed object {0}: no header".format(sha))
+        head += perf_decompress(d, buf, 256)
+
+    x = head.find(b' ')
+    y = head.find(b'\x00', x)
+    fmt = head[0:x]
+    size = int(head[x+1:y].decode("ascii"))
+
+    def chunks():
+        with f:
+            length = len(head) - y - 1
+            if length:
+                yield head[y+1:]
+
+            while not d.eof:
+                buf = d.unconsumed_tail or f.read(65536)
+                if not buf:
+                    break
+                chunk = perf_decompress(d, buf, OBJECT_CHUNK_SIZE)
+                if chunk:
+                    length += len(chunk)
+                    yield chunk
+
+        if length != size:
+            raise Exception(
+                "Malformed object {0}: bad length".format(sha))
+
+    return fmt, size, chunks()
+
+def object_header_loose(path, sha):
+    # Inflate a loose object only until the end of the
+    # "type size\0" header.
+    d = zlib.decompressobj()
+    header = b''
+
+    with open(path, "rb") as f:
+        while b'\x00' not in header:
+            buf = d.unconsumed_tail or f.read(256)
+            if not buf or d.eof:
+                raise Exception(
+                    "Malformed object {0}: no header".format(sha))
+            header += perf_decompress(d, buf, 64)
+
+    x = header.find(b' ')
+    y = header.find(b'\x00', x)
+    return header[0:x], int(header[x+1:y].decode("ascii"))
+
+def object_read_loose(repo, sha):
+    # Read a loose object, returning None if it isn't there.
+    path = repo_path(repo, "objects", sha[0:2], sha[2:])
+
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+    with f:
+        data = f.read()
+
+    raw = perf_decompress(None, data)
+
+    # Read object type
+    x = raw.find(b' ')
+    fmt = raw[0:x]
+
+    # Read and validate object size
+    y = raw.find(b'\x00', x)
+    size = int(raw[x:y].decode("ascii"))
+
+    if size != len(raw)-y-1:
+        raise Exception(
+            "Malformed object {0}: bad length".format(
+                sha
             )
+        )
 
-        # Call constructor and return object
-        return c(repo, raw[y+1:])
+    return fmt, raw[y+1:]
 
 def object_find(repo, name, fmt=None, follow=True):
     sha = object_resolve(repo, name)
@@ -502,19 +1570,26 @@ def object_find(repo, name, fmt=None, follow=True):
         return sha
 
     while True:
-        obj = object_read(repo, sha)
-
-        if obj.fmt == fmt:
+        # The header is enough to know if we're done,
+        # which spares inflating a whole blob.
+        obj_fmt = object_header(repo, sha)[0]
+        if obj_fmt == fmt:
             return sha
 
         if not follow:
             return None
 
-        # Follow tags
-        if obj.fmt == b'tag':
-            sha = obj.kvlm[b'object'].decode("ascii")
-        elif obj.fmt == b'commit' and fmt == b'tree':
-            sha = obj.kvlm[b'tree'].decode("ascii")
+        # Follow tags, straight to their target if
+        # packed-refs knows it
+        if obj_fmt == b'tag':
+            peeled = ref_snapshot(repo).peeled.get(sha)
+            if peeled:
+                sha = peeled
+            else:
+                sha = object_read(repo, sha).kvlm[b'object'] \
+                    .decode("ascii")
+        elif obj_fmt == b'commit' and fmt == b'tree':
+            sha = commit_tree(repo, sha)
         else:
             return None
 
@@ -529,8 +1604,7 @@ def object_resolve(repo, name):
     - branches
     - remote branches'''
     candidates = list()
-    hashRE = re.compile(r"^[0-9A-Fa-f]{1,16}$")
-    smallHashRE = re.compile(r"^[0-9A-Fa-f]{1,16}$")
+    hashRE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
 
     # Empty string?  Abort.
     if not name.strip():
@@ -538,27 +1612,51 @@ def object_resolve(repo, name):
 
     # Head is nonambiguous
     if name == "HEAD":
-        return [ ref_resolve(repo, "HEAD") ]
+        head = ref_resolve(repo, "HEAD")
+        return [ head ] if head else []
 
+    # This is a complete hash
+    if len(name) == 40 and hashRE.match(name):
+        return [ name.lower() ]
+
+    # Tags, branches and remote branches, looked up in the
+    # ref snapshot
+    sha = ref_dwim(repo, name)
+    if sha:
+        return [ sha ]
 
     if hashRE.match(name):
-        if len(name) == 40:
-            # This is a complete hash
-            return [ name.lower() ]
-        elif len(name) >= 4:
-            # This is a small hash 4 seems to be the 
-            # minimal length for git to consider something 
-            # a short hash.
-            # This limit is documented in man git-rev-parse
-            name = name.lower()
-            prefix = name[0:2]
-            path = repo_dir(repo, "objects", 
-                prefix, mkdir=False)
-            if path:
-                rem = name[2:]
-                for f in os.listdir(path):
-                    if f.startswith(rem):
-                        candidates.append(prefix + f)
+        # This is a small hash 4 seems to be the 
+        # minimal length for git to consider something 
+        # a short hash.
+        # This limit is documented in man git-rev-parse
+        name = name.lower()
+
+        # The object index answers with a bisection, for
+        # the loose objects too unless their directory
+        # changed since it was written, and then only that
+        # directory is listed.
+        prefix = name[0:2]
+        index = oid_index(repo)
+        fresh = index is not None and index.fresh(
+            repo_path(repo, "objects", prefix))
+        if index:
+            candidates = index.find_prefix(name, loose=fresh)
+
+        path = None if fresh else repo_dir(repo, "objects",
+            prefix, mkdir=False)
+        if path:
+            rem = name[2:]
+            for f in os.listdir(path):
+                if f.startswith(rem) and prefix + f not in candidates:
+                    candidates.append(prefix + f)
+
+        # Packed objects can match the prefix too
+        if not index:
+            for pack in pack_list(repo):
+                for sha in pack.find_prefix(name):
+                    if sha not in candidates:
+                        candidates.append(sha)
 
     return candidates
 
@@ -571,90 +1669,1287 @@ def object_write(obj, actually_write=True):
     # Compute Hash
     sha = hashlib.sha1(result).hexdigest()
 
-    if actually_write:
-        path = repo_file(obj.repo, "objects", sha[0:2],
-            sha[2:], mkdir=actually_write)
+    if actually_write and not object_exists(obj.repo, sha):
+        compressed = perf_compress(zlib.compress, result)
+
+        fd, tmp = object_tempfile(obj.repo)
+        with os.fdopen(fd, "wb") as f:
+            f.write(compressed)
+        object_rename(obj.repo, tmp, sha)
+
+    # Cache a copy of our own: the caller may well modify
+    # obj and write it again.
+    cache = obj.repo.object_cache if obj.repo else None
+    if cache is not None and sha not in cache.objects:
+        cache.put(sha, type(obj)(obj.repo, data), len(data))
+
+    return sha
+
+# Size of the chunks large files are read by
+OBJECT_CHUNK_SIZE = 1024 * 1024
+
+def object_hash_file(path, fmt=b'blob', repo=None):
+    # Hash the file at path as an object of type fmt and,
+    # if repo is given, write it there unless it has it
+    # already.  Large files are read in chunks, so memory use
+    # doesn't depend on their size.
+    size = os.stat(path).st_size
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+
+    if size <= OBJECT_CHUNK_SIZE:
+        # Small files are read at once
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) != size:
+            raise Exception(
+                "{0} changed while being hashed".format(path))
+
+        result = header + data
+        sha = hashlib.sha1(result).hexdigest()
+        if repo and not object_exists(repo, sha):
+            compressed = perf_compress(zlib.compress, result)
+
+            fd, tmp = object_tempfile(repo)
+            with os.fdopen(fd, "wb") as f:
+                f.write(compressed)
+            object_rename(repo, tmp, sha)
+        return sha
 
-        with open(path, "wb") as f:
-            f.write(zlib.compress(result))
+    # Large files are hashed first, so that objects we
+    # already have are neither compressed nor written, and
+    # read again to be compressed if we don't.
+    sha = object_hash_chunks(path, header, size)
+    if repo and not object_exists(repo, sha):
+        fd, tmp = object_tempfile(repo)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                again = object_hash_chunks(path, header, size, out)
+            if again != sha:
+                raise Exception(
+                    "{0} changed while being hashed".format(path))
+        except:
+            os.unlink(tmp)
+            raise
+        object_rename(repo, tmp, sha)
 
     return sha
 
+# The hex SHA of the object with header whose contents are
+# the size bytes of the file at path, read in chunks, which
+# are deflated to out as well if it is given
+def object_hash_chunks(path, header, size, out=None):
+    sha = hashlib.sha1(header)
+    if out:
+        z = zlib.compressobj()
+        out.write(perf_compress(z.compress, header))
+
+    read = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(OBJECT_CHUNK_SIZE)
+            if not chunk:
+                break
+            read += len(chunk)
+            sha.update(chunk)
+            if out:
+                out.write(perf_compress(z.compress, chunk))
+
+    if read != size:
+        raise Exception(
+            "{0} changed while being hashed".format(path))
+
+    if out:
+        out.write(perf_compress(z.flush))
+    return sha.hexdigest()
+
+# Open a temporary file in objects/, to be renamed to its
+# final path by object_rename once complete.  Returns
+# (fd, path).
+def object_tempfile(repo):
+    return tempfile.mkstemp(prefix="tmp_obj_",
+        dir=repo_dir(repo, "objects", mkdir=True))
+
+# Move a complete object in place.  Renaming is atomic, so
+# readers never see a partially written object.
+def object_rename(repo, tmp, sha):
+    repo_dir(repo, "objects", sha[0:2], mkdir=True)
+    os.chmod(tmp, 0o444)
+    os.rename(tmp, repo_path(repo, "objects", sha[0:2], sha[2:]))
+
 def object_hash(fd, fmt, repo=None):
     data = fd.read()
 
     # Choose constructor depending on
     # object type found in header.
-    if   fmt==b'commit' : obj=GitCommit(repo, data)
-    elif fmt==b'tree'   : obj=GitTree(repo, data)
-    elif fmt==b'tag'    : obj=GitTag(repo, data)
-    elif fmt==b'blob'   : obj=GitBlob(repo, data)
-    else:
-        raise Exception("Unknown type %s!" % fmt)
+    obj = object_class(fmt)(repo, data)
 
     return object_write(obj, repo)
 
 # }}
 
-# Commit Parsing {{
+# Packfiles {{
+
+# Object types as numbered inside of packfiles
+PACK_OBJ_COMMIT = 1
+PACK_OBJ_TREE = 2
+PACK_OBJ_BLOB = 3
+PACK_OBJ_TAG = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+pack_type_fmt = {
+    PACK_OBJ_COMMIT : b'commit',
+    PACK_OBJ_TREE   : b'tree',
+    PACK_OBJ_BLOB   : b'blob',
+    PACK_OBJ_TAG    : b'tag',
+}
+
+pack_fmt_type = { v: k for k, v in pack_type_fmt.items() }
+
+# A packfile (objects/pack/pack-*.pack) along with its
+# version 2 index (objects/pack/pack-*.idx).  Both files
+# are memory-mapped, so looking an object up only touches
+# the few pages the binary search lands on.
+class GitPack(object):
+    idx = None
+    """The memory-mapped .idx file"""
+    pack = None
+    """The memory-mapped .pack file"""
+    fanout = None
+    """The 256 cumulative object counts, by first byte of SHA"""
+    count = None
+    """Number of objects in the pack"""
+    base_cache = None
+    """Delta bases already inflated, by offset, in LRU order"""
+    base_cache_size = 0
+    base_cache_limit = 16 * 1024 * 1024
+    """How many bytes of inflated delta bases we keep around"""
+
+    def __init__(self, path):
+        # path is the packfile name without its extension
+        self.path = path
 
-# A simple commit parser
-# KVLM is for Key-Value List with Message
-def kvlm_parse(raw, start=0, dct=None):
-    if not dct:
-        dct = collections.OrderedDict()
-        # Note: Do NOT declare it as dct=OrderedDict()
-        # or all calls to the functions will endlessly
-        # grow the same dict.
-
-    # Search for the next space and next newline
-    spc = raw.find(b' ', start)
-    nl = raw.find(b'\n', start)
-
-    # If space appears before newline, we have a keyword.
-
-    # Base case
-    # =========
-    # If newline appears first (or there's no space at all,
-    # in which case find returns -1), we assume a 
-    # blank line.  A blank line means the remainder of 
-    # the data is the message.
-    if (spc < 0) or (nl < spc):
-        assert(nl == start)
-        dct[b''] = raw[start+1:]
-        return dct
+        with open(path + ".idx", "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0,
+                access=mmap.ACCESS_READ)
 
-    # Recursive case
-    # ==============
-    # we read a key-value pair and recurse for the next.
-    key = raw[start:spc]
-
-    # Find the end of the value. Continuation lines 
-    # begin with a space, so we loop until we find a "\n" 
-    # not followed by a space.
-    end = start
-    while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end+1] != ord(' '): break
+        if self.idx[0:8] != b'\xfftOc\x00\x00\x00\x02':
+            raise Exception(
+                "Unsupported pack index {0}.idx".format(path))
 
-    # Grab the value
-    # Also, drop the leading space on continuation lines
-    value = raw[spc+1:end].replace(b'\n ', b'\n')
+        self.fanout = struct.unpack_from(">256I", self.idx, 8)
+        self.count = self.fanout[255]
 
-    # Don't overwrite existing data contents
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
-        else:
-            dct[key] = [ dct[key], value ]
-    else:
-        dct[key]=value
+        # Offsets of the tables following the fanout
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_offset_table = \
+            self.offset_table + 4 * self.count
 
-    return kvlm_parse(raw, start=end+1, dct=dct)
+        with open(path + ".pack", "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0,
+                access=mmap.ACCESS_READ)
 
-# Serialises Commit objects
+        if self.pack[0:4] != b'PACK' or struct.unpack_from(
+                ">I", self.pack, 4)[0] not in (2, 3):
+            raise Exception(
+                "Unsupported packfile {0}.pack".format(path))
+
+        self.base_cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def sha(self, i):
+        # The binary SHA of the i-th object, in index order
+        pos = self.sha_table + 20 * i
+        return self.idx[pos:pos+20]
+
+    def offset(self, i):
+        # The pack offset of the i-th object, in index order
+        off = struct.unpack_from(
+            ">I", self.idx, self.offset_table + 4 * i)[0]
+        if off & 0x80000000:
+            # Offsets past 2GiB live in the large table
+            off = struct.unpack_from(">Q", self.idx,
+                self.large_offset_table
+                + 8 * (off & 0x7fffffff))[0]
+        return off
+
+    def _bisect(self, binsha):
+        # Binary search inside the fanout bucket of the
+        # first byte.  Returns the first position whose SHA
+        # is not lower than binsha.
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha(mid) < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_offset(self, binsha):
+        # Offset of the object in the packfile, or None
+        i = self._bisect(binsha)
+        if i < self.count and self.sha(i) == binsha:
+            return self.offset(i)
+        return None
+
+    def find_prefix(self, prefix):
+        # All the hex SHAs of this pack starting with prefix
+        ret = list()
+        i = self._bisect(bytes.fromhex(
+            prefix.ljust(40, "0")))
+        while i < self.count:
+            sha = self.sha(i).hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+            i += 1
+        return ret
+
+    def entry_header(self, offset):
+        # Decode the type and inflated size at offset.
+        # Returns (type, size, position of what follows).
+        c = self.pack[offset]
+        type = (c >> 4) & 7
+        size = c & 0x0f
+        shift = 4
+        pos = offset + 1
+        while c & 0x80:
+            c = self.pack[pos]
+            size |= (c & 0x7f) << shift
+            shift += 7
+            pos += 1
+        return type, size, pos
+
+    def header(self, repo, offset):
+        # The type and size of the object at offset, without
+        # inflating it.  For deltas, the size comes from the
+        # first bytes of the delta, and the type from the
+        # end of the chain.  Returns (fmt, size).
+        size = None
+        while True:
+            type, entry_size, pos = self.entry_header(offset)
+
+            if type in pack_type_fmt:
+                if size is None:
+                    size = entry_size
+                return pack_type_fmt[type], size
+
+            if type == PACK_OBJ_OFS_DELTA:
+                base, pos = self.ofs_delta_base(offset, pos)
+            elif type == PACK_OBJ_REF_DELTA:
+                binsha = self.pack[pos:pos+20]
+                base = self.find_offset(binsha)
+                pos += 20
+            else:
+                raise Exception(
+                    "Unknown type {0} in {1}.pack".format(
+                        type, self.path))
+
+            if size is None:
+                # The result size is the second varint at
+                # the start of the delta.
+                d = zlib.decompressobj()
+                delta = b''
+                while len(delta) < 20 and not d.eof:
+                    buf = d.unconsumed_tail
+                    if not buf:
+                        buf = self.pack[pos:pos+256]
+                        pos += 256
+                    delta += perf_decompress(d, buf, 20 - len(delta))
+                _, pos = delta_varint(delta, 0)
+                size, _ = delta_varint(delta, pos)
+
+            if base is None:
+                return object_header(repo, binsha.hex())[0], \
+                    size
+            offset = base
+
+    def ofs_delta_base(self, offset, pos):
+        # Decode the negative offset of an OFS_DELTA base.
+        # Returns (base offset, position of the delta data).
+        c = self.pack[pos]
+        pos += 1
+        ofs = c & 0x7f
+        while c & 0x80:
+            c = self.pack[pos]
+            pos += 1
+            ofs = ((ofs + 1) << 7) | (c & 0x7f)
+        return offset - ofs, pos
+
+    def inflate(self, pos, size):
+        # Inflate the zlib stream starting at pos, which we
+        # know decompresses to size bytes.
+        d = zlib.decompressobj()
+        parts = list()
+        chunk = size + 64
+        end = pos
+        while not d.eof:
+            buf = self.pack[end:end+chunk]
+            if not buf:
+                raise Exception(
+                    "Truncated packfile {0}.pack".format(
+                        self.path))
+            parts.append(perf_decompress(d, buf))
+            end += len(buf)
+            chunk = 65536
+
+        data = b''.join(parts)
+        if len(data) != size:
+            raise Exception(
+                "Malformed entry in {0}.pack: bad length"
+                .format(self.path))
+        return data
+
+    def stream(self, repo, offset):
+        # Like object_stream, for the object at offset.
+        # Full objects are inflated straight from the pack;
+        # deltas have to be applied to the whole object.
+        type, size, pos = self.entry_header(offset)
+
+        if type not in pack_type_fmt:
+            fmt, data = self.read(repo, offset)
+
+            def chunks():
+                view = memoryview(data)
+                for i in range(0, len(data), OBJECT_CHUNK_SIZE):
+                    yield view[i:i+OBJECT_CHUNK_SIZE]
+
+            return fmt, len(data), chunks()
+
+        def chunks():
+            d = zlib.decompressobj()
+            length = 0
+            start = pos
+            while not d.eof:
+                buf = d.unconsumed_tail
+                if not buf:
+                    buf = self.pack[start:start+65536]
+                    start += len(buf)
+                    if not buf:
+                        break
+                chunk = perf_decompress(d, buf, OBJECT_CHUNK_SIZE)
+                if chunk:
+                    length += len(chunk)
+                    yield chunk
+
+            if length != size:
+                raise Exception(
+                    "Malformed entry in {0}.pack: bad length"
+                    .format(self.path))
+
+        return pack_type_fmt[type], size, chunks()
+
+    def read(self, repo, offset):
+        # Read the object at offset, resolving deltas.
+        # Returns (fmt, data).
+
+        # Walk down the delta chain until we find either
+        # a full object or a base we have in cache.  This
+        # is done iteratively: chains can be long.
+        chain = list()
+        while True:
+            cached = self.cached_base(offset)
+            if cached is not None:
+                type, data = cached
+                break
+
+            type, size, pos = self.entry_header(offset)
+
+            if type == PACK_OBJ_OFS_DELTA:
+                base, pos = self.ofs_delta_base(offset, pos)
+                chain.append((offset, pos, size))
+                offset = base
+            elif type == PACK_OBJ_REF_DELTA:
+                binsha = self.pack[pos:pos+20]
+                chain.append((offset, pos + 20, size))
+                base = self.find_offset(binsha)
+                if base is not None:
+                    offset = base
+                else:
+                    # The base lives elsewhere in the repo
+                    fmt, data = object_read_raw(repo,
+                        binsha.hex())
+                    type = pack_fmt_type[fmt]
+                    offset = None
+                    break
+            elif type in pack_type_fmt:
+                data = self.inflate(pos, size)
+                break
+            else:
+                raise Exception(
+                    "Unknown type {0} in {1}.pack".format(
+                        type, self.path))
+
+        # Apply the deltas back up the chain, remembering
+        # the intermediate results as they're likely bases
+        # for other objects too.
+        if chain and offset is not None:
+            self.cache_base(offset, type, data)
+        for offset, pos, size in reversed(chain):
+            data = delta_apply(data, self.inflate(pos, size))
+            self.cache_base(offset, type, data)
+
+        return pack_type_fmt[type], data
+
+    # The cache is shared by the threads of a parallel
+    # checkout, hence the lock.
+    def cached_base(self, offset):
+        with self.lock:
+            entry = self.base_cache.get(offset)
+            if entry is not None:
+                self.base_cache.move_to_end(offset)
+            return entry
+
+    def cache_base(self, offset, type, data):
+        if len(data) > self.base_cache_limit // 4:
+            return
+
+        with self.lock:
+            if offset in self.base_cache:
+                self.base_cache.move_to_end(offset)
+                return
+
+            self.base_cache[offset] = (type, data)
+            self.base_cache_size += len(data)
+            while self.base_cache_size > self.base_cache_limit:
+                _, (_, old) = self.base_cache.popitem(last=False)
+                self.base_cache_size -= len(old)
+
+def pack_list(repo, refresh=False):
+    # The packfiles of repo, loaded once per repository
+    if repo.packs is not None and not refresh:
+        return repo.packs
+
+    known = dict()
+    if repo.packs:
+        known = { p.path: p for p in repo.packs }
+
+    packs = list()
+    path = repo_path(repo, "objects", "pack")
+    if os.path.isdir(path):
+        for f in sorted(os.listdir(path)):
+            if not f.endswith(".idx"):
+                continue
+            name = os.path.join(path, f[:-4])
+            if name in known:
+                packs.append(known[name])
+            elif os.path.exists(name + ".pack"):
+                packs.append(GitPack(name))
+
+    repo.packs = packs
+    return packs
+
+# Read the variable length sizes at the start of a delta
+def delta_varint(delta, pos):
+    ret = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        ret |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return ret, pos
+
+# Rebuild an object from its base and a delta, which is
+# a list of "copy from base" and "insert" instructions.
+def delta_apply(base, delta):
+    base_size, pos = delta_varint(delta, 0)
+    result_size, pos = delta_varint(delta, pos)
+
+    if base_size != len(base):
+        raise Exception("Delta base size mismatch")
+
+    out = bytearray()
+    max = len(delta)
+    while pos < max:
+        c = delta[pos]
+        pos += 1
+        if c & 0x80:
+            # Copy: the low bits tell which offset and size
+            # bytes follow.
+            off = 0
+            for i in range(4):
+                if c & (1 << i):
+                    off |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if c & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[off:off+size]
+        elif c:
+            # Insert: c bytes follow verbatim.
+            out += delta[pos:pos+c]
+            pos += c
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if len(out) != result_size:
+        raise Exception("Delta result size mismatch")
+
+    return bytes(out)
+
+# }}
+
+# Writing Packfiles {{
+
+# Writes a version 2 packfile and its index into
+# objects/pack.  Objects are appended with add() (or
+# add_delta() for an OFS_DELTA against an object already in
+# this pack), and finish() writes the index and moves both
+# files in place.  When the number of objects isn't known
+# in advance, the header is patched at the end.
+class GitPackWriter(object):
+    def __init__(self, repo, count=None):
+        self.repo = repo
+        self.count = count
+        self.entries = dict()
+        """Binary SHA => (offset, crc32) of written objects"""
+
+        # Names of our own, as a process may write several
+        # packs at once
+        fd, self.tmp_path = tempfile.mkstemp(prefix="tmp_pack_",
+            dir=repo_dir(repo, "objects", "pack", mkdir=True))
+        self.file = os.fdopen(fd, "wb")
+        self.sha = hashlib.sha1() if count is not None else None
+        self.offset = 0
+
+        self._write(b'PACK' + struct.pack(">II", 2,
+            count if count is not None else 0))
+
+    def _write(self, data):
+        self.file.write(data)
+        if self.sha:
+            self.sha.update(data)
+        self.offset += len(data)
+
+    def _entry(self, binsha, type, size, extra, data):
+        if binsha in self.entries:
+            return self.entries[binsha][0]
+
+        # Type and size header, then the delta base if any,
+        # then the deflated contents.
+        c = (type << 4) | (size & 0x0f)
+        size >>= 4
+        header = bytearray()
+        while size:
+            header.append(c | 0x80)
+            c = size & 0x7f
+            size >>= 7
+        header.append(c)
+
+        entry = bytes(header) + extra \
+            + perf_compress(zlib.compress, data)
+        offset = self.offset
+        self.entries[binsha] = (offset, zlib.crc32(entry))
+        self._write(entry)
+        return offset
+
+    def add(self, binsha, fmt, data):
+        # Append a full object, returning its offset
+        return self._entry(binsha, pack_fmt_type[fmt],
+            len(data), b'', data)
+
+    def add_delta(self, binsha, base, delta, size):
+        # Append a delta against the object with binary
+        # SHA base, already in this pack.  size is the size
+        # of the delta instructions.
+        ofs = self.offset - self.entries[base][0]
+
+        # Negative offset, in Git's own varint flavour
+        extra = bytearray([ofs & 0x7f])
+        ofs >>= 7
+        while ofs:
+            ofs -= 1
+            extra.insert(0, 0x80 | (ofs & 0x7f))
+            ofs >>= 7
+
+        return self._entry(binsha, PACK_OBJ_OFS_DELTA,
+            size, bytes(extra), delta)
+
+    def read(self, binsha):
+        # The type and contents of an object added in full,
+        # read back before the pack is finished
+        self.file.flush()
+        with open(self.tmp_path, "rb") as f:
+            f.seek(self.entries[binsha][0])
+            c = f.read(1)[0]
+            type = (c >> 4) & 7
+            while c & 0x80:
+                c = f.read(1)[0]
+
+            d = zlib.decompressobj()
+            ret = list()
+            while not d.eof:
+                chunk = f.read(65536)
+                if not chunk:
+                    raise Exception("Truncated pack entry")
+                ret.append(perf_decompress(d, chunk))
+        return pack_type_fmt[type], b''.join(ret)
+
+    def finish(self):
+        # Complete the packfile and write its index.
+        # Returns the GitPack for the new pack.
+        count = len(self.entries)
+        if self.count is not None and count != self.count:
+            raise Exception(
+                "Pack announced {0} objects but has {1}"
+                .format(self.count, count))
+
+        if self.sha is None:
+            # Patch the object count in, and hash the whole
+            # file now that it is final.
+            self.file.seek(8)
+            self.file.write(struct.pack(">I", count))
+            self.file.close()
+            self.sha = hashlib.sha1()
+            with open(self.tmp_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    self.sha.update(chunk)
+            self.file = open(self.tmp_path, "ab")
+
+        checksum = self.sha.digest()
+        self.file.write(checksum)
+        self.file.close()
+
+        name = repo_path(self.repo, "objects", "pack",
+            "pack-" + checksum.hex())
+        fd, tmp_idx = tempfile.mkstemp(prefix="tmp_idx_",
+            dir=os.path.dirname(self.tmp_path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(pack_index_serialize(self.entries,
+                checksum))
+
+        # Read-only, like loose objects
+        for tmp, ext in ((self.tmp_path, ".pack"), (tmp_idx, ".idx")):
+            os.chmod(tmp, 0o444)
+            os.rename(tmp, name + ext)
+
+        pack_list(self.repo, refresh=True)
+        return GitPack(name)
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.tmp_path)
+
+# Serialize a version 2 pack index from the entries of a
+# GitPackWriter and the checksum of the packfile.
+def pack_index_serialize(entries, checksum):
+    shas = sorted(entries)
+
+    fanout = [0] * 256
+    for binsha in shas:
+        fanout[binsha[0]] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+
+    offsets = list()
+    large = list()
+    for binsha in shas:
+        offset = entries[binsha][0]
+        if offset >= 0x80000000:
+            offsets.append(0x80000000 | len(large))
+            large.append(offset)
+        else:
+            offsets.append(offset)
+
+    ret = b''.join([
+        b'\xfftOc', struct.pack(">I", 2),
+        struct.pack(">256I", *fanout),
+        b''.join(shas),
+        struct.pack(">{0}I".format(len(shas)),
+            *[ entries[binsha][1] for binsha in shas ]),
+        struct.pack(">{0}I".format(len(shas)), *offsets),
+        struct.pack(">{0}Q".format(len(large)), *large),
+        checksum ])
+
+    return ret + hashlib.sha1(ret).digest()
+
+# Index every aligned block of a delta base.  Later
+# occurrences don't replace earlier ones, so copies tend to
+# come from the start of the base.
+DELTA_BLOCK = 16
+
+def delta_index(base):
+    index = dict()
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[i:i+DELTA_BLOCK], i)
+    return index
+
+# Compute a delta rebuilding target from base, in the format
+# delta_apply reads.  Gives up and returns None as soon as
+# the delta grows past max_size bytes.  index is the
+# delta_index of base, when the caller already has it.
+def delta_create(base, target, max_size=None, index=None):
+    block = DELTA_BLOCK
+    if index is None:
+        index = delta_index(base)
+
+    def varint(n):
+        ret = bytearray()
+        while True:
+            c = n & 0x7f
+            n >>= 7
+            if n:
+                ret.append(c | 0x80)
+            else:
+                ret.append(c)
+                return ret
+
+    out = varint(len(base)) + varint(len(target))
+    if max_size is None:
+        max_size = len(target)
+
+    def insert(start, end):
+        while start < end:
+            n = min(end - start, 0x7f)
+            out.append(n)
+            out.extend(target[start:start+n])
+            start += n
+
+    def copy(off, size):
+        while size:
+            n = min(size, 0x10000)
+            c = 0x80
+            args = bytearray()
+            for i in range(4):
+                byte = (off >> (8 * i)) & 0xff
+                if byte:
+                    c |= 1 << i
+                    args.append(byte)
+            for i in range(3):
+                byte = ((n if n != 0x10000 else 0)
+                        >> (8 * i)) & 0xff
+                if byte:
+                    c |= 0x10 << i
+                    args.append(byte)
+            out.append(c)
+            out.extend(args)
+            off += n
+            size -= n
+
+    pending = 0
+    i = 0
+    end = len(target)
+    while i + block <= end:
+        off = index.get(target[i:i+block])
+        if off is None:
+            i += 1
+            # Bytes we'll have to insert count too
+            if len(out) + i - pending > max_size:
+                return None
+            continue
+
+        # Grow the match backwards over pending bytes...
+        while i > pending and off > 0 \
+                and target[i-1] == base[off-1]:
+            i -= 1
+            off -= 1
+
+        # ...and forwards, comparing slices that double in
+        # size while they match, then halve down to a byte.
+        n = block
+        step = block
+        while step:
+            if target[i+n:i+n+step] == base[off+n:off+n+step] \
+                    and i + n + step <= end \
+                    and off + n + step <= len(base):
+                n += step
+                step *= 2
+            else:
+                step //= 2
+
+        insert(pending, i)
+        copy(off, n)
+        i += n
+        pending = i
+
+        if len(out) > max_size:
+            return None
+
+    insert(pending, end)
+    if len(out) > max_size:
+        return None
+
+    return bytes(out)
+
+# Git's hash of a path name, which sorts files with the same
+# name (wherever they are in the tree) next to each other.
+def pack_name_hash(name):
+    hash = 0
+    for c in name:
+        if chr(c).isspace():
+            continue
+        hash = ((hash >> 2) + (c << 24)) & 0xffffffff
+    return hash
+
+# List the objects reachable from the refs and HEAD, as
+# (sha, fmt, size, name hash) tuples.  Blobs are only
+# inflated as far as their header, the other objects are read
+# to find what they point to.
+def repack_walk(repo):
+    ret = list()
+    seen = set()
+    stack = [ (sha, b'', False) for sha in ref_list_shas(repo) ]
+    while stack:
+        sha, name, blob = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        if blob:
+            fmt, size = object_header(repo, sha)
+            ret.append((sha, fmt, size, pack_name_hash(name)))
+            continue
+
+        fmt, data = object_read_raw(repo, sha)
+        ret.append((sha, fmt, len(data), pack_name_hash(name)))
+
+        if fmt == b'commit':
+            kvlm = kvlm_parse(data)
+            stack.append((kvlm[b'tree'].decode("ascii"), b'', False))
+            for p in commit_kvlm_parents(kvlm):
+                stack.append((p, b'', False))
+        elif fmt == b'tag':
+            kvlm = kvlm_parse(data)
+            stack.append((kvlm[b'object'].decode("ascii"),
+                kvlm.get(b'tag', b''), False))
+        elif fmt == b'tree':
+            for item in GitTree(repo, data):
+                # Submodules point to other repositories
+                if item.mode == b'160000':
+                    continue
+                stack.append((item.sha, item.path,
+                    not item.mode.startswith(b'4')))
+
+    return ret
+
+# Write all the objects reachable from the refs into a single
+# packfile, deltifying each object against the best of the
+# window previous ones of the same type.  Objects are sorted
+# by type, name hash and decreasing size, as Git does, so
+# that files with the same name end up near each other and
+# deltas mostly remove data.
+def repack(repo, window=10, depth=50):
+    objects = repack_walk(repo)
+    objects.sort(key=lambda o: (pack_fmt_type[o[1]], o[3], -o[2]))
+
+    writer = GitPackWriter(repo, count=len(objects))
+    try:
+        # Window entries are [binsha, fmt, data, depth,
+        # delta index of data]
+        recent = collections.deque(maxlen=window)
+        for sha, fmt, size, _ in objects:
+            _, data = object_read_raw(repo, sha)
+            binsha = bytes.fromhex(sha)
+
+            best = None
+            # The most recent objects are the likeliest bases
+            for base in reversed(recent):
+                if base[1] != fmt or base[3] >= depth:
+                    continue
+                # Don't bother when the target is much
+                # smaller than the base
+                if size < len(base[2]) // 32:
+                    continue
+                # The delta has to be worth it
+                max_size = size // 2 - 20
+                if best:
+                    max_size = min(max_size, len(best[1]) - 1)
+                if max_size <= 0:
+                    continue
+                if base[4] is None:
+                    base[4] = delta_index(base[2])
+                delta = delta_create(base[2], data, max_size,
+                    base[4])
+                if delta is not None:
+                    best = (base, delta)
+
+            if best:
+                base, delta = best
+                writer.add_delta(binsha, base[0], delta,
+                    len(delta))
+                recent.append([binsha, fmt, data, base[3] + 1,
+                    None])
+            else:
+                writer.add(binsha, fmt, data)
+                recent.append([binsha, fmt, data, 0, None])
+
+        pack = writer.finish()
+    except:
+        writer.abort()
+        raise
+
+    return pack, objects
+
+# Disk usage and number of the loose objects, then of the
+# packs, as ((loose count, loose bytes), (pack objects, pack
+# bytes)).
+def objects_usage(repo):
+    loose = [0, 0]
+    packed = [0, 0]
+    path = repo_path(repo, "objects")
+    for d in os.listdir(path):
+        if len(d) != 2:
+            continue
+        for f in os.scandir(os.path.join(path, d)):
+            loose[0] += 1
+            loose[1] += f.stat().st_blocks * 512
+    for pack in pack_list(repo, refresh=True):
+        packed[0] += pack.count
+        for ext in (".pack", ".idx"):
+            packed[1] += os.stat(
+                pack.path + ext).st_blocks * 512
+    return tuple(loose), tuple(packed)
+
+# Remove the loose objects and the packs that the new pack
+# makes redundant.
+def repack_prune(repo, pack):
+    path = repo_path(repo, "objects")
+    for d in os.listdir(path):
+        if len(d) != 2:
+            continue
+        fan = os.path.join(path, d)
+        for f in os.listdir(fan):
+            if pack.find_offset(bytes.fromhex(d + f)) is not None:
+                os.unlink(os.path.join(fan, f))
+        if not os.listdir(fan):
+            os.rmdir(fan)
+
+    for old in pack_list(repo, refresh=True):
+        if old.path == pack.path:
+            continue
+        # Only drop packs whose objects were all repacked
+        if all(pack.find_offset(old.sha(i)) is not None
+               for i in range(old.count)):
+            for ext in (".idx", ".pack"):
+                os.unlink(old.path + ext)
+
+    pack_list(repo, refresh=True)
+    oid_index_write(repo)
+
+# }}
+
+# Object ID Index {{
+
+# A sorted table of the SHAs of all the objects of the
+# repository, loose and packed, in objects/info/pvc-oid-index.
+# Like Git's multi-pack-index it's memory-mapped and searched
+# by bisection, which makes existence checks and short hash
+# lookups cheap however many objects and packs there are.
+#
+# The table gets the modification time of the moment it
+# started being written.  A fan-out directory of loose
+# objects which hasn't changed since is listed exactly by
+# the table, so short hashes in it are looked up without
+# listing it.  One that changed, because pvc or another tool
+# wrote or removed objects there, is listed instead until
+# the table is rewritten, and nothing is spent on keeping
+# the table up to date as objects are written.  Packs which
+# appeared since the table was written are searched through
+# their own index, and if a pack it covers went away the
+# table isn't trusted at all until it is rewritten.
+OID_INDEX_SIGNATURE = b'PVCX'
+OID_INDEX_VERSION = 1
+
+# An entry of the table is either a loose or a packed object
+OID_INDEX_LOOSE = 0
+OID_INDEX_PACKED = 1
+
+class GitOidIndex(object):
+    data = None
+    """The memory-mapped table"""
+    count = 0
+    """Number of objects in the table"""
+    fanout = None
+    covered = None
+    """Names of the packs whose objects are in the table"""
+    uncovered = None
+    """The packs which aren't"""
+    mtime_ns = None
+    """When the table started being written"""
+
+    def __init__(self, repo, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0,
+                access=mmap.ACCESS_READ)
+            self.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+
+        sig, version, packs, self.count = struct.unpack_from(
+            ">4sIII", self.data, 0)
+        if sig != OID_INDEX_SIGNATURE or \
+                version != OID_INDEX_VERSION:
+            raise Exception(
+                "Unsupported object index {0}".format(path))
+
+        pos = 16
+        self.covered = set()
+        for i in range(packs):
+            self.covered.add(self.data[pos:pos+20].hex())
+            pos += 20
+
+        self.fanout = struct.unpack_from(">256I", self.data, pos)
+        self.sha_table = pos + 256 * 4
+        self.flag_table = self.sha_table + 20 * self.count
+
+        current = { oid_index_pack_name(p): p
+                    for p in pack_list(repo) }
+        self.valid = self.covered <= set(current)
+        self.uncovered = [ p for name, p in current.items()
+                           if name not in self.covered ]
+
+    def sha(self, i):
+        pos = self.sha_table + 20 * i
+        return self.data[pos:pos+20]
+
+    def _bisect(self, binsha):
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha(mid) < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, binsha):
+        # OID_INDEX_PACKED or OID_INDEX_LOOSE if the table
+        # has binsha, None otherwise.
+        i = self._bisect(binsha)
+        if i < self.count and self.sha(i) == binsha:
+            return self.data[self.flag_table + i]
+        return None
+
+    def fresh(self, path):
+        # Whether the loose objects of the fan-out directory
+        # path are those of the table: it didn't change since
+        # the table was written.  A change within the same
+        # tick of the clock of the file system doesn't count
+        # as older.
+        try:
+            return os.stat(path).st_mtime_ns < self.mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def find_prefix(self, prefix, loose=True):
+        # The hex SHAs starting with prefix, in the table and
+        # in the uncovered packs, leaving out the loose
+        # entries of the table unless loose.
+        ret = list()
+        low = bytes.fromhex(prefix.ljust(40, "0"))
+
+        i = self._bisect(low)
+        while i < self.count:
+            sha = self.sha(i).hex()
+            if not sha.startswith(prefix):
+                break
+            if loose or self.data[self.flag_table + i] \
+                    == OID_INDEX_PACKED:
+                ret.append(sha)
+            i += 1
+
+        for pack in self.uncovered:
+            ret.extend(pack.find_prefix(prefix))
+
+        return sorted(set(ret))
+
+def oid_index_pack_name(pack):
+    # The checksum in the name of a pack
+    return os.path.basename(pack.path)[5:]
+
+# The object index of repo, or None if it has none or can't
+# trust it.
+def oid_index(repo):
+    if repo.oid_index is None:
+        path = repo_path(repo, "objects", "info", "pvc-oid-index")
+        repo.oid_index = False
+        if os.path.exists(path):
+            index = GitOidIndex(repo, path)
+            if index.valid:
+                repo.oid_index = index
+
+    return repo.oid_index or None
+
+# Write the object index of repo from scratch, listing the
+# loose objects and the packs.  Returns the number of
+# objects, or None if another process is writing it.
+def oid_index_write(repo):
+    return oid_index_save(repo, None)
+
+# Rewrite the table of index with the packs it doesn't cover
+# and the fan-out directories which changed since it was
+# written, keeping the rest of its entries
+def oid_index_merge(repo, index):
+    return oid_index_save(repo, index)
+
+def oid_index_save(repo, index):
+    path = repo_file(repo, "objects", "info", "pvc-oid-index",
+        mkdir=True)
+
+    # Only one process rewrites the table at a time.  A lock
+    # old enough to have been left by a crash is broken, as
+    # Git does.  The lock is taken before anything is
+    # listed, and its time, by the clock of the file system,
+    # becomes that of the table: a directory changing while
+    # it is being listed ends up newer than the table.
+    fd = oid_index_lock(path + ".lock")
+    if fd is None:
+        return None
+
+    try:
+        mtime_ns = os.fstat(fd).st_mtime_ns
+        objects = repo_path(repo, "objects")
+
+        entries = dict()
+        fresh = set()
+        if index:
+            fresh = { d for d in ("{0:02x}".format(i)
+                                  for i in range(256))
+                      if index.fresh(os.path.join(objects, d)) }
+            for i in range(index.count):
+                binsha = index.sha(i)
+                flag = index.data[index.flag_table + i]
+                if flag == OID_INDEX_PACKED or \
+                        binsha[:1].hex() in fresh:
+                    entries[binsha] = flag
+
+        for d in os.listdir(objects):
+            if len(d) != 2 or d in fresh:
+                continue
+            for f in os.listdir(os.path.join(objects, d)):
+                if len(f) == 38:
+                    entries.setdefault(bytes.fromhex(d + f),
+                        OID_INDEX_LOOSE)
+
+        packs = pack_list(repo, refresh=True)
+        for pack in packs:
+            if index and oid_index_pack_name(pack) in index.covered:
+                continue
+            for i in range(pack.count):
+                entries[pack.sha(i)] = OID_INDEX_PACKED
+
+        with os.fdopen(fd, "wb") as f:
+            f.write(oid_index_serialize(entries, packs))
+        os.utime(path + ".lock", ns=(mtime_ns, mtime_ns))
+        os.rename(path + ".lock", path)
+    except BaseException:
+        os.unlink(path + ".lock")
+        raise
+
+    repo.oid_index = None
+    return len(entries)
+
+def oid_index_serialize(entries, packs):
+    shas = sorted(entries)
+
+    fanout = [0] * 256
+    for binsha in shas:
+        fanout[binsha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    names = [ bytes.fromhex(oid_index_pack_name(p))
+              for p in packs ]
+    ret = b''.join([
+        struct.pack(">4sIII", OID_INDEX_SIGNATURE,
+            OID_INDEX_VERSION, len(names), len(shas)),
+        b''.join(names),
+        struct.pack(">256I", *fanout),
+        b''.join(shas),
+        bytes([ entries[binsha] for binsha in shas ]) ])
+    return ret + hashlib.sha1(ret).digest()
+
+# Seconds after which the lock of the table is taken to be
+# left over by a crash
+OID_INDEX_LOCK_STALE = 600
+
+def oid_index_lock(path):
+    try:
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+            0o644)
+    except FileExistsError:
+        pass
+
+    try:
+        age = time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        age = 0
+    if age < OID_INDEX_LOCK_STALE:
+        return None
+
+    sys.stderr.write("warning: removing {0}, left {1:.0f}s ago\n"
+        .format(path, age))
+    try:
+        os.unlink(path)
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+            0o644)
+    except (FileNotFoundError, FileExistsError):
+        return None
+
+# }}
+
+# Commit Parsing {{
+
+# A simple commit parser
+# KVLM is for Key-Value List with Message
+#
+# A single pass over the headers: each one is a name, a
+# space and a value running to the first newline not
+# followed by a space, which would continue the value on
+# the next line.  A blank line ends the headers, the rest
+# is the message.
+KVLM_HEADER = re.compile(rb'([^ \n]+) ([^\n]*(?:\n [^\n]*)*)(?:\n|\Z)')
+
+def kvlm_parse(raw):
+    kvlm = GitKvlm(raw)
+    spans = kvlm.spans
+    match = KVLM_HEADER.match
+    end = len(raw)
+
+    pos = 0
+    while pos < end:
+        if raw[pos] == 0x0a:
+            kvlm.message = pos + 1
+            break
+
+        m = match(raw, pos)
+        if m is None:
+            raise Exception("Malformed header {0!r}".format(
+                raw[pos:raw.find(b'\n', pos)]))
+
+        key = m.group(1)
+        if key in spans:
+            spans[key].append(m.span(2))
+        else:
+            spans[key] = [ m.span(2) ]
+        pos = m.end()
+    else:
+        # Headers only, Git takes that as an empty message
+        kvlm.message = end
+
+    return kvlm
+
+# Serialises Commit objects
 def kvlm_serialize(kvlm):
-    ret = b''
+    if isinstance(kvlm, GitKvlm) and not kvlm.modified:
+        return kvlm.raw
+
+    ret = list()
 
     # Output fields
     for k in kvlm.keys():
@@ -666,12 +2961,560 @@ def kvlm_serialize(kvlm):
             val = [ val ]
 
         for v in val:
-            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+            ret.append(k + b' ' + v.replace(b'\n', b'\n ') + b'\n')
 
     # Append message
-    ret += b'\n' + kvlm[b'']
+    ret.append(b'\n')
+    ret.append(kvlm.get(b'', b''))
 
-    return ret
+    return b''.join(ret)
+
+# }}
+
+# Commit Graph {{
+
+# Git's objects/info/commit-graph: the parents, root tree,
+# date and generation number of every commit, in a sorted
+# table we can memory-map.  Walking history through it
+# spares inflating and parsing the commits themselves.
+COMMIT_GRAPH_PARENT_NONE = 0x70000000
+COMMIT_GRAPH_EXTRA_EDGES = 0x80000000
+COMMIT_GRAPH_LAST_EDGE = 0x80000000
+COMMIT_GRAPH_GENERATION_MAX = 0x3fffffff
+
+class GitCommitGraph(object):
+    data = None
+    """The memory-mapped commit-graph file"""
+    fanout = None
+    """The 256 cumulative commit counts, by first byte of SHA"""
+    count = None
+    """Number of commits in the graph"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0,
+                access=mmap.ACCESS_READ)
+
+        if self.data[0:4] != b'CGPH' or self.data[4] != 1 \
+                or self.data[5] != 1:
+            raise Exception(
+                "Unsupported commit-graph {0}".format(path))
+
+        chunks = dict()
+        for i in range(self.data[6] + 1):
+            id, offset = struct.unpack_from(">4sQ", self.data,
+                8 + 12 * i)
+            chunks[id] = offset
+
+        for id in (b'OIDF', b'OIDL', b'CDAT'):
+            if id not in chunks:
+                raise Exception("Missing {0} chunk in {1}"
+                    .format(id.decode("ascii"), path))
+
+        self.fanout = struct.unpack_from(">256I", self.data,
+            chunks[b'OIDF'])
+        self.count = self.fanout[255]
+        self.oid_table = chunks[b'OIDL']
+        self.data_table = chunks[b'CDAT']
+        self.edge_table = chunks.get(b'EDGE')
+
+    def sha(self, pos):
+        # The binary SHA of the commit at pos
+        start = self.oid_table + 20 * pos
+        return self.data[start:start+20]
+
+    def find(self, binsha):
+        # The position of a commit in the graph, or None
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sha = self.sha(mid)
+            if sha < binsha:
+                lo = mid + 1
+            elif sha > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def tree(self, pos):
+        start = self.data_table + 36 * pos
+        return self.data[start:start+20]
+
+    def parents(self, pos):
+        # The positions of the parents of the commit at pos
+        p1, p2, _, _ = struct.unpack_from(">IIII", self.data,
+            self.data_table + 36 * pos + 20)
+
+        ret = list()
+        if p1 == COMMIT_GRAPH_PARENT_NONE:
+            return ret
+        ret.append(p1)
+        if p2 == COMMIT_GRAPH_PARENT_NONE:
+            return ret
+        if not p2 & COMMIT_GRAPH_EXTRA_EDGES:
+            ret.append(p2)
+            return ret
+
+        # Octopus merges list their other parents
+        # in the EDGE chunk.
+        edge = self.edge_table + 4 * (p2 & 0x7fffffff)
+        while True:
+            p = struct.unpack_from(">I", self.data, edge)[0]
+            ret.append(p & 0x7fffffff)
+            if p & COMMIT_GRAPH_LAST_EDGE:
+                return ret
+            edge += 4
+
+    def generation(self, pos):
+        return struct.unpack_from(">I", self.data,
+            self.data_table + 36 * pos + 28)[0] >> 2
+
+    def date(self, pos):
+        high, low = struct.unpack_from(">II", self.data,
+            self.data_table + 36 * pos + 28)
+        return ((high & 3) << 32) | low
+
+def commit_graph(repo):
+    # The commit-graph of repo, or None if it has none
+    if repo.commit_graph is None:
+        path = repo_path(repo, "objects", "info", "commit-graph")
+        if os.path.exists(path):
+            repo.commit_graph = GitCommitGraph(path)
+        else:
+            # Don't look again
+            repo.commit_graph = False
+
+    return repo.commit_graph or None
+
+# The parents of a commit, as hex SHAs, from the
+# commit-graph if it has the commit.
+def commit_parents(repo, sha):
+    graph = commit_graph(repo)
+    if graph:
+        pos = graph.find(bytes.fromhex(sha))
+        if pos is not None:
+            return [ graph.sha(p).hex()
+                     for p in graph.parents(pos) ]
+
+    return commit_kvlm_parents(object_read(repo, sha).kvlm)
+
+# The root tree of a commit, from the commit-graph if
+# it has the commit.
+def commit_tree(repo, sha):
+    graph = commit_graph(repo)
+    if graph:
+        pos = graph.find(bytes.fromhex(sha))
+        if pos is not None:
+            return graph.tree(pos).hex()
+
+    return object_read(repo, sha).kvlm[b'tree'].decode("ascii")
+
+def commit_kvlm_parents(kvlm):
+    parents = kvlm.get(b'parent', [])
+    if type(parents) != list:
+        parents = [ parents ]
+    return [ p.decode("ascii") for p in parents ]
+
+# The committer timestamp of a commit
+def commit_kvlm_date(kvlm):
+    committer = kvlm[b'committer']
+    if type(committer) == list:
+        committer = committer[0]
+    return int(committer.rsplit(b' ', 2)[1])
+
+# Write a commit-graph with every commit reachable from the
+# refs and HEAD.  Returns the number of commits.
+def commit_graph_write(repo):
+    # Collect the commits, following tags to them
+    commits = dict()
+    stack = ref_list_shas(repo)
+    while stack:
+        sha = stack.pop()
+        if sha in commits:
+            continue
+        obj = object_read(repo, sha)
+        if obj.fmt == b'tag':
+            stack.append(obj.kvlm[b'object'].decode("ascii"))
+            continue
+        if obj.fmt != b'commit':
+            continue
+
+        parents = commit_kvlm_parents(obj.kvlm)
+        commits[sha] = (obj.kvlm[b'tree'].decode("ascii"),
+            parents, commit_kvlm_date(obj.kvlm))
+        stack.extend(parents)
+
+    # Generation numbers, parents first.  Done with an
+    # explicit stack, histories are deep.
+    generation = dict()
+    for sha in commits:
+        stack = [ sha ]
+        while stack:
+            top = stack[-1]
+            if top in generation:
+                stack.pop()
+                continue
+            missing = [ p for p in commits[top][1]
+                        if p not in generation ]
+            if missing:
+                stack.extend(missing)
+                continue
+            generation[top] = min(COMMIT_GRAPH_GENERATION_MAX,
+                1 + max([ generation[p] for p in commits[top][1] ],
+                        default=0))
+            stack.pop()
+
+    shas = sorted(commits)
+    position = { sha: i for i, sha in enumerate(shas) }
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    cdat = list()
+    edges = list()
+    for sha in shas:
+        tree, parents, date = commits[sha]
+        parents = [ position[p] for p in parents ]
+
+        p1 = parents[0] if parents else COMMIT_GRAPH_PARENT_NONE
+        if len(parents) < 2:
+            p2 = COMMIT_GRAPH_PARENT_NONE
+        elif len(parents) == 2:
+            p2 = parents[1]
+        else:
+            p2 = COMMIT_GRAPH_EXTRA_EDGES | len(edges)
+            edges.extend(parents[1:-1])
+            edges.append(COMMIT_GRAPH_LAST_EDGE | parents[-1])
+
+        cdat.append(bytes.fromhex(tree) + struct.pack(">IIII",
+            p1, p2, (generation[sha] << 2) | ((date >> 32) & 3),
+            date & 0xffffffff))
+
+    chunks = [
+        (b'OIDF', struct.pack(">256I", *fanout)),
+        (b'OIDL', b''.join([ bytes.fromhex(s) for s in shas ])),
+        (b'CDAT', b''.join(cdat)),
+    ]
+    if edges:
+        chunks.append((b'EDGE', struct.pack(
+            ">{0}I".format(len(edges)), *edges)))
+
+    header = b'CGPH' + bytes([1, 1, len(chunks), 0])
+    offset = len(header) + 12 * (len(chunks) + 1)
+    lookup = list()
+    for id, data in chunks:
+        lookup.append(struct.pack(">4sQ", id, offset))
+        offset += len(data)
+    lookup.append(struct.pack(">4sQ", b'\x00' * 4, offset))
+
+    ret = b''.join([ header ] + lookup
+                   + [ data for _, data in chunks ])
+    ret += hashlib.sha1(ret).digest()
+
+    path = repo_file(repo, "objects", "info", "commit-graph",
+        mkdir=True)
+    with open(path + ".lock", "wb") as f:
+        f.write(ret)
+    os.rename(path + ".lock", path)
+
+    repo.commit_graph = None
+    return len(shas)
+
+# }}
+
+# History Walking {{
+
+# How many commits the walk goes on for once only excluded
+# commits are left, to make up for clock skew.
+REV_WALK_SLOP = 5
+
+# The parents, committer date and generation number of a
+# commit.  The generation is None for commits which aren't
+# in the commit-graph.
+def commit_walk_info(repo, sha):
+    graph = commit_graph(repo)
+    if graph:
+        pos = graph.find(bytes.fromhex(sha))
+        if pos is not None:
+            return ([ graph.sha(p).hex() for p in graph.parents(pos) ],
+                    graph.date(pos), graph.generation(pos))
+
+    kvlm = object_read(repo, sha).kvlm
+    return commit_kvlm_parents(kvlm), commit_kvlm_date(kvlm), None
+
+# Walk the history from the commits of include, skipping
+# those reachable from the commits of exclude (as in
+# "exclude..include"), and yield (sha, parents) for each
+# commit as soon as its place in the output is known.
+#
+# order is "date" (newest commits first) or "topo" (no
+# parent before all of its children).  Commits older than
+# the since timestamp are left out, and their history isn't
+# walked.  Only the commits that have to be are read: the
+# first n commits of a linear history cost about n reads.
+def rev_walk(repo, include, exclude=(), order="date",
+             max_count=None, since=None):
+    if max_count is not None and max_count <= 0:
+        return
+
+    # Generation numbers give a topological order that we
+    # can stream, and make exclusions exact.  They're only
+    # known when the commit-graph has all our commits, which
+    # it has if it has the starting points.
+    graph = commit_graph(repo)
+    by_generation = graph is not None and all(
+        graph.find(bytes.fromhex(sha)) is not None
+        for sha in list(include) + list(exclude))
+
+    if order == "topo" and not by_generation:
+        walk = rev_walk_topo_sort(repo, rev_walk_queue(
+            repo, include, exclude, False, since))
+    else:
+        walk = rev_walk_queue(repo, include, exclude,
+            order == "topo", since)
+
+    for count, entry in enumerate(walk, 1):
+        yield entry
+        if count == max_count:
+            return
+
+# The priority queue behind rev_walk.  Commits come out by
+# decreasing generation if by_generation is set, by
+# decreasing date otherwise.  Excluded commits go through
+# the queue too, to mark their own parents as excluded.
+def rev_walk_queue(repo, include, exclude, by_generation, since):
+    info = dict()
+    queue = list()
+    queued = dict()
+    uninteresting = set()
+    seq = itertools.count()
+
+    # How many queue entries aren't excluded, so we know
+    # when only excluded ones are left.
+    interesting = 0
+
+    def push(sha):
+        nonlocal interesting
+        parents, date, generation = info[sha] = \
+            commit_walk_info(repo, sha)
+        key = -generation if by_generation else -date
+        entry = [ key, -date, next(seq), sha,
+                  sha not in uninteresting ]
+        if entry[4]:
+            interesting += 1
+        queued[sha] = entry
+        heapq.heappush(queue, entry)
+
+    def mark(sha):
+        # Exclude sha, even if it was queued as interesting
+        nonlocal interesting
+        uninteresting.add(sha)
+        entry = queued.get(sha)
+        if entry and entry[4]:
+            entry[4] = False
+            interesting -= 1
+
+    for sha in exclude:
+        uninteresting.add(sha)
+    for sha in list(exclude) + list(include):
+        if sha not in info:
+            push(sha)
+
+    # Without generation numbers, date order can't tell
+    # whether a commit is excluded until the excluded side
+    # of the walk has gone past it: such walks are
+    # collected first, then filtered.
+    limited = bool(exclude) and not by_generation
+    collected = list()
+    slop = REV_WALK_SLOP
+
+    while queue:
+        if not interesting:
+            if not limited or not slop:
+                break
+            slop -= 1
+
+        entry = heapq.heappop(queue)
+        sha = entry[3]
+        del queued[sha]
+        if entry[4]:
+            interesting -= 1
+        parents, date, _ = info[sha]
+
+        if sha in uninteresting:
+            for p in parents:
+                mark(p)
+                if p not in info:
+                    push(p)
+            continue
+
+        if since is not None and date < since:
+            continue
+
+        for p in parents:
+            if p not in info:
+                push(p)
+
+        if limited:
+            collected.append((sha, parents))
+        else:
+            yield sha, parents
+
+    for sha, parents in collected:
+        if sha not in uninteresting:
+            yield sha, parents
+
+# Sort a finished walk so that no commit comes before its
+# children, newest first otherwise.  It needs the whole
+# walk, which is why rev_walk prefers generation numbers.
+def rev_walk_topo_sort(repo, walk):
+    commits = collections.OrderedDict(walk)
+
+    children = collections.Counter()
+    for parents in commits.values():
+        for p in parents:
+            if p in commits:
+                children[p] += 1
+
+    dates = dict()
+    ready = list()
+    seq = itertools.count()
+    for sha in commits:
+        if not children[sha]:
+            dates[sha] = commit_walk_info(repo, sha)[1]
+            heapq.heappush(ready, (-dates[sha], next(seq), sha))
+
+    while ready:
+        _, _, sha = heapq.heappop(ready)
+        yield sha, commits[sha]
+        for p in commits[sha]:
+            if p not in commits:
+                continue
+            children[p] -= 1
+            if not children[p]:
+                date = commit_walk_info(repo, p)[1]
+                heapq.heappush(ready, (-date, next(seq), p))
+
+# What merge_base paints commits with: the side they are
+# reachable from, and whether they are below a common
+# ancestor already found.
+MERGE_BASE_OURS = 1
+MERGE_BASE_THEIRS = 2
+MERGE_BASE_BOTH = MERGE_BASE_OURS | MERGE_BASE_THEIRS
+MERGE_BASE_STALE = 4
+
+# The best common ancestors of the commits a and b, those
+# that aren't ancestors of another one, as a list which is
+# empty for unrelated histories.
+#
+# Commits are painted with the sides they are reachable
+# from, going down from a and b through a priority queue:
+# by decreasing generation when the commit-graph has them,
+# so that no commit is taken before its descendants in the
+# walk, by decreasing date otherwise.  A commit painted from
+# both sides is a common ancestor, and its own ancestors are
+# painted stale.  The walk stops as soon as only stale
+# commits are queued: it never goes further down the history
+# than the merge bases, however long it is below them.
+def merge_base(repo, a, b):
+    if a == b:
+        return [ a ]
+
+    graph = commit_graph(repo)
+    by_generation = graph is not None and all(
+        graph.find(bytes.fromhex(sha)) is not None for sha in (a, b))
+
+    flags = dict()
+    queue = list()
+    seq = itertools.count()
+    bases = list()
+
+    # A commit can be queued again when it is reached with
+    # new colors: pending counts its entries, and active
+    # those of all the commits that aren't stale.
+    pending = collections.Counter()
+    active = 0
+
+    def paint(sha, color):
+        nonlocal active
+        old = flags.get(sha, 0)
+        if old & color == color:
+            return
+        flags[sha] = old | color
+        if color & MERGE_BASE_STALE and not old & MERGE_BASE_STALE:
+            active -= pending[sha]
+
+        parents, date, generation = commit_walk_info(repo, sha)
+        key = -generation if by_generation else -date
+        heapq.heappush(queue, (key, -date, next(seq), sha, parents))
+        pending[sha] += 1
+        if not color & MERGE_BASE_STALE:
+            active += 1
+
+    paint(a, MERGE_BASE_OURS)
+    paint(b, MERGE_BASE_THEIRS)
+
+    while active:
+        _, _, _, sha, parents = heapq.heappop(queue)
+        pending[sha] -= 1
+        color = flags[sha]
+        if not color & MERGE_BASE_STALE:
+            active -= 1
+
+        if color & (MERGE_BASE_BOTH | MERGE_BASE_STALE) \
+                == MERGE_BASE_BOTH:
+            bases.append(sha)
+            color |= MERGE_BASE_STALE
+            flags[sha] = color
+            active -= pending[sha]
+
+        for p in parents:
+            paint(p, color)
+
+    # With several bases, one may be an ancestor of another
+    # one (it was found first on a skewed date, or through a
+    # shorter path).
+    if len(bases) > 1:
+        bases = [ sha for sha in bases
+                  if not any(commit_is_ancestor(repo, sha, other)
+                             for other in bases if other != sha) ]
+    return bases
+
+# Whether the commit a is reachable from the commit b
+def commit_is_ancestor(repo, a, b):
+    return a == b or next(rev_walk(repo, [ a ], [ b ]), None) is None
+
+# Parse the argument of --since: a timestamp, a date as
+# YYYY-MM-DD with an optional HH:MM[:SS], or "N units ago".
+def rev_walk_parse_date(text):
+    text = text.strip()
+    if text.isdigit():
+        return int(text)
+
+    m = re.match(r"^(\d+)\s*(second|minute|hour|day|week|month|year)s?"
+                 r"(\s+ago)?$", text)
+    if m:
+        unit = { "second": 1, "minute": 60, "hour": 3600,
+                 "day": 86400, "week": 7 * 86400,
+                 "month": 30 * 86400, "year": 365 * 86400 }
+        return int(time.time()) - int(m.group(1)) * unit[m.group(2)]
+
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(time.strptime(text, fmt)))
+        except ValueError:
+            pass
+
+    raise Exception("Unknown date {0}".format(text))
 
 # }}
 
@@ -681,71 +3524,1009 @@ def kvlm_serialize(kvlm):
 def tree_parse_one(raw, start=0):
     # Find the space terminator of the mode
     x = raw.find(b' ', start)
-    assert(x-start == 5 or x-start==6)
-
-    # Read the mode
-    mode = raw[start:x]
 
-    # Find the NULL terminator of the path
+    # Find the NULL terminator of the path, the SHA is
+    # the 20 bytes after it.
     y = raw.find(b'\x00', x)
-    # and read the path
-    path = raw[x+1:y]
-
-    # Read the SHA and convert to an hex string
-    sha = hex(
-        int.from_bytes(raw[y+1:y+21], "big"))[2:] 
-        # hex() adds 0x in front, we don't want that.
 
-    return y+21, GitTreeLeaf(mode, path, sha)
+    return y+21, GitTreeLeaf(raw[start:x], raw[x+1:y],
+        raw[y+1:y+21])
 
-# Calls the previous parser in a loop for chained trees
+# The offsets of the entries of a tree, found by skipping
+# from NUL to NUL: the modes, names and SHAs are only read
+# when they are needed.
 def tree_parse(raw):
+    ret = array.array("I")
     pos = 0
-    max = len(raw)
-    ret = list()
-    while pos < max:
-        pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
+    end = len(raw)
+    find = raw.find
+    while pos < end:
+        ret.append(pos)
+        y = find(b'\x00', pos + 5)
+        if y < 0 or y + 21 > end:
+            raise Exception("Malformed tree")
+        pos = y + 21
 
     return ret
 
+# The name of the entry at pos as Git sorts it, with a
+# trailing slash for directories
+def tree_sort_key(raw, pos):
+    x = raw.find(b' ', pos)
+    y = raw.find(b'\x00', x)
+    if raw[pos] == ord('4'):
+        return raw[x+1:y] + b'/'
+    return raw[x+1:y]
+
 # Tree Serializer
-def tree_serialize(obj):
-    ret = b''
-    for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
+def tree_serialize(items):
+    return b''.join([ b''.join((i.mode, b' ', i.path, b'\x00',
+                                i.binsha))
+                      for i in items ])
+
+# }}
+
+# Tree Diff {{
+
+# The changes from the tree a to the tree b, as a stream of
+# GitTreeChange in Git's order.  Both trees are walked side
+# by side in their sorted order, and entries with the same
+# mode and SHA on both sides are skipped, subtrees
+# included: only the trees of directories that changed are
+# ever read.  Unless recursive, changed subtrees are
+# reported as such instead of being descended into.  a or b
+# may be None, for an empty tree.
+def tree_diff(repo, a, b, recursive=False, prefix=b''):
+    old = iter(object_read(repo, a).items) if a else iter(())
+    new = iter(object_read(repo, b).items) if b else iter(())
+
+    x = next(old, None)
+    y = next(new, None)
+    while x is not None or y is not None:
+        if y is None:
+            key = -1
+        elif x is None:
+            key = 1
+        else:
+            kx = tree_leaf_key(x)
+            ky = tree_leaf_key(y)
+            key = (kx > ky) - (kx < ky)
+
+        if key < 0:
+            yield from tree_diff_side(repo, x, "D", recursive,
+                prefix)
+            x = next(old, None)
+        elif key > 0:
+            yield from tree_diff_side(repo, y, "A", recursive,
+                prefix)
+            y = next(new, None)
+        else:
+            if x.binsha != y.binsha or x.mode != y.mode:
+                yield from tree_diff_pair(repo, x, y, recursive,
+                    prefix)
+            x = next(old, None)
+            y = next(new, None)
+
+# The name of a leaf as trees sort it
+def tree_leaf_key(leaf):
+    if leaf.mode.startswith(b'4'):
+        return leaf.path + b'/'
+    return leaf.path
+
+# A leaf only on one side, and everything under it
+def tree_diff_side(repo, leaf, status, recursive, prefix):
+    path = prefix + leaf.path
+    if recursive and tree_leaf_fmt(leaf.mode) == b'tree':
+        a, b = (leaf.sha, None) if status == "D" else (None, leaf.sha)
+        yield from tree_diff(repo, a, b, recursive, path + b'/')
+    elif status == "D":
+        yield GitTreeChange(status, path, leaf, None)
+    else:
+        yield GitTreeChange(status, path, None, leaf)
+
+# A leaf on both sides whose mode or SHA changed
+def tree_diff_pair(repo, old, new, recursive, prefix):
+    path = prefix + old.path
+    fmt = tree_leaf_fmt(old.mode)
+    if fmt == b'tree':
+        if recursive:
+            yield from tree_diff(repo, old.sha, new.sha, recursive,
+                path + b'/')
+        else:
+            yield GitTreeChange("M", path, old, new)
+    elif fmt != tree_leaf_fmt(new.mode) \
+            or (old.mode == b'120000') != (new.mode == b'120000'):
+        yield GitTreeChange("T", path, old, new)
+    else:
+        yield GitTreeChange("M", path, old, new)
+
+# }}
+
+# Tree Merge {{
+
+# Merge the changes from the tree base to the tree theirs
+# into the tree ours, and return the SHA of the result with
+# the list of GitMergeConflict.  Any of the trees may be
+# None, for an empty tree.
+#
+# Wherever two of the three sides have the same SHA the
+# merged tree is known without reading anything, so only the
+# directories changed on both sides are walked: merging
+# branches that each touch a few directories costs the same
+# whatever the size of the repository.  Only the trees and
+# blobs the merge creates are written.  Files changed on
+# both sides get their lines merged, with conflict markers
+# labelled with labels where they can't be; the other
+# conflicts keep our side, or the only side left.
+def tree_merge(repo, base, ours, theirs,
+               labels=(b'ours', b'theirs')):
+    conflicts = list()
+    sha = tree_merge_walk(repo, base, ours, theirs, b'', labels,
+        conflicts)
+    if sha is None:
+        sha = object_write(GitTree(repo))
+    return sha, conflicts
+
+# The merge of three trees, as the SHA of the written tree,
+# or None if it is empty
+def tree_merge_walk(repo, base, ours, theirs, prefix, labels,
+                    conflicts):
+    if ours == theirs or base == theirs:
+        return ours
+    if base == ours:
+        return theirs
+
+    sides = list()
+    for sha in (base, ours, theirs):
+        items = object_read(repo, sha).items if sha else ()
+        sides.append({ leaf.path: leaf for leaf in items })
+    b, o, t = sides
+
+    leaves = list()
+    for name in set(b) | set(o) | set(t):
+        x, y, z = b.get(name), o.get(name), t.get(name)
+        if tree_merge_same(y, z) or tree_merge_same(x, z):
+            leaf = y
+        elif tree_merge_same(x, y):
+            leaf = z
+        else:
+            leaf = tree_merge_leaf(repo, x, y, z, prefix + name,
+                labels, conflicts)
+        if leaf is not None:
+            leaves.append(leaf)
+
+    if not leaves:
+        return None
+    tree = GitTree(repo)
+    tree.items = sorted(leaves, key=tree_leaf_key)
+    return object_write(tree)
+
+def tree_merge_same(x, y):
+    if x is None or y is None:
+        return x is y
+    return x.binsha == y.binsha and x.mode == y.mode
+
+# Merge a path changed differently on both sides.  Returns
+# the leaf of the result, or None to leave the path out.
+def tree_merge_leaf(repo, base, ours, theirs, path, labels,
+                    conflicts):
+    name = (ours or theirs).path
+    fmt = [ tree_leaf_fmt(leaf.mode) if leaf else None
+            for leaf in (base, ours, theirs) ]
+
+    if fmt[1] == fmt[2] == b'tree':
+        sha = tree_merge_walk(repo,
+            base.sha if fmt[0] == b'tree' else None,
+            ours.sha, theirs.sha, path + b'/', labels, conflicts)
+        if sha is None:
+            return None
+        return GitTreeLeaf(b'40000', name, bytes.fromhex(sha))
+
+    if ours is None or theirs is None:
+        # Deleted on one side, changed on the other.  A file
+        # replaced by a directory, or the other way round,
+        # isn't a change of the deleted file.
+        left = ours or theirs
+        if tree_leaf_fmt(left.mode) != fmt[0]:
+            return left
+        conflicts.append(GitMergeConflict("modify/delete", path,
+            base, ours, theirs))
+        return left
+
+    if not (tree_merge_regular(ours) and tree_merge_regular(theirs)):
+        if fmt[1] != fmt[2] or ours.mode != theirs.mode:
+            kind = "type"
+        else:
+            kind = "add/add" if base is None else "content"
+        conflicts.append(GitMergeConflict(kind, path, base, ours,
+            theirs))
+        return ours
+
+    # Two versions of a regular file
+    if base is not None and tree_merge_regular(base):
+        old = object_read(repo, base.sha).blobdata
+    else:
+        old = b''
+    data, clean = merge_lines(old,
+        object_read(repo, ours.sha).blobdata,
+        object_read(repo, theirs.sha).blobdata, labels)
+
+    mode = ours.mode
+    if base is not None and base.mode == ours.mode:
+        mode = theirs.mode
+    elif base is not None and base.mode != theirs.mode \
+            and ours.mode != theirs.mode:
+        clean = False
+
+    if not clean:
+        conflicts.append(GitMergeConflict("add/add" if base is None
+            else "content", path, base, ours, theirs))
+    sha = object_write(GitBlob(repo, data))
+    return GitTreeLeaf(mode, name, bytes.fromhex(sha))
+
+# Whether the leaf is a file whose lines can be merged
+def tree_merge_regular(leaf):
+    return leaf.mode in (b'100644', b'100755')
+
+# Merge the changes from base to theirs into ours, line by
+# line.  Returns the merged data and whether it is free of
+# conflicts.  Binary files can't be merged: ours is kept.
+#
+# The regions of base that both sides kept unchanged are
+# found first, from the lines each side has in common with
+# base; what lies between two of them was changed on one
+# side, which wins, on both in the same way, or on both
+# differently, which is a conflict.
+def merge_lines(base, ours, theirs, labels=(b'ours', b'theirs')):
+    if b'\x00' in base or b'\x00' in ours or b'\x00' in theirs:
+        return ours, False
+
+    z, a, b = merge_split(base), merge_split(ours), merge_split(theirs)
+    out = list()
+    clean = True
+    iz = ia = ib = 0
+    for zs, ze, as_, ae, bs, be in merge_sync_regions(z, a, b):
+        x, y, w = z[iz:zs], a[ia:as_], b[ib:bs]
+        if y == w or x == w:
+            out.extend(y)
+        elif x == y:
+            out.extend(w)
+        else:
+            clean = False
+            # Lines both sides start or end with aren't part
+            # of the conflict
+            head = 0
+            while head < min(len(y), len(w)) and y[head] == w[head]:
+                head += 1
+            tail = 0
+            while tail < min(len(y), len(w)) - head \
+                    and y[-1 - tail] == w[-1 - tail]:
+                tail += 1
+            out.extend(y[:head])
+            out.append(b'<<<<<<< ' + labels[0] + b'\n')
+            out.extend(merge_terminate(y[head:len(y) - tail]))
+            out.append(b'=======\n')
+            out.extend(merge_terminate(w[head:len(w) - tail]))
+            out.append(b'>>>>>>> ' + labels[1] + b'\n')
+            out.extend(y[len(y) - tail:])
+        out.extend(z[zs:ze])
+        iz, ia, ib = ze, ae, be
+
+    return b''.join(out), clean
+
+# The lines of data, with their line feed
+def merge_split(data):
+    lines = data.split(b'\n')
+    ret = [ line + b'\n' for line in lines[:-1] ]
+    if lines[-1]:
+        ret.append(lines[-1])
+    return ret
+
+# The lines of a conflict, the last one ending with a line
+# feed so that the marker after it has a line of its own
+def merge_terminate(lines):
+    if lines and not lines[-1].endswith(b'\n'):
+        return lines[:-1] + [ lines[-1] + b'\n' ]
+    return lines
+
+# The regions of base unchanged on both sides, as (start,
+# end) in base, in a and in b, ending with an empty region
+# at the end of all three
+def merge_sync_regions(base, a, b):
+    am = merge_matching_blocks(base, a)
+    bm = merge_matching_blocks(base, b)
+
+    ret = list()
+    i = j = 0
+    while i < len(am) and j < len(bm):
+        abase, amatch, alen = am[i]
+        bbase, bmatch, blen = bm[j]
+        start = max(abase, bbase)
+        end = min(abase + alen, bbase + blen)
+        if start < end:
+            ret.append((start, end,
+                amatch + start - abase, amatch + end - abase,
+                bmatch + start - bbase, bmatch + end - bbase))
+        if abase + alen < bbase + blen:
+            i += 1
+        else:
+            j += 1
+
+    ret.append((len(base), len(base), len(a), len(a),
+                len(b), len(b)))
+    return ret
+
+# The lines base and other have in common, as difflib's
+# matching blocks.  Where lines were only added or only
+# removed, and the block could as well start further down,
+# as when it ends with a blank line like the one after it,
+# it is moved down as far as it goes, the way Git's diff
+# does, so that both sides of a merge agree on where their
+# changes are.
+def merge_matching_blocks(base, other):
+    blocks = [ [ 0, 0, 0 ] ] + [ list(m) for m in
+        difflib.SequenceMatcher(None, base, other,
+            autojunk=False).get_matching_blocks() ]
+
+    for prev, cur in zip(blocks, blocks[1:]):
+        gap_base = cur[0] - prev[0] - prev[2]
+        gap_other = cur[1] - prev[1] - prev[2]
+        if gap_base == 0 and gap_other > 0:
+            lines, start, end = other, prev[1] + prev[2], cur[1]
+        elif gap_other == 0 and gap_base > 0:
+            lines, start, end = base, prev[0] + prev[2], cur[0]
+        else:
+            continue
+
+        while cur[2] and lines[start] == lines[end]:
+            prev[2] += 1
+            cur[0] += 1
+            cur[1] += 1
+            cur[2] -= 1
+            start += 1
+            end += 1
+
+    return blocks
+
+# }}
+
+# Index File {{
+
+def index_parse(data):
+    sig, version, count = struct.unpack_from(">4sII", data, 0)
+    if sig != b'DIRC':
+        raise Exception("Bad index file signature")
+    if version not in (2, 3):
+        raise Exception(
+            "Unsupported index version {0}".format(version))
+    if hashlib.sha1(memoryview(data)[:-20]).digest() \
+            != data[-20:]:
+        raise Exception("Bad index file checksum")
+
+    # This loop runs once per file of the worktree: the
+    # flags are read a byte at a time, which is cheaper
+    # than a call to struct, and the stat data is left
+    # packed.
+    entries = [None] * count
+    pos = 12
+    for i in range(count):
+        flags = data[pos+60] << 8 | data[pos+61]
+        length = flags & 0xFFF
+        name = pos + 62
+
+        if flags & 0x4000:
+            if version < 3:
+                raise Exception("Extended flags in a v2 index")
+            flags |= (data[name] << 8 | data[name+1]) << 16
+            name += 2
+
+        # Long names are only known by their NUL terminator
+        if length == 0xFFF:
+            end = data.index(b'\x00', name)
+        else:
+            end = name + length
+
+        # The name length and the extended bit are implied
+        # by the entry itself.
+        entries[i] = GitIndexEntry(data[name:end],
+            data[pos:pos+60], flags & 0xFFFFB000)
+
+        # Entries are padded with 1 to 8 NULs to a multiple
+        # of 8 bytes.
+        pos += (end - pos + 8) & ~7
+
+    # Extensions with an uppercase signature are optional
+    # caches, which are safe to drop.
+    tree = None
+    while pos < len(data) - 20:
+        ext, size = struct.unpack_from(">4sI", data, pos)
+        if ext == b'TREE':
+            (_, tree), _ = index_parse_tree(data[pos+8:pos+8+size])
+        elif not b'A' <= ext[:1] <= b'Z':
+            raise Exception("Unsupported index extension {0}"
+                .format(ext.decode("ascii", "replace")))
+        pos += 8 + size
+
+    return GitIndex(version, entries, tree)
+
+def index_serialize(index):
+    version = index.version
+    if any(e.flags >> 16 for e in index.entries):
+        version = 3
+
+    short = struct.Struct(">H").pack
+    ret = [ struct.pack(">4sII", b'DIRC', version,
+        len(index.entries)) ]
+    for e in index.entries:
+        length = len(e.name)
+        flags = e.flags & 0xFFFF | min(length, 0xFFF)
+        ret.append(e.raw)
+        if e.flags >> 16:
+            ret.append(short(flags | 0x4000))
+            ret.append(short(e.flags >> 16))
+            length += 64
+        else:
+            ret.append(short(flags))
+            length += 62
+        ret.append(e.name)
+        ret.append(b'\x00' * (8 - length % 8))
+
+    if index.tree is not None:
+        tree = list()
+        index_serialize_tree(b'', index.tree, tree)
+        tree = b''.join(tree)
+        ret.append(struct.pack(">4sI", b'TREE', len(tree)))
+        ret.append(tree)
+
+    ret = b''.join(ret)
+    return ret + hashlib.sha1(ret).digest()
+
+# The TREE extension lists the cached trees depth first:
+# each one is its name, NUL, its number of entries (-1 if
+# invalid), a space, its number of subtrees, a newline and
+# the SHA, when valid.
+def index_parse_tree(data, pos=0):
+    end = data.index(b'\x00', pos)
+    name = data[pos:end]
+    eol = data.index(b'\n', end)
+    count, subtrees = data[end+1:eol].split(b' ')
+    tree = GitCacheTree(int(count))
+    pos = eol + 1
+    if tree.count >= 0:
+        tree.sha = data[pos:pos+20]
+        pos += 20
+
+    for i in range(int(subtrees)):
+        sub, pos = index_parse_tree(data, pos)
+        tree.subtrees[sub[0]] = sub[1]
+    return (name, tree), pos
+
+def index_serialize_tree(name, tree, ret):
+    ret.append(name + b'\x00' + "{0} {1}\n".format(tree.count,
+        len(tree.subtrees)).encode())
+    if tree.count >= 0:
+        ret.append(tree.sha)
+    # Git keeps subtrees by length, then name
+    for sub in sorted(tree.subtrees, key=lambda n: (len(n), n)):
+        index_serialize_tree(sub, tree.subtrees[sub], ret)
+
+# Read .git/index, an empty index if there is none yet
+def index_read(repo):
+    path = repo_file(repo, "index")
+    if not os.path.exists(path):
+        return GitIndex()
+
+    with open(path, "rb") as f:
+        return index_parse(f.read())
+
+# Write index to .git/index, through .git/index.lock as Git
+# does so that two commands never update it at once.
+def index_write(repo, index):
+    path = repo_file(repo, "index")
+    try:
+        fd = os.open(path + ".lock",
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        raise Exception("Unable to create '{0}.lock': "
+            "File exists.".format(path))
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(index_serialize(index))
+        os.rename(path + ".lock", path)
+    except:
+        os.unlink(path + ".lock")
+        raise
+
+# An index entry for the file at path, from its lstat
+def index_entry_stat(name, sha, path):
+    return GitIndexEntry(name, index_stat(os.lstat(path)) + sha)
+
+# Pack st as in an index entry.  Git keeps only the low 32
+# bits of each field.
+def index_stat(st):
+    if stat.S_ISLNK(st.st_mode):
+        mode = 0o120000
+    elif st.st_mode & stat.S_IXUSR:
+        mode = 0o100755
+    else:
+        mode = 0o100644
+
+    return INDEX_STAT.pack(
+        st.st_ctime_ns // 1000000000 & 0xFFFFFFFF,
+        st.st_ctime_ns % 1000000000,
+        st.st_mtime_ns // 1000000000 & 0xFFFFFFFF,
+        st.st_mtime_ns % 1000000000,
+        st.st_dev & 0xFFFFFFFF, st.st_ino & 0xFFFFFFFF, mode,
+        st.st_uid & 0xFFFFFFFF, st.st_gid & 0xFFFFFFFF,
+        st.st_size & 0xFFFFFFFF)
+
+# An entry is racily clean when its file changed in the
+# same tick the index was written: the change may not show
+# in the stat data, so its content has to be checked.  Git
+# also smudges entries, setting their size to 0, to have
+# them checked until their stat data is refreshed.
+#
+# stamp is the mtime of the index packed like the mtime of
+# entries, big endian seconds then nanoseconds, which
+# compare as bytes in the same order as numbers.
+EMPTY_BLOB = bytes.fromhex("e69de29bb2d1d6434b8b29ae775ad8c2e48c5391")
+
+def index_stamp(mtime_ns):
+    return struct.pack(">II", mtime_ns // 1000000000 & 0xFFFFFFFF,
+        mtime_ns % 1000000000)
+
+def index_entry_racy(e, stamp):
+    raw = e.raw
+    return raw[8:16] >= stamp \
+        or (raw[36:40] == b'\x00\x00\x00\x00'
+            and raw[40:] != EMPTY_BLOB)
+
+# The paths of the files under the tree sha, with their
+# mode and SHA as in the tree
+def tree_flatten(repo, sha):
+    ret = dict()
+    stack = [ (sha, b'') ]
+    while stack:
+        sha, prefix = stack.pop()
+        for item in object_read(repo, sha).items:
+            if tree_leaf_fmt(item.mode) == b'tree':
+                stack.append((item.sha, prefix + item.path + b'/'))
+            else:
+                ret[prefix + item.path] = (item.mode, item.sha)
+    return ret
+
+# The worktree paths of the files under paths, as index
+# names, skipping the .git directory.
+def index_worktree_paths(repo, paths):
+    worktree = os.path.realpath(repo.worktree)
+    for path in paths:
+        # Symbolic links are files, not what they point to
+        full = os.path.abspath(path)
+        full = os.path.join(
+            os.path.realpath(os.path.dirname(full)),
+            os.path.basename(full))
+        name = os.path.relpath(full, worktree)
+        if name == os.pardir or name.startswith(os.pardir + os.sep):
+            raise Exception("'{0}' is outside repository"
+                .format(path))
+
+        if os.path.isdir(full) and not os.path.islink(full):
+            for root, dirs, files in os.walk(full):
+                links = [ d for d in dirs
+                          if os.path.islink(os.path.join(root, d)) ]
+                dirs[:] = sorted(d for d in dirs
+                                 if d != ".git" and d not in links)
+                for f in sorted(files + links):
+                    yield index_name(worktree,
+                        os.path.join(root, f))
+        elif os.path.lexists(full):
+            yield index_name(worktree, full)
+        else:
+            raise Exception("pathspec '{0}' did not match any "
+                "files".format(path))
+
+def index_name(worktree, path):
+    return os.fsencode(os.path.relpath(path, worktree)
+        .replace(os.sep, "/"))
+
+# Merge the sorted new entries into index, replacing any
+# entry of the same name whatever its stage.
+def index_update(index, entries):
+    names = set(e.name for e in entries)
+    old = [ e for e in index.entries if e.name not in names ]
+
+    key = lambda e: (e.name, e.flag_stage)
+    index.entries = list(heapq.merge(old, entries, key=key))
+
+    for name in names:
+        index_invalidate_tree(index, name)
+
+# The changes from the tree sha to the index, as a dict
+# from names to A, M or D.  Directories whose cached tree
+# is valid and equal to their tree in sha have no change,
+# and are skipped without reading either side.
+def index_diff_tree(repo, index, sha):
+    ret = dict()
+    index_diff_tree_walk(repo, index.entries, 0, b'', index.tree,
+        bytes.fromhex(sha) if sha else None, ret)
     return ret
 
+def index_diff_tree_walk(repo, entries, pos, prefix, tree, sha,
+                         ret):
+    if tree is not None and tree.count >= 0 and tree.sha == sha:
+        return pos + tree.count
+
+    old = dict()
+    if sha is not None:
+        for item in object_read(repo, sha.hex()).items:
+            old[item.path] = item
+
+    i = pos
+    while i < len(entries) and entries[i].name.startswith(prefix):
+        e = entries[i]
+        name = e.name[len(prefix):]
+        slash = name.find(b'/')
+
+        if slash >= 0:
+            name = name[:slash]
+            item = old.pop(name, None)
+            sub = None
+            if item is not None:
+                if tree_leaf_fmt(item.mode) == b'tree':
+                    sub = item.binsha
+                else:
+                    # A file became a directory
+                    ret[prefix + name] = "D"
+            i = index_diff_tree_walk(repo, entries, i,
+                prefix + name + b'/',
+                tree.subtrees.get(name) if tree else None,
+                sub, ret)
+            continue
+
+        item = old.pop(name, None)
+        if e.flag_stage:
+            ret[e.name] = "U"
+        elif e.flag_intent_to_add:
+            pass
+        elif item is None or tree_leaf_fmt(item.mode) == b'tree':
+            ret[e.name] = "A"
+        elif item.binsha != e.sha or \
+                item.mode.rjust(6, b'0') != e.mode:
+            ret[e.name] = "M"
+        i += 1
+
+    for name, item in old.items():
+        if tree_leaf_fmt(item.mode) == b'tree':
+            for path in tree_flatten(repo, item.sha):
+                ret.setdefault(prefix + name + b'/' + path, "D")
+        else:
+            ret.setdefault(prefix + name, "D")
+
+    return i
+
+# Mark the cached trees of the directories of name stale
+def index_invalidate_tree(index, name):
+    tree = index.tree
+    parts = name.split(b'/')[:-1]
+    while tree is not None:
+        tree.count = -1
+        if not parts:
+            break
+        tree = tree.subtrees.get(parts.pop(0))
+
+# Write the tree objects of the index and return the SHA of
+# the root.  Directories whose cached tree is still valid
+# are skipped whole; the others are serialized again and
+# cached.
+def index_write_tree(repo, index):
+    if index.tree is None:
+        index.tree = GitCacheTree()
+    index_update_tree(repo, index.tree, index.entries, 0, b'')
+    return index.tree.sha.hex()
+
+# Bring tree, the cached tree of the directory prefix whose
+# entries start at pos, up to date.  Returns the position
+# of the first entry after the directory.
+def index_update_tree(repo, tree, entries, pos, prefix):
+    if tree.count >= 0:
+        return pos + tree.count
+
+    items = list()
+    seen = set()
+    complete = True
+    i = pos
+    while i < len(entries) and entries[i].name.startswith(prefix):
+        e = entries[i]
+        name = e.name[len(prefix):]
+        slash = name.find(b'/')
+
+        if slash >= 0:
+            name = name[:slash]
+            sub = tree.subtrees.get(name)
+            if sub is None:
+                sub = tree.subtrees[name] = GitCacheTree()
+            seen.add(name)
+            i = index_update_tree(repo, sub, entries, i,
+                prefix + name + b'/')
+            complete = complete and sub.count >= 0
+            # Git leaves out directories with nothing to add
+            if sub.sha != EMPTY_TREE:
+                items.append(GitTreeLeaf(b'40000', name, sub.sha))
+            continue
+
+        if e.flag_stage:
+            raise Exception("{0}: unmerged entry".format(
+                e.name.decode()))
+
+        # Files added with add -N only exist in the index,
+        # and the trees that would hold them aren't cached.
+        if e.flag_intent_to_add:
+            complete = False
+        else:
+            items.append(GitTreeLeaf(e.mode, name, e.sha))
+        i += 1
+
+    for name in list(tree.subtrees):
+        if name not in seen:
+            del tree.subtrees[name]
+
+    obj = GitTree(repo)
+    obj.items = items
+    tree.sha = bytes.fromhex(object_write(obj))
+    tree.count = i - pos if complete else -1
+    return i
+
+EMPTY_TREE = bytes.fromhex("4b825dc642cb6eb9a060e54bf8d69288fbee4904")
+
 # }}
 
 # For Resolving References {{
 
+# Every ref of a repository, loaded at once from
+# .git/packed-refs and the loose files under .git/refs, so
+# that resolving names doesn't touch the filesystem.  Loose
+# refs win over packed ones, as in Git.
+class GitRefs(object):
+    refs = None
+    """Full ref name => SHA, sorted by name"""
+    symbolic = None
+    """Full ref name => the ref it points to, for symbolic refs"""
+    peeled = None
+    """SHA of an annotated tag => SHA of the object it tags,
+    from the ^ lines of packed-refs"""
+    packed = None
+    """Full ref name => SHA, for the refs of packed-refs"""
+
+    def __init__(self, repo):
+        self.packed = packed_refs_read(repo, self)
+
+        refs = dict(self.packed)
+        self.symbolic = dict()
+
+        # Loose refs, walked with an explicit stack.  Like
+        # Git, the locks of refs being written, or left by a
+        # crash, are no refs.
+        stack = [ ("refs", repo_path(repo, "refs")) ]
+        while stack:
+            name, path = stack.pop()
+            try:
+                entries = list(os.scandir(path))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.name.endswith(".lock"):
+                    continue
+                full = name + "/" + entry.name
+                if entry.is_dir():
+                    stack.append((full, entry.path))
+                    continue
+                with open(entry.path, "r") as fp:
+                    data = fp.read().strip()
+                if data.startswith("ref: "):
+                    self.symbolic[full] = data[5:]
+                else:
+                    refs[full] = data
+
+        # Symbolic refs pointing to refs we know
+        for name, target in self.symbolic.items():
+            for _ in range(10):
+                if target not in self.symbolic:
+                    break
+                target = self.symbolic[target]
+            if target in refs:
+                refs[name] = refs[target]
+
+        self.refs = collections.OrderedDict(sorted(refs.items()))
+
+# Parse .git/packed-refs into a dict of full ref name =>
+# SHA.  The peeled SHAs of annotated tags go into
+# snapshot.peeled.
+def packed_refs_read(repo, snapshot):
+    ret = dict()
+    snapshot.peeled = dict()
+
+    try:
+        f = open(repo_path(repo, "packed-refs"), "r")
+    except FileNotFoundError:
+        return ret
+
+    with f:
+        last = None
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("^"):
+                # Peeled value of the tag on the line before
+                if last:
+                    snapshot.peeled[last] = line[1:]
+                continue
+            sha, name = line.split(" ", 1)
+            ret[name] = sha
+            last = sha
+
+    return ret
+
+# The ref snapshot of repo, loaded on first use.  Functions
+# writing refs call ref_invalidate.
+def ref_snapshot(repo):
+    if repo.refs is None:
+        repo.refs = GitRefs(repo)
+    return repo.refs
+
+def ref_invalidate(repo):
+    repo.refs = None
+
 def ref_resolve(repo, ref):
-    with open(repo_file(repo, ref), 'r') as fp:
-        data = fp.read()[:-1]
-        # Drop final \n ^^^^^
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
-    else:
-        return data
+    # Resolve ref (HEAD or a full ref name) to a SHA,
+    # following symbolic refs.  Returns None for refs that
+    # don't exist, like the branch of a new repository.
+    snapshot = ref_snapshot(repo)
+
+    for _ in range(10):
+        if ref in snapshot.refs:
+            return snapshot.refs[ref]
+        if ref in snapshot.symbolic:
+            ref = snapshot.symbolic[ref]
+            continue
+        if ref.startswith("refs/"):
+            return None
 
-def ref_list(repo, path=None):
-    if not path:
-        path = repo_dir(repo, "refs")
-    ret = collections.OrderedDict()
-    # Git shows refs sorted.  To do the same, we use
-    # an OrderedDict and sort the output of listdir
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
+        # HEAD and the like live outside of refs/, and
+        # change too often to be kept in the snapshot.
+        try:
+            with open(repo_path(repo, ref), 'r') as fp:
+                data = fp.read().strip()
+        except FileNotFoundError:
+            return None
+        if data.startswith("ref: "):
+            ref = data[5:]
         else:
-            ret[f] = ref_resolve(repo, can)
+            return data
+
+    raise Exception("Symbolic ref loop at {0}".format(ref))
+
+# The ref HEAD points to, or HEAD itself when detached
+def ref_head(repo):
+    with open(repo_path(repo, "HEAD"), 'r') as fp:
+        data = fp.read().strip()
+    if data.startswith("ref: "):
+        return data[5:]
+    return "HEAD"
+
+# The branch name of HEAD for messages
+def ref_head_name(repo):
+    ref = ref_head(repo)
+    if ref.startswith("refs/heads/"):
+        return ref[11:]
+    return "detached HEAD"
+
+# Point HEAD, or the branch it is on, at sha
+def ref_update_head(repo, sha):
+    ref_create(repo, ref_head(repo), sha)
+
+# Resolve a short ref name the way Git does, trying the
+# prefixes below in order.  Returns None if nothing matches.
+ref_dwim_rules = [ "{0}", "refs/{0}", "refs/tags/{0}",
+    "refs/heads/{0}", "refs/remotes/{0}", "refs/remotes/{0}/HEAD" ]
+
+def ref_dwim(repo, name):
+    snapshot = ref_snapshot(repo)
+    for rule in ref_dwim_rules:
+        full = rule.format(name)
+        if full in snapshot.refs:
+            return snapshot.refs[full]
+    return None
+
+def ref_list(repo):
+    # The refs under refs/, as nested OrderedDicts by path
+    # component, the leaves being SHAs.
+    ret = collections.OrderedDict()
+    for name, sha in ref_snapshot(repo).refs.items():
+        parts = name.split("/")[1:]
+        node = ret
+        for part in parts[:-1]:
+            node = node.setdefault(part, collections.OrderedDict())
+        node[parts[-1]] = sha
+
+    return ret
+
+# Point ref (a full ref name) at sha
+def ref_create(repo, ref, sha):
+    path = repo_file(repo, *ref.split("/"), mkdir=True)
+    with open(path + ".lock", "w") as fp:
+        fp.write(sha + "\n")
+    os.rename(path + ".lock", path)
+    ref_invalidate(repo)
+
+# Write every ref under refs/tags, plus the ones already
+# packed (or all of them with all_refs), into packed-refs
+# with the peeled SHAs of annotated tags.  Unless prune is
+# false, the loose files of the packed refs are removed.
+# Returns the number of refs packed.
+def pack_refs(repo, all_refs=False, prune=True):
+    snapshot = ref_snapshot(repo)
+
+    packed = collections.OrderedDict()
+    for name, sha in snapshot.refs.items():
+        if name in snapshot.symbolic:
+            continue
+        if all_refs or name.startswith("refs/tags/") \
+                or name in snapshot.packed:
+            packed[name] = sha
+
+    lines = [ "# pack-refs with: peeled fully-peeled sorted \n" ]
+    for name, sha in packed.items():
+        lines.append("{0} {1}\n".format(sha, name))
+
+        # Fully peel annotated tags
+        peeled = sha
+        while object_header(repo, peeled)[0] == b'tag':
+            peeled = object_read(repo, peeled).kvlm[b'object'] \
+                .decode("ascii")
+        if peeled != sha:
+            lines.append("^{0}\n".format(peeled))
+
+    path = repo_path(repo, "packed-refs")
+    with open(path + ".lock", "w") as fp:
+        fp.write("".join(lines))
+    os.rename(path + ".lock", path)
+
+    if prune:
+        for name, sha in packed.items():
+            loose = repo_path(repo, *name.split("/"))
+            try:
+                with open(loose, "r") as fp:
+                    data = fp.read().strip()
+            except FileNotFoundError:
+                continue
+            # Leave refs that changed meanwhile alone
+            if data != sha:
+                continue
+            os.unlink(loose)
+
+            # Remove the directories left empty, but keep
+            # refs/heads and refs/tags.
+            parts = name.split("/")[:-1]
+            while len(parts) > 2:
+                try:
+                    os.rmdir(repo_path(repo, *parts))
+                except OSError:
+                    break
+                parts.pop()
+
+    ref_invalidate(repo)
+    return len(packed)
+
+# The SHAs the refs and HEAD point to, the starting points
+# of everything reachable.
+def ref_list_shas(repo):
+    ret = list(ref_snapshot(repo).refs.values())
+
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        ret.append(head)
 
     return ret
 
@@ -757,12 +4538,352 @@ def cmd_tag(args):
     repo = repo_find()
 
     if args.name:
-        tag_create(args.name,
-            args.object,
-            type="object" if args.create_tag_object else "ref")
+        tag_create(repo, args.name, args.object,
+            create_tag_object=args.create_tag_object,
+            message=args.message)
     else:
         refs = ref_list(repo)
-        show_ref(repo, refs["tags"], with_hash=False)
+        show_ref(repo, refs.get("tags", {}), with_hash=False)
+
+# Create the tag name for the object named ref, as a
+# lightweight tag, or as an annotated tag object if
+# create_tag_object is set.
+def tag_create(repo, name, ref, create_tag_object=False,
+               message=None):
+    sha = object_find(repo, ref)
+
+    if create_tag_object:
+        tag = GitTag(repo)
+        tag.kvlm = collections.OrderedDict()
+        tag.kvlm[b'object'] = sha.encode()
+        tag.kvlm[b'type'] = object_header(repo, sha)[0]
+        tag.kvlm[b'tag'] = name.encode()
+        tag.kvlm[b'tagger'] = repo_identity(repo, "COMMITTER")
+        tag.kvlm[b''] = (message or name).encode() + b'\n'
+        sha = object_write(tag)
+
+    ref_create(repo, "refs/tags/" + name, sha)
+
+# "Name <email> timestamp timezone" for commits and tags,
+# from the environment or the [user] section of the
+# configuration, as Git does.  who is AUTHOR or COMMITTER.
+def repo_identity(repo, who):
+    conf = configparser.ConfigParser()
+    conf.read([ os.path.expanduser("~/.gitconfig"),
+                repo_path(repo, "config") ])
+
+    name = os.environ.get("GIT_{0}_NAME".format(who)) \
+        or conf.get("user", "name", fallback=None)
+    email = os.environ.get("GIT_{0}_EMAIL".format(who)) \
+        or conf.get("user", "email", fallback=None)
+    if not name or not email:
+        raise Exception("Please set user.name and user.email")
+
+    now = int(time.time())
+    offset = time.localtime(now).tm_gmtoff // 60
+    tz = "{0}{1:02}{2:02}".format("+" if offset >= 0 else "-",
+        abs(offset) // 60, abs(offset) % 60)
+
+    return "{0} <{1}> {2} {3}".format(name, email, now, tz) \
+        .encode("utf8")
+
+# }}
+
+# Performance Tracing {{
+
+# Tracing counts the calls of the functions of PERF_WRAPPED,
+# the directory scans and the work of zlib, and times them.
+# It is off unless asked for with --trace-perf or the
+# PVC_TRACE_PERF variable, and costs nothing then: the
+# functions are only wrapped when it is turned on, and the
+# zlib calls go through perf_compress and perf_decompress,
+# which only check that perf is set.
+perf = None
+"""The GitPerf of the run, None when tracing is off"""
+
+# The functions wrapped by perf_enable, with what to count
+# from their arguments and result besides calls and time
+PERF_WRAPPED = collections.OrderedDict([
+    ("object_read", None),
+    ("object_read_raw", lambda args, ret: { "inflated": len(ret[1]) }),
+    ("object_read_loose", None),
+    ("object_stream", lambda args, ret: { "inflated": ret[1] }),
+    ("object_header", None),
+    ("object_write", None),
+    ("object_hash_file", None),
+    ("object_resolve", None),
+    ("ref_resolve", None),
+    ("packed_refs_read", None),
+    ("kvlm_parse", lambda args, ret: { "bytes": len(args[0]) }),
+    ("tree_parse", lambda args, ret: { "bytes": len(args[0]) }),
+    ("index_parse", lambda args, ret: { "bytes": len(args[0]) }),
+])
+
+class GitPerf(object):
+    __slots__ = {
+        "start": "When tracing started, from time.perf_counter",
+        "stats": "Names to their calls, seconds and byte counts",
+        "events": "The Chrome trace events, None unless wanted",
+        "lock": "For the threads of parallel checkouts",
+    }
+
+    def __init__(self, events=False):
+        self.start = time.perf_counter()
+        self.stats = dict()
+        self.events = list() if events else None
+        self.lock = threading.Lock()
+
+    def add(self, name, start, **amounts):
+        # Record a call of name that started at start, and
+        # the bytes it handled
+        end = time.perf_counter()
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = collections.Counter()
+            stat["calls"] += 1
+            stat["seconds"] += end - start
+            stat.update(amounts)
+
+            if self.events is not None:
+                self.events.append({ "name": name, "cat": "pvc",
+                    "ph": "X", "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "ts": (start - self.start) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "args": amounts })
+
+# Turn tracing on, with the events of a Chrome trace if
+# events is set
+def perf_enable(events=False):
+    global perf
+    perf = GitPerf(events)
+
+    module = globals()
+    for name, measure in PERF_WRAPPED.items():
+        perf_originals[name] = module[name]
+        module[name] = perf_wrap(name, module[name], measure)
+    perf_originals["GitPack.read"] = GitPack.read
+    GitPack.read = perf_wrap("GitPack.read", GitPack.read)
+
+    # Directory scans are made through os directly
+    perf_originals["os.listdir"] = os.listdir
+    perf_originals["os.scandir"] = os.scandir
+    os.listdir = perf_wrap("os.listdir", os.listdir,
+        lambda args, ret: { "entries": len(ret) })
+    os.scandir = perf_wrap("os.scandir", os.scandir)
+
+# The functions perf_enable replaced, by name
+perf_originals = dict()
+
+# Turn tracing off, putting the functions back
+def perf_disable():
+    global perf
+    perf = None
+
+    module = globals()
+    for name, fn in perf_originals.items():
+        if name == "GitPack.read":
+            GitPack.read = fn
+        elif name.startswith("os."):
+            setattr(os, name[3:], fn)
+        else:
+            module[name] = fn
+    perf_originals.clear()
+
+def perf_wrap(name, fn, measure=None):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        ret = fn(*args, **kwargs)
+        perf.add(name, start, **(measure(args, ret) if measure else {}))
+        return ret
+    return wrapper
+
+# compress(data), or compress() if data is None, counted as
+# work of zlib.  compress is zlib.compress, or the compress
+# or flush method of a compressobj.
+def perf_compress(compress, data=None):
+    if perf is None:
+        return compress() if data is None else compress(data)
+
+    start = time.perf_counter()
+    ret = compress() if data is None else compress(data)
+    perf.add("zlib.compress", start, compressed=len(ret),
+        inflated=0 if data is None else len(data))
+    return ret
+
+# d.decompress(data, max_length), or zlib.decompress(data) if
+# d is None, counted as work of zlib.  The compressed bytes
+# are those d consumed, not what it left for later calls or
+# found after the end of the stream.
+def perf_decompress(d, data, max_length=0):
+    if perf is None:
+        if d is None:
+            return zlib.decompress(data)
+        return d.decompress(data, max_length)
+
+    start = time.perf_counter()
+    if d is None:
+        ret = zlib.decompress(data)
+        used = len(data)
+    else:
+        ret = d.decompress(data, max_length)
+        used = len(data) - len(d.unconsumed_tail) \
+            - len(d.unused_data)
+    perf.add("zlib.decompress", start, compressed=used,
+        inflated=len(ret))
+    return ret
+
+# Write what tracing recorded to path, or to the standard
+# error for "-": a summary of the counters as JSON, or with
+# chrome a trace for chrome://tracing and Perfetto which
+# has the summary too.
+def perf_write(path, chrome=False, argv=()):
+    summary = { "argv": list(argv),
+                "seconds": time.perf_counter() - perf.start,
+                "stats": { name: dict(stat) for name, stat
+                           in sorted(perf.stats.items()) } }
+    if chrome:
+        summary = { "traceEvents": perf.events,
+                    "displayTimeUnit": "ms",
+                    "otherData": summary }
+
+    if path == "-":
+        json.dump(summary, sys.stderr, indent=1)
+        sys.stderr.write("\n")
+    else:
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=1)
+            f.write("\n")
+
+# }}
+
+# Async Repository {{
+
+# How many tree entries a walk yields before letting the
+# event loop run other tasks, and how many commits a history
+# walk reads per job
+ASYNC_WALK_YIELD = 256
+ASYNC_HISTORY_BATCH = 64
+
+# An asyncio facade over a repository, for services that
+# embed pvc: reads, writes and walks run on a bounded pool of
+# threads, so the event loop never waits on the disk or on
+# zlib.
+#
+# Concurrent reads of the same object share a single read.
+# At most max_pending jobs are queued or running at a time,
+# and callers past that wait their turn: a producer can't
+# queue more work than the pool gets through.  Walks are
+# made of many small jobs, one per tree or batch of commits,
+# rather than of one big one, so that a large walk never
+# holds the pool or the loop for long and other requests are
+# served in between.
+#
+# Parsed objects are cached on the event loop's thread,
+# GitObjectCache not being thread-safe: the repository the
+# threads use has no cache of its own.  As with that cache,
+# the objects returned are shared and must not be modified.
+class AsyncRepository(object):
+    repo = None
+    """The GitRepository the threads work on"""
+    cache = None
+    """Parsed objects, only used from the event loop"""
+    executor = None
+    """The pool of threads the blocking work runs on"""
+    pending = None
+    """Semaphore bounding the jobs queued or running"""
+    reads = None
+    """SHA => the task of its read in flight"""
+
+    def __init__(self, path=".", workers=4, max_pending=64,
+                 cache_bytes=64 * 1024 * 1024):
+        self.repo = repo_find(path)
+        self.cache = GitObjectCache(cache_bytes) if cache_bytes else None
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.reads = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def run(self, fn, *args):
+        # Run fn(*args) on the pool once there's room
+        async with self.pending:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, fn, *args)
+
+    async def read_object(self, sha):
+        if self.cache is not None:
+            obj = self.cache.get(sha)
+            if obj is not None:
+                return obj
+
+        task = self.reads.get(sha)
+        if task is None:
+            task = asyncio.ensure_future(self.read_uncached(sha))
+            self.reads[sha] = task
+            task.add_done_callback(lambda _: self.reads.pop(sha, None))
+
+        # A caller giving up mustn't cancel the read for the
+        # others waiting on it
+        return await asyncio.shield(task)
+
+    async def read_uncached(self, sha):
+        obj = await self.run(object_read, self.repo, sha)
+        if self.cache is not None:
+            self.cache.put(sha, obj, len(obj.serialize()))
+        return obj
+
+    async def write_object(self, obj):
+        # Write obj, a GitObject of any repository, here and
+        # return its SHA.  obj itself is left alone: what is
+        # written is a copy of it belonging to this repository.
+        copy = object_class(obj.fmt)(self.repo, obj.serialize())
+        return await self.run(object_write, copy)
+
+    async def resolve(self, name, fmt=None):
+        return await self.run(object_find, self.repo, name, fmt)
+
+    async def walk_tree(self, sha, recursive=True, prefix=b''):
+        # Yield the (path, GitTreeLeaf) of the tree sha, or of
+        # the tree of the commit sha, in the order of ls-tree
+        obj = await self.read_object(sha)
+        if obj.fmt == b'commit':
+            obj = await self.read_object(
+                obj.kvlm[b'tree'].decode("ascii"))
+
+        for n, leaf in enumerate(obj.items, 1):
+            path = prefix + leaf.path
+            if recursive and tree_leaf_fmt(leaf.mode) == b'tree':
+                async for entry in self.walk_tree(leaf.sha, True,
+                                                  path + b'/'):
+                    yield entry
+            else:
+                yield path, leaf
+            if n % ASYNC_WALK_YIELD == 0:
+                await asyncio.sleep(0)
+
+    async def walk_history(self, include, exclude=(), order="date",
+                           max_count=None, since=None):
+        # Yield (sha, parents) like rev_walk, which runs on the
+        # pool a batch of commits at a time
+        walk = rev_walk(self.repo, include, exclude, order,
+            max_count, since)
+        batch = lambda: list(itertools.islice(walk,
+            ASYNC_HISTORY_BATCH))
+        while True:
+            entries = await self.run(batch)
+            if not entries:
+                return
+            for entry in entries:
+                yield entry
 
 # }}
 
@@ -777,15 +4898,785 @@ def cmd_init(args):
 
 # }}
 
+# Add {{
+
+# Files bigger than this are worth sending to the pool of
+# hashing processes, smaller ones are faster to hash here
+# than to ship around.
+ADD_PARALLEL_MIN = 1024
+
+def cmd_add(args):
+    repo = repo_find()
+    index = index_read(repo)
+
+    names = sorted(set(index_worktree_paths(repo, args.path)))
+    jobs = args.jobs or os.cpu_count() or 1
+    index_update(index, index_add(repo, names, jobs))
+    index_write(repo, index)
+
+# Write the blobs of the files names and return their
+# entries.  The blobs are written in one batch, spread over
+# jobs processes when there are enough of them, and the
+# files are stat'ed before they are read so that a change
+# while we hash them shows in the index.
+def index_add(repo, names, jobs=1):
+    paths = [ os.path.join(repo.worktree, os.fsdecode(name))
+              for name in names ]
+    entries = [ index_entry_stat(name, bytes(20), path)
+                for name, path in zip(names, paths) ]
+
+    files = list()
+    for e, path in zip(entries, paths):
+        if e.mode_type == 0b1010:
+            # A symbolic link is stored as its target
+            blob = GitBlob(repo, os.fsencode(os.readlink(path)))
+            e.sha = bytes.fromhex(object_write(blob))
+        else:
+            files.append((e, path))
+
+    if len(files) < ADD_PARALLEL_MIN:
+        jobs = 1
+    shas = hash_object_paths([ path for _, path in files ],
+        b'blob', repo, jobs)
+    for (e, _), sha in zip(files, shas):
+        e.sha = bytes.fromhex(sha)
+
+    return entries
+
+# }}
+
+# Rm {{
+
+def cmd_rm(args):
+    repo = repo_find()
+    index = index_read(repo)
+    worktree = os.path.realpath(repo.worktree)
+
+    # Names are matched against the index, since removed
+    # files need not exist anymore.
+    names = set()
+    dirs = set()
+    for path in args.path:
+        full = os.path.abspath(path)
+        name = index_name(worktree, os.path.join(
+            os.path.realpath(os.path.dirname(full)),
+            os.path.basename(full)))
+        if name.startswith(b'../') or name == b'..':
+            raise Exception("'{0}' is outside repository"
+                .format(path))
+        if name == b'.':
+            name = b''
+        names.add(name)
+        if name:
+            dirs.add(name + b'/')
+        else:
+            dirs.add(b'')
+
+    removed = list()
+    matched = set()
+    for e in index.entries:
+        if e.name in names:
+            matched.add(e.name)
+            removed.append(e)
+            continue
+        for d in dirs:
+            if e.name.startswith(d):
+                if not args.recursive:
+                    raise Exception("not removing '{0}' "
+                        "recursively without -r".format(
+                            d.rstrip(b'/').decode() or "."))
+                matched.add(d[:-1])
+                removed.append(e)
+                break
+
+    for name in names - matched:
+        raise Exception("pathspec '{0}' did not match any files"
+            .format(name.decode()))
+
+    if not args.cached and not args.force:
+        for e in removed:
+            if index_entry_modified(repo, e):
+                raise Exception("'{0}' has local modifications "
+                    "(use --cached to keep the file, or -f to "
+                    "force removal)".format(e.name.decode()))
+
+    gone = set(id(e) for e in removed)
+    index.entries = [ e for e in index.entries
+                      if id(e) not in gone ]
+    for e in removed:
+        index_invalidate_tree(index, e.name)
+    index_write(repo, index)
+
+    for e in removed:
+        print("rm '{0}'".format(e.name.decode()))
+        if args.cached:
+            continue
+
+        path = os.path.join(repo.worktree, os.fsdecode(e.name))
+        if os.path.lexists(path):
+            os.unlink(path)
+
+        # Like Git, don't leave empty directories behind
+        parent = os.path.dirname(path)
+        while os.path.realpath(parent) != worktree:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+# Whether the worktree file of e differs from its entry
+def index_entry_modified(repo, e):
+    path = os.path.join(repo.worktree, os.fsdecode(e.name))
+    if not os.path.lexists(path):
+        return False
+    if os.path.islink(path):
+        sha = object_write(GitBlob(None,
+            os.fsencode(os.readlink(path))), False)
+    else:
+        sha = object_hash_file(path, b'blob', None)
+    return sha != e.obj
+
+# }}
+
+# Bench {{
+
+def cmd_bench(args):
+    if args.suite == "kvlm":
+        bench_kvlm(repo_find(), args.rounds)
+    elif args.suite == "commands":
+        bench_commands(args)
+    elif args.suite == "fast-import":
+        bench_fast_import(args)
+
+# The best time of rounds runs of fn
+def bench_time(fn, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# Parse and serialize every commit and tag reachable from
+# the refs, checking that they round-trip byte for byte.
+def bench_kvlm(repo, rounds):
+    corpus = list()
+    seen = set()
+    stack = ref_list_shas(repo)
+    while stack:
+        sha = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        fmt, data = object_read_raw(repo, sha)
+        if fmt == b'commit':
+            corpus.append(data)
+            stack.extend(commit_kvlm_parents(kvlm_parse(data)))
+        elif fmt == b'tag':
+            corpus.append(data)
+            stack.append(kvlm_parse(data)[b'object'].decode("ascii"))
+
+    if not corpus:
+        raise Exception("No commits to parse")
+
+    for data in corpus:
+        kvlm = kvlm_parse(data)
+        if kvlm_serialize(kvlm) != data:
+            raise Exception("Round trip changed an object")
+        # Forces serializing from the parsed values
+        kvlm.modified = True
+        for key in kvlm:
+            kvlm[key]
+        if kvlm_serialize(kvlm) != data:
+            raise Exception("Re-serializing changed an object")
+
+    def parse():
+        for data in corpus:
+            kvlm_parse(data)
+
+    def walk():
+        # What history walks read
+        for data in corpus:
+            kvlm = kvlm_parse(data)
+            if b'tree' in kvlm:
+                kvlm[b'tree']
+                commit_kvlm_parents(kvlm)
+                commit_kvlm_date(kvlm)
+
+    def full():
+        for data in corpus:
+            kvlm_parse(data).items()
+
+    parsed = list()
+    for data in corpus:
+        kvlm = kvlm_parse(data)
+        kvlm.items()
+        kvlm.modified = True
+        parsed.append(kvlm)
+
+    def serialize():
+        for kvlm in parsed:
+            kvlm_serialize(kvlm)
+
+    size = sum(len(data) for data in corpus)
+    print("{0} objects, {1} bytes, best of {2}".format(
+        len(corpus), size, rounds))
+    for name, fn in (("parse", parse),
+                     ("parse + tree, parents, date", walk),
+                     ("parse + every field", full),
+                     ("serialize", serialize)):
+        elapsed = bench_time(fn, rounds)
+        print("{0:<28} {1:>9.2f} ms {2:>8.2f} us/object "
+              "{3:>8.1f} MiB/s".format(name, elapsed * 1000,
+                  elapsed * 1e6 / len(corpus),
+                  size / elapsed / 1048576 if elapsed else 0))
+
+
+# The commands timed by the commands suite, with their
+# arguments.  {blob}, {commit}, {file} and {dest} are
+# replaced by a blob and the abbreviated SHA of the last
+# commit, a file to hash and an empty directory.  Starting
+# the interpreter and loading pvc is timed on its own.
+BENCH_COMMANDS = [
+    ("startup", [ "--help" ]),
+    ("hash-object", [ "hash-object", "{file}" ]),
+    ("cat-file", [ "cat-file", "blob", "{blob}" ]),
+    ("ls-tree", [ "ls-tree", "-r", "HEAD" ]),
+    ("log", [ "log", "--pretty", "oneline", "HEAD" ]),
+    ("checkout", [ "checkout", "HEAD", "{dest}" ]),
+    ("rev-parse", [ "rev-parse", "{commit}" ]),
+    ("show-ref", [ "show-ref" ]),
+]
+
+# Generate a repository, then run each command of
+# BENCH_COMMANDS in a new process, as they are run for
+# real: cold, with the files of the repository dropped from
+# the page cache first, and warm, right after a first run.
+def bench_commands(args):
+    low, high = bench_blob_size(args)
+    shape = { "files": args.files, "depth": args.depth,
+              "fanout": args.fanout, "blob_size": [ low, high ],
+              "commits": args.commits, "branches": args.branches,
+              "seed": args.seed, "pack": args.pack }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["shape"] != shape:
+            raise Exception("{0} was measured on a repository "
+                "of another shape: {1}".format(args.compare,
+                    json.dumps(baseline["shape"])))
+
+    scratch = tempfile.mkdtemp(prefix="pvc-bench-")
+    try:
+        path = args.dir or os.path.join(scratch, "repo")
+        start = time.perf_counter()
+        repo, blob, commit = bench_generate(path, args.files,
+            args.depth, args.fanout, (low, high), args.commits,
+            args.branches, args.seed)
+        if args.pack:
+            pack, _ = repack(repo)
+            repack_prune(repo, pack)
+            pack_refs(repo, all_refs=True)
+            commit_graph_write(repo)
+        generated = time.perf_counter() - start
+
+        # Dirty pages can't be dropped
+        os.sync()
+
+        with open(os.path.join(scratch, "file"), "wb") as f:
+            f.write(object_read(repo, blob).blobdata)
+        values = { "blob": blob, "commit": commit[:7],
+                   "file": os.path.join(scratch, "file"),
+                   "dest": os.path.join(scratch, "checkout") }
+
+        print("Generated {0} files and {1} commits in {2:.2f}s, "
+              "best and median of {3}".format(args.files,
+                  args.commits, generated, args.rounds))
+        print("{0:<12} {1:>11} {2:>11} {3:>11} {4:>11}".format(
+            "command", "cold best", "cold median", "warm best",
+            "warm median"))
+
+        results = collections.OrderedDict()
+        evicted = True
+        for name, argv in BENCH_COMMANDS:
+            argv = [ arg.format(**values) for arg in argv ]
+            results[name] = dict()
+            for mode in ("cold", "warm"):
+                times, dropped = bench_run(path, argv, args.rounds,
+                    mode == "cold", values["dest"])
+                evicted = evicted and dropped
+                times.sort()
+                results[name][mode] = {
+                    "best": times[0],
+                    "median": times[len(times) // 2] }
+            print("{0:<12} {1:>8.1f} ms {2:>8.1f} ms {3:>8.1f} ms "
+                  "{4:>8.1f} ms".format(name,
+                      *(results[name][mode][stat] * 1000
+                        for mode in ("cold", "warm")
+                        for stat in ("best", "median"))))
+    finally:
+        shutil.rmtree(scratch)
+
+    report = { "shape": shape,
+               "system": { "python": sys.version.split()[0],
+                           "platform": sys.platform,
+                           "cpus": os.cpu_count() },
+               "rounds": args.rounds,
+               "generate": generated,
+               "evicted": evicted,
+               "results": results }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if baseline is not None:
+        bench_compare(baseline, report, args.threshold)
+
+# Generate a fast-import stream, then import it into new
+# repositories, rounds times into a pack and rounds times
+# into loose objects, as object_write writes them.  The
+# import is run in process, so that only the writing of the
+# objects differs.
+def bench_fast_import(args):
+    low, high = bench_blob_size(args)
+    shape = { "suite": "fast-import", "files": args.files,
+              "depth": args.depth, "fanout": args.fanout,
+              "blob_size": [ low, high ], "commits": args.commits,
+              "seed": args.seed }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["shape"] != shape:
+            raise Exception("{0} was measured on a stream "
+                "of another shape: {1}".format(args.compare,
+                    json.dumps(baseline["shape"])))
+
+    stream = bench_stream(args.files, args.depth, args.fanout,
+        (low, high), args.commits, args.seed)
+    print("Generated a stream of {0} files and {1} commits, "
+          "{2} KiB, best and median of {3}".format(args.files,
+              args.commits, len(stream) // 1024, args.rounds))
+    print("{0:<6} {1:>8} {2:>11} {3:>11} {4:>12}".format(
+        "mode", "objects", "best", "median", "objects/s"))
+
+    results = collections.OrderedDict()
+    scratch = tempfile.mkdtemp(prefix="pvc-bench-")
+    try:
+        for mode in ("pack", "loose"):
+            times = list()
+            for i in range(args.rounds):
+                path = os.path.join(scratch, "{0}-{1}".format(mode, i))
+                repo = repo_create(path)
+                imp = GitFastImport(repo, io.BytesIO(stream),
+                    loose=(mode == "loose"))
+                os.sync()
+                start = time.perf_counter()
+                imp.run()
+                times.append(time.perf_counter() - start)
+                shutil.rmtree(path)
+
+            times.sort()
+            count = sum(imp.counts.values())
+            results[mode] = { "objects": count, "best": times[0],
+                              "median": times[len(times) // 2] }
+            print("{0:<6} {1:>8} {2:>8.1f} ms {3:>8.1f} ms "
+                  "{4:>12.0f}".format(mode, count, times[0] * 1000,
+                      times[len(times) // 2] * 1000,
+                      count / times[0]))
+    finally:
+        shutil.rmtree(scratch)
+
+    print("The pack is {0:.1f} times faster".format(
+        results["loose"]["best"] / results["pack"]["best"]))
+
+    report = { "shape": shape,
+               "system": { "python": sys.version.split()[0],
+                           "platform": sys.platform,
+                           "cpus": os.cpu_count() },
+               "rounds": args.rounds,
+               "results": { "fast-import": results } }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if baseline is not None:
+        bench_compare(baseline, report, args.threshold)
+
+def bench_blob_size(args):
+    try:
+        low, high = (int(x) for x in args.blob_size.split(":"))
+    except ValueError:
+        raise Exception("--blob-size takes MIN:MAX, not {0}"
+            .format(args.blob_size))
+    if not 0 < low <= high:
+        raise Exception("Bad blob sizes {0}".format(args.blob_size))
+    return low, high
+
+# Time rounds runs of pvc with argv in the repository at
+# path.  Returns the times, and whether the page cache could
+# be dropped for cold runs.  dest is removed before each run,
+# for checkout.
+def bench_run(path, argv, rounds, cold, dest):
+    command = [ sys.executable, "-c", "import libpvc; libpvc.main()" ]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+    # Tracing would be timed too
+    env.pop("PVC_TRACE_PERF", None)
+
+    times = list()
+    dropped = True
+    for n in range(rounds + (not cold)):
+        shutil.rmtree(dest, ignore_errors=True)
+        if cold:
+            dropped = bench_evict(os.path.join(path, ".git"))
+
+        start = time.perf_counter()
+        subprocess.run(command + argv, cwd=path, env=env, check=True,
+            stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+
+        # The first warm run is only there to warm up
+        if cold or n:
+            times.append(elapsed)
+
+    shutil.rmtree(dest, ignore_errors=True)
+    return times, dropped
+
+# Drop the files under path from the page cache.  Returns
+# False where the system can't.
+def bench_evict(path):
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+# Compare the best times of report with those of baseline,
+# and fail if any is slower by more than threshold percent.
+def bench_compare(baseline, report, threshold):
+    print("{0:<12} {1:<5} {2:>11} {3:>11} {4:>8}".format(
+        "command", "", "baseline", "now", "change"))
+
+    regressions = list()
+    for name, modes in report["results"].items():
+        for mode, now in modes.items():
+            old = baseline["results"].get(name, {}).get(mode)
+            if old is None:
+                continue
+            change = (now["best"] / old["best"] - 1) * 100
+            slower = change > threshold
+            if slower:
+                regressions.append("{0} ({1})".format(name, mode))
+            print("{0:<12} {1:<5} {2:>8.1f} ms {3:>8.1f} ms "
+                  "{4:>+7.1f}%{5}".format(name, mode,
+                      old["best"] * 1000, now["best"] * 1000, change,
+                      " REGRESSION" if slower else ""))
+
+    if regressions:
+        raise Exception("{0} slower by more than {1}%: {2}".format(
+            len(regressions), threshold, ", ".join(regressions)))
+
+# Generate a repository at path, through the object API.
+# Files are spread evenly over the fanout ** depth
+# directories at the bottom of the tree, with random words
+# for content.  Each commit changes a few files, on master or
+# on one of the topic branches, which get merged back into
+# master now and then.  Commit dates go up an hour at a time
+# from a fixed date, so that a seed always gives the same
+# repository.  Returns the repository, a blob and the last
+# commit of master.
+BENCH_EPOCH = 1500000000
+
+def bench_generate(path, files, depth, fanout, blob_size, commits,
+                   branches, seed):
+    rng = random.Random(seed)
+    repo = repo_create(path)
+    pool = bench_text(rng, blob_size[1])
+
+    def blob(name, rev):
+        data = bench_blob(rng, pool, blob_size, name, rev)
+        return bytes.fromhex(object_write(GitBlob(repo, data)))
+
+    def commit(tree, parents, n):
+        obj = GitCommit(repo)
+        obj.kvlm = collections.OrderedDict()
+        obj.kvlm[b'tree'] = tree.encode()
+        if parents:
+            obj.kvlm[b'parent'] = [ p.encode() for p in parents ]
+        who = b'Bench <bench@example.com> %d +0000' % (
+            BENCH_EPOCH + 3600 * n)
+        obj.kvlm[b'author'] = who
+        obj.kvlm[b'committer'] = who
+        obj.kvlm[b''] = b'Commit %d\n' % n
+        return object_write(obj)
+
+    names = bench_names(files, depth, fanout)
+    root = dict()
+    for name in names:
+        *parts, last = name.split(b'/')
+        node = root
+        for part in parts:
+            node = node.setdefault(part, dict())
+        node[last] = blob(name, 0)
+    last = names[-1]
+
+    heads = { "master": commit(bench_tree_write(repo, root), [], 0) }
+    topics = [ "topic-{0}".format(i) for i in range(branches) ]
+    for topic in topics:
+        heads[topic] = heads["master"]
+
+    n = 1
+    while n < commits:
+        branch = rng.choice([ "master" ] + topics)
+        changes = dict()
+        for _ in range(rng.randint(1, 4)):
+            last = rng.choice(names)
+            changes[last] = blob(last, n)
+        tree = bench_tree_update(repo,
+            commit_tree(repo, heads[branch]), changes)
+        heads[branch] = commit(tree, [ heads[branch] ], n)
+        n += 1
+
+        if branch != "master" and n < commits and rng.random() < 0.25:
+            master, topic = heads["master"], heads[branch]
+            base = merge_base(repo, master, topic)[0]
+            tree, _ = tree_merge(repo, commit_tree(repo, base),
+                commit_tree(repo, master), commit_tree(repo, topic))
+            heads["master"] = commit(tree, [ master, topic ], n)
+            heads[branch] = heads["master"]
+            n += 1
+
+        if n % 10 == 0:
+            ref_create(repo, "refs/tags/v{0}".format(n // 10),
+                heads["master"])
+
+    for branch, sha in heads.items():
+        ref_create(repo, "refs/heads/" + branch, sha)
+
+    tree = commit_tree(repo, heads["master"])
+    for part in last.split(b'/'):
+        tree = object_read(repo, tree).items.find(part).sha
+    return repo, tree, heads["master"]
+
+# A fast-import stream of a linear history on master, of
+# the same shape as the repositories of bench_generate: a
+# first commit adds all the files, and each of the next ones
+# changes a few of them.
+def bench_stream(files, depth, fanout, blob_size, commits, seed):
+    rng = random.Random(seed)
+    pool = bench_text(rng, blob_size[1])
+    names = bench_names(files, depth, fanout)
+
+    ret = list()
+    for n in range(commits):
+        message = b'Commit %d\n' % n
+        ret.append(b'commit refs/heads/master\nmark :%d\n'
+            b'committer Bench <bench@example.com> %d +0000\n'
+            b'data %d\n%s' % (n + 1, BENCH_EPOCH + 3600 * n,
+                len(message), message))
+        changed = names if n == 0 else \
+            rng.sample(names, min(len(names), rng.randint(1, 4)))
+        for name in changed:
+            data = bench_blob(rng, pool, blob_size, name, n)
+            ret.append(b'M 100644 inline %s\ndata %d\n%s\n' % (
+                name, len(data), data))
+        ret.append(b'\n')
+    return b''.join(ret)
+
+# The paths of files files, spread evenly over the
+# fanout ** depth directories at the bottom of the tree
+def bench_names(files, depth, fanout):
+    dirs = [ b''.join(b'd%d/' % i for i in p) for p in
+             itertools.product(range(fanout), repeat=depth) ]
+    return [ dirs[i % len(dirs)] + b'f%d.txt' % i
+             for i in range(files) ]
+
+# The contents of revision rev of the file called name, cut
+# from pool, of a size spread evenly over the orders of
+# magnitude of blob_size
+def bench_blob(rng, pool, blob_size, name, rev):
+    low, high = blob_size
+    size = int(low * (high / low) ** rng.random())
+    start = rng.randrange(len(pool) - size + 1)
+    return b'%s %d\n' % (name, rev) + pool[start:start + size]
+
+# Lines of random words, at least size bytes of them
+def bench_text(rng, size):
+    words = [ bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz')
+                    for _ in range(rng.randint(1, 10)))
+              for _ in range(2000) ]
+    lines = list()
+    total = 0
+    while total < max(size, 65536):
+        line = b' '.join(rng.choice(words)
+                         for _ in range(rng.randint(1, 12))) + b'\n'
+        lines.append(line)
+        total += len(line)
+    return b''.join(lines)
+
+# Write the tree of node, a dict from names to blob SHAs and
+# to the dicts of subdirectories
+def bench_tree_write(repo, node):
+    leaves = list()
+    for name, value in node.items():
+        if type(value) == dict:
+            sha = bytes.fromhex(bench_tree_write(repo, value))
+            leaves.append(GitTreeLeaf(b'40000', name, sha))
+        else:
+            leaves.append(GitTreeLeaf(b'100644', name, value))
+    tree = GitTree(repo)
+    tree.items = sorted(leaves, key=tree_leaf_key)
+    return object_write(tree)
+
+# Write a copy of tree with the files of changes, a dict
+# from paths to blob SHAs, set to their blob, and only the
+# trees above them
+def bench_tree_update(repo, tree, changes):
+    leaves = dict()
+    if tree:
+        leaves = { leaf.path: leaf
+                   for leaf in object_read(repo, tree).items }
+
+    subdirs = collections.defaultdict(dict)
+    for path, binsha in changes.items():
+        name, _, rest = path.partition(b'/')
+        if rest:
+            subdirs[name][rest] = binsha
+        else:
+            leaves[name] = GitTreeLeaf(b'100644', name, binsha)
+
+    for name, sub in subdirs.items():
+        leaf = leaves.get(name)
+        sha = bench_tree_update(repo, leaf.sha if leaf else None, sub)
+        leaves[name] = GitTreeLeaf(b'40000', name, bytes.fromhex(sha))
+
+    new = GitTree(repo)
+    new.items = sorted(leaves.values(), key=tree_leaf_key)
+    return object_write(new)
+
+# }}
+
 # Cat-File {{
 
 def cmd_cat_file(args):
     repo = repo_find()
-    cat_file(repo, args.object, fmt=args.type.encode())
+
+    # A single argument is the object
+    if args.object is None:
+        args.type, args.object = None, args.type
+
+    if args.batch or args.batch_check:
+        cat_file_batch(repo, sys.stdin.buffer, sys.stdout.buffer,
+            contents=args.batch, flush=not args.buffer)
+    elif args.object is None:
+        raise Exception("cat-file needs an object")
+    elif args.show_type or args.show_size:
+        fmt, size = object_header(repo,
+            object_find(repo, args.object))
+        print(fmt.decode("ascii") if args.show_type else size)
+    elif args.type in ("blob", "commit", "tag", "tree"):
+        cat_file(repo, args.object, fmt=args.type.encode())
+    elif args.type:
+        raise Exception("Unknown type {0}".format(args.type))
+    else:
+        raise Exception("cat-file needs a type, -t or -s")
 
 def cat_file(repo, obj, fmt=None):
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    # Write the object as it is stored, as it comes out
+    # of zlib.
+    _, _, chunks = object_stream(repo,
+        object_find(repo, obj, fmt=fmt))
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
+
+# Git's cat-file --batch and --batch-check: read object
+# names from inp, one per line, and write for each one a
+# "<sha> <type> <size>" line to out, followed by the
+# contents and a newline if contents is set.  Names which
+# don't resolve give "<name> missing" (or "ambiguous")
+# instead, and the stream goes on.
+def cat_file_batch(repo, inp, out, contents=True, flush=True):
+    for line in inp:
+        name = line.rstrip(b'\n').decode("utf8", "replace")
+
+        try:
+            shas = object_resolve(repo, name)
+        except Exception:
+            shas = None
+
+        if shas and len(shas) > 1:
+            out.write("{0} ambiguous\n".format(name).encode())
+            continue
+
+        try:
+            sha = shas[0] if shas else None
+            fmt, size = object_header(repo, sha) if sha \
+                else (None, None)
+        except Exception:
+            fmt = None
+
+        if not fmt:
+            out.write("{0} missing\n".format(name).encode())
+        else:
+            out.write("{0} {1} {2}\n".format(
+                sha, fmt.decode("ascii"), size).encode())
+            if contents:
+                for chunk in object_stream(repo, sha)[2]:
+                    out.write(chunk)
+                out.write(b'\n')
+
+        if flush:
+            out.flush()
+
+    out.flush()
+
+# }}
+
+# Diff-Tree {{
+
+def cmd_diff_tree(args):
+    repo = repo_find()
+
+    if args.b is None:
+        # A commit against its parent.  Like Git, root
+        # commits and merges show nothing.
+        sha = object_find(repo, args.a, fmt=b'commit')
+        parents = commit_parents(repo, sha)
+        if len(parents) != 1:
+            return
+        print(sha)
+        a = commit_tree(repo, parents[0])
+        b = commit_tree(repo, sha)
+    else:
+        a = object_find(repo, args.a, fmt=b'tree')
+        b = object_find(repo, args.b, fmt=b'tree')
+
+    for change in tree_diff(repo, a, b, args.recursive):
+        print(":{0} {1} {2} {3} {4}\t{5}".format(
+            diff_mode(change.old), diff_mode(change.new),
+            change.old.sha if change.old else "0" * 40,
+            change.new.sha if change.new else "0" * 40,
+            change.status,
+            change.path.decode("utf8", "replace")))
+
+def diff_mode(leaf):
+    if leaf is None:
+        return "000000"
+    return leaf.mode.rjust(6, b'0').decode("ascii")
 
 # }}
 
@@ -793,13 +5684,60 @@ def cat_file(repo, obj, fmt=None):
 
 def cmd_hash_object(args):
     if args.write:
-        repo = GitRepository(".")
+        repo = repo_find()
     else:
         repo = None
 
-    with open(args.path, "rb") as fd:
-        sha = object_hash(fd, args.type.encode(), repo)
-        print(sha)
+    fmt = args.type.encode()
+
+    if args.stdin_paths:
+        paths = [ line.rstrip("\n") for line in sys.stdin ]
+        jobs = args.jobs or os.cpu_count() or 1
+        for sha in hash_object_paths(paths, fmt, repo, jobs):
+            print(sha)
+        return
+
+    if not args.path:
+        raise Exception("hash-object needs a path or --stdin-paths")
+    print(hash_object_path(args.path, fmt, repo))
+
+def hash_object_path(path, fmt, repo):
+    if fmt == b'blob':
+        # Blobs can be huge and need no parsing: stream them
+        return object_hash_file(path, fmt, repo)
+    else:
+        with open(path, "rb") as fd:
+            return object_hash(fd, fmt, repo)
+
+# Hash (and write, if repo is given) every file of paths,
+# yielding their SHAs in the same order.  Hashing and
+# compressing is CPU bound, so with jobs > 1 the files are
+# spread over a pool of processes, each with its own
+# handle on the repository.
+def hash_object_paths(paths, fmt, repo, jobs=1):
+    if jobs <= 1:
+        for path in paths:
+            yield hash_object_path(path, fmt, repo)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs,
+            initializer=hash_object_init,
+            initargs=(repo.worktree if repo else None, fmt)) \
+            as pool:
+        yield from pool.map(hash_object_job, paths,
+            chunksize=64)
+
+# State of the hash_object_paths worker processes
+hash_object_state = None
+
+def hash_object_init(worktree, fmt):
+    global hash_object_state
+    repo = GitRepository(worktree) if worktree else None
+    hash_object_state = (repo, fmt)
+
+def hash_object_job(path):
+    repo, fmt = hash_object_state
+    return hash_object_path(path, fmt, repo)
 
 # }}
 
@@ -808,32 +5746,46 @@ def cmd_hash_object(args):
 def cmd_log(args):
     repo = repo_find()
 
-    print("digraph wyaglog{")
-    log_graphviz(repo, object_find(repo, args.commit), set())
-    print("}")
-
-def log_graphviz(repo, sha, seen):
-
-    if sha in seen:
-        return
-    seen.add(sha)
+    include = list()
+    exclude = list()
+    for name in args.commit:
+        if ".." in name:
+            a, b = name.split("..", 1)
+            exclude.append(object_find(repo, a or "HEAD",
+                fmt=b'commit'))
+            include.append(object_find(repo, b or "HEAD",
+                fmt=b'commit'))
+        elif name.startswith("^"):
+            exclude.append(object_find(repo, name[1:],
+                fmt=b'commit'))
+        else:
+            include.append(object_find(repo, name,
+                fmt=b'commit'))
 
-    commit = object_read(repo, sha)
-    assert (commit.fmt==b'commit')
+    since = None
+    if args.since:
+        since = rev_walk_parse_date(args.since)
 
-    if not b'parent' in commit.kvlm.keys():
-        # Base case: the initial commit.
-        return
+    walk = rev_walk(repo, include, exclude, order=args.order,
+        max_count=args.max_count, since=since)
 
-    parents = commit.kvlm[b'parent']
+    if args.pretty == "oneline":
+        log_oneline(repo, walk)
+    else:
+        print("digraph wyaglog{")
+        log_graphviz(repo, walk)
+        print("}")
 
-    if type(parents) != list:
-        parents = [ parents ]
+def log_graphviz(repo, walk):
+    for sha, parents in walk:
+        for p in parents:
+            print ("c_{0} -> c_{1};".format(sha, p))
 
-    for p in parents:
-        p = p.decode("ascii")
-        print ("c_{0} -> c_{1};".format(sha, p))
-        log_graphviz(repo, p, seen)
+def log_oneline(repo, walk):
+    for sha, _ in walk:
+        message = object_read(repo, sha).kvlm[b'']
+        print("{0} {1}".format(sha,
+            message.split(b'\n', 1)[0].decode("utf8", "replace")))
 
 # }}
 
@@ -857,19 +5809,606 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path).encode())
+    path = os.path.realpath(args.path).encode()
+    if args.jobs > 1:
+        # Only report progress to a human
+        progress = None
+        if sys.stderr.isatty():
+            progress = checkout_progress
+
+        files, size, seconds = tree_checkout_parallel(
+            repo, obj, path, args.jobs, progress)
+        print("Checked out {0} files, {1} bytes in {2:.2f}s "
+              "({3:.1f} files/s, {4:.1f} MiB/s)".format(
+                  files, size, seconds,
+                  files / seconds if seconds else 0,
+                  size / seconds / 1048576 if seconds else 0))
+    else:
+        tree_checkout(repo, obj, path)
+
+def checkout_progress(done, total):
+    sys.stderr.write("\rChecking out files: {0}% ({1}/{2})"
+        .format(100 * done // total if total else 100,
+            done, total))
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
 
 def tree_checkout(repo, tree, path):
     for item in tree.items:
-        obj = object_read(repo, item.sha)
+        fmt = tree_leaf_fmt(item.mode)
         dest = os.path.join(path, item.path)
 
-        if obj.fmt == b'tree':
+        if fmt == b'tree':
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
+            tree_checkout(repo, object_read(repo, item.sha), dest)
+        elif fmt == b'blob':
+            # Blobs go to disk chunk by chunk
+            _, _, chunks = object_stream(repo, item.sha)
             with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+                for chunk in chunks:
+                    f.write(chunk)
+
+# Check tree out in path like tree_checkout does, writing
+# the blobs from a pool of jobs threads.  The trees are
+# read first to create all the directories, then the blobs
+# are inflated and written in parallel, zlib releasing the
+# GIL while it works.  progress, if given, is called with
+# the number of files done and their total.  Returns the
+# number of files, their size and the time it all took.
+def tree_checkout_parallel(repo, tree, path, jobs, progress=None):
+    start = time.monotonic()
+
+    # Parents are listed before their children
+    dirs = list()
+    files = list()
+    stack = [ (tree, path) ]
+    while stack:
+        tree, path = stack.pop()
+        for item in tree.items:
+            fmt = tree_leaf_fmt(item.mode)
+            dest = os.path.join(path, item.path)
+
+            if fmt == b'tree':
+                dirs.append(dest)
+                stack.append((object_read(repo, item.sha), dest))
+            elif fmt == b'blob':
+                files.append((item.sha, dest))
+
+    for d in dirs:
+        os.mkdir(d)
+
+    def write(job):
+        sha, dest = job
+        size = 0
+        _, _, chunks = object_stream(repo, sha)
+        with open(dest, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for done, size in enumerate(pool.map(write, files), 1):
+            total += size
+            if progress and (done % 100 == 0
+                             or done == len(files)):
+                progress(done, len(files))
+
+    return len(files), total, time.monotonic() - start
+
+# }}
+
+# Status {{
+
+def cmd_status(args):
+    repo = repo_find()
+    jobs = args.jobs or os.cpu_count() or 1
+
+    staged, unstaged, untracked, refreshed = repo_status(repo,
+        jobs, args.refresh)
+
+    head = ref_resolve(repo, "HEAD")
+    if head is None:
+        print("No commits yet")
+
+    for name in sorted(set(staged) | set(unstaged)):
+        print("{0}{1} {2}".format(staged.get(name, " "),
+            unstaged.get(name, " "), name.decode()))
+    for name in untracked:
+        print("?? {0}".format(name.decode()))
+
+# Compare HEAD, the index and the worktree.  Returns dicts
+# from names to a letter for the staged and the unstaged
+# changes (A, M, D or U for unmerged), the sorted list of
+# untracked files and directories, and whether the index
+# was refreshed.  Untracked paths that .gitignore files,
+# info/exclude or core.excludesFile ignore are left out.
+#
+# Files whose stat data matches their index entry are
+# taken to be unchanged without being read, only the other
+# ones and the racily clean ones are hashed.  Directories
+# are listed and their files lstat'ed from jobs threads.
+# With refresh, the new stat data of files found unchanged
+# is saved to the index, so the next run needn't hash them.
+def repo_status(repo, jobs=1, refresh=False):
+    start = time.time_ns()
+    index = index_read(repo)
+    try:
+        stamp = index_stamp(
+            os.stat(repo_file(repo, "index")).st_mtime_ns)
+    except FileNotFoundError:
+        stamp = bytes(8)
+
+    unstaged = dict()
+    untracked = list()
+
+    # Staged changes, which the cached trees of the index
+    # mostly answer
+    head = ref_resolve(repo, "HEAD")
+    staged = index_diff_tree(repo, index,
+        commit_tree(repo, head) if head else None)
+    for e in index.entries:
+        if e.flags:
+            if e.flag_stage:
+                unstaged[e.name] = "U"
+            elif e.flag_intent_to_add:
+                unstaged[e.name] = "A"
+
+    # The entries by directory
+    dirs = collections.defaultdict(dict)
+    for e in index.entries:
+        parent, _, base = e.name.rpartition(b'/')
+        dirs[parent][base] = e
+
+    # Directories with a tracked file somewhere under them
+    tracked = { b'' }
+    for parent in dirs:
+        while parent not in tracked:
+            tracked.add(parent)
+            parent = parent.rpartition(b'/')[0]
+
+    # The ignore rules of each tracked directory, parents
+    # first, and the tracked directories which are ignored
+    # themselves, where every untracked file is.
+    worktree = os.fsencode(repo.worktree)
+    rules = { b'': ignore_read(worktree, b'', ignore_rules(repo)) }
+    ignored = set()
+    for parent in sorted(tracked):
+        if parent:
+            up = parent.rpartition(b'/')[0]
+            if up in ignored or ignore_match(rules[up], parent, True):
+                ignored.add(parent)
+            rules[parent] = ignore_read(worktree, parent, rules[up])
+
+    # List a tracked directory and lstat its files.  Returns
+    # the entries which need their content checked, the
+    # names of the untracked files and directories and of
+    # the deleted files.
+    def scan(parent):
+        entries = dirs.get(parent, {})
+        prefix = parent + b'/' if parent else b''
+        r = rules[parent]
+        skip = parent in ignored
+        changed = list()
+        new = list()
+        seen = set()
+
+        try:
+            it = os.scandir(os.path.join(worktree, parent))
+        except (FileNotFoundError, NotADirectoryError):
+            it = ()
+
+        for entry in it:
+            base = entry.name
+            e = entries.get(base)
+            if entry.is_dir(follow_symlinks=False):
+                name = prefix + base
+                if name in tracked or base == b'.git':
+                    continue
+                if not skip and not ignore_match(r, name, True) \
+                        and status_has_files(worktree, name, r):
+                    new.append(name + b'/')
+                continue
+
+            if e is None:
+                if not skip and not ignore_match(r, prefix + base,
+                        False):
+                    new.append(prefix + base)
+                continue
+            seen.add(base)
+            if e.flags:
+                continue
+
+            st = index_stat(entry.stat(follow_symlinks=False))
+            if st != e.raw[:40] or index_entry_racy(e, stamp):
+                changed.append((e, st))
+
+        if it:
+            it.close()
+
+        # A tracked file may have become a directory
+        deleted = [ e.name for base, e in entries.items()
+                    if base not in seen ]
+        return changed, new, deleted
+
+    # Only the tracked directories are scanned, untracked
+    # ones are reported as a whole.
+    changed = list()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for c, new, deleted in pool.map(scan, tracked):
+            changed.extend(c)
+            untracked.extend(new)
+            for name in deleted:
+                unstaged.setdefault(name, "D")
+
+        # Hash what stat couldn't tell, hashlib and zlib
+        # leave the GIL to the other threads.
+        def check(job):
+            e, st = job
+            path = os.path.join(worktree, e.name)
+            if os.path.islink(path):
+                sha = object_write(GitBlob(None,
+                    os.readlink(path)), False)
+            else:
+                sha = object_hash_file(path, b'blob', None)
+            return e, st, bytes.fromhex(sha) == e.sha
+
+        dirty = False
+        for e, st, same in pool.map(check, changed):
+            if not same or st[24:28] != e.raw[24:28]:
+                unstaged.setdefault(e.name, "M")
+            elif refresh:
+                # Files changed since we started may change
+                # again unnoticed within the same tick, so
+                # they're smudged to be checked next time.
+                if st[8:16] >= index_stamp(
+                        start - start % 1000000000):
+                    st = st[:36] + bytes(4)
+                if st != e.raw[:40]:
+                    e.raw = st + e.sha
+                    dirty = True
+
+    if dirty:
+        index_write(repo, index)
+
+    untracked.sort()
+    return staged, unstaged, untracked, dirty
+
+# Whether the untracked directory name has a file which
+# isn't ignored, rules being the ignore rules of its parent
+def status_has_files(worktree, name, rules):
+    rules = ignore_read(worktree, name, rules)
+    try:
+        it = os.scandir(os.path.join(worktree, name))
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+    with it:
+        for entry in it:
+            path = name + b'/' + entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if ignore_match(rules, path, is_dir):
+                continue
+            if not is_dir or status_has_files(worktree, path, rules):
+                return True
+    return False
+
+# Ignore rules are (base, regex, negated, directories only)
+# tuples, in increasing order of precedence: base is the
+# directory of the .gitignore they come from, with a
+# trailing slash, and regex matches the paths from there.
+# The rules of the repository as a whole: core.excludesFile,
+# then info/exclude.
+def ignore_rules(repo):
+    conf = configparser.ConfigParser()
+    conf.read([ os.path.expanduser("~/.gitconfig"),
+                repo_path(repo, "config") ])
+    xdg = os.environ.get("XDG_CONFIG_HOME") \
+        or os.path.expanduser("~/.config")
+    excludes = conf.get("core", "excludesfile",
+        fallback=os.path.join(xdg, "git", "ignore"))
+
+    ret = list()
+    for path in (os.path.expanduser(excludes),
+                 repo_path(repo, "info", "exclude")):
+        try:
+            with open(path, "rb") as f:
+                ret.extend(ignore_parse(f.read(), b''))
+        except (FileNotFoundError, IsADirectoryError):
+            pass
+    return ret
+
+# rules, followed by those of the .gitignore of directory
+# name if it has one
+def ignore_read(worktree, name, rules):
+    try:
+        with open(os.path.join(worktree, name, b'.gitignore'),
+                "rb") as f:
+            data = f.read()
+    except (FileNotFoundError, NotADirectoryError,
+            IsADirectoryError):
+        return rules
+    return rules + ignore_parse(data, name + b'/' if name else b'')
+
+def ignore_parse(data, base):
+    ret = list()
+    for line in data.split(b'\n'):
+        line = line.rstrip(b'\r')
+        # Trailing spaces only count when escaped
+        while line.endswith(b' ') and not line.endswith(b'\\ '):
+            line = line[:-1]
+        if not line or line.startswith(b'#'):
+            continue
+
+        negated = line.startswith(b'!')
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith(b'/')
+        if dir_only:
+            line = line[:-1]
+        # Patterns with a slash are relative to base, the
+        # others match a name at any depth under it.
+        anchored = b'/' in line
+        if line.startswith(b'/'):
+            line = line[1:]
+        if not line:
+            continue
+
+        regex = ignore_regex(line)
+        if not anchored:
+            regex = b'(?:.*/)?' + regex
+        ret.append((base, re.compile(regex + b'\\Z', re.S),
+            negated, dir_only))
+    return ret
+
+# The regular expression of a gitignore pattern: * and ?
+# don't match slashes, unlike a leading **/, a trailing /**
+# or a /**/ in the middle.
+def ignore_regex(pattern):
+    ret = list()
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i:i+1]
+        if pattern.startswith(b'**', i) \
+                and (i == 0 or pattern[i-1:i] == b'/'):
+            if i + 2 == n:
+                ret.append(b'.*')
+                i += 2
+                continue
+            if pattern[i+2:i+3] == b'/':
+                ret.append(b'(?:.*/)?')
+                i += 3
+                continue
+
+        if c == b'*':
+            ret.append(b'[^/]*')
+            while pattern[i+1:i+2] == b'*':
+                i += 1
+        elif c == b'?':
+            ret.append(b'[^/]')
+        elif c == b'[':
+            j = i + 1
+            if pattern[j:j+1] in (b'!', b'^'):
+                j += 1
+            if pattern[j:j+1] == b']':
+                j += 1
+            j = pattern.find(b']', j)
+            if j < 0:
+                ret.append(re.escape(c))
+            else:
+                body = pattern[i+1:j].replace(b'\\', b'\\\\')
+                if body[:1] in (b'!', b'^'):
+                    body = b'^/' + body[1:]
+                ret.append(b'[' + body + b']')
+                i = j
+        elif c == b'\\' and i + 1 < n:
+            i += 1
+            ret.append(re.escape(pattern[i:i+1]))
+        else:
+            ret.append(re.escape(c))
+        i += 1
+    return b''.join(ret)
+
+# Whether the path name, from the worktree, is ignored: the
+# last rule to match it decides.
+def ignore_match(rules, name, is_dir):
+    for base, regex, negated, dir_only in reversed(rules):
+        if dir_only and not is_dir:
+            continue
+        if name.startswith(base) and regex.match(name, len(base)):
+            return not negated
+    return False
+
+# }}
+
+# Commit {{
+
+def cmd_write_tree(args):
+    repo = repo_find()
+    index = index_read(repo)
+    sha = index_write_tree(repo, index)
+    # Save the cached trees for next time
+    index_write(repo, index)
+    print(sha)
+
+def cmd_commit(args):
+    repo = repo_find()
+    index = index_read(repo)
+    tree = index_write_tree(repo, index)
+    index_write(repo, index)
+
+    parent = ref_resolve(repo, "HEAD")
+    parents = [ parent ] if parent else []
+
+    # Concluding a merge that had conflicts
+    merge_head = repo_path(repo, "MERGE_HEAD")
+    if os.path.exists(merge_head):
+        with open(merge_head) as f:
+            parents.append(f.read().strip())
+
+    sha = commit_create(repo, tree, parents, args.message)
+    ref_update_head(repo, sha)
+    if len(parents) > 1:
+        os.unlink(merge_head)
+
+    print("[{0} {1}] {2}".format(ref_head_name(repo), sha[:7],
+        args.message.split("\n", 1)[0]))
+
+def commit_create(repo, tree, parents, message):
+    commit = GitCommit(repo)
+    commit.kvlm = collections.OrderedDict()
+    commit.kvlm[b'tree'] = tree.encode()
+    if parents:
+        commit.kvlm[b'parent'] = [ p.encode() for p in parents ]
+    commit.kvlm[b'author'] = repo_identity(repo, "AUTHOR")
+    commit.kvlm[b'committer'] = repo_identity(repo, "COMMITTER")
+    if not message.endswith("\n"):
+        message += "\n"
+    commit.kvlm[b''] = message.encode()
+    return object_write(commit)
+
+# }}
+
+# Merge {{
+
+def cmd_merge(args):
+    repo = repo_find()
+    head = ref_resolve(repo, "HEAD")
+    if head is None:
+        raise Exception("No commits yet")
+    other = object_find(repo, args.commit, fmt=b'commit')
+
+    if args.apply and os.path.exists(repo_path(repo, "MERGE_HEAD")):
+        raise Exception("A merge is in progress: commit it first")
+
+    # With several merge bases, as after criss-cross merges,
+    # Git merges them first; we take the first one.
+    bases = merge_base(repo, head, other)
+    if other in bases:
+        print("Already up to date.")
+        return
+
+    if head in bases:
+        tree, conflicts = commit_tree(repo, other), []
+    else:
+        tree, conflicts = tree_merge(repo,
+            commit_tree(repo, bases[0]) if bases else None,
+            commit_tree(repo, head), commit_tree(repo, other),
+            (b'HEAD', args.commit.encode()))
+
+    if not args.apply:
+        print(tree)
+        for c in conflicts:
+            print("CONFLICT ({0}): {1}".format(c.kind,
+                c.path.decode("utf8", "replace")))
+        return
+
+    staged, unstaged, _, _ = repo_status(repo)
+    if staged or unstaged:
+        raise Exception("Your local changes would be overwritten "
+            "by merge: commit them first")
+
+    merge_checkout(repo, commit_tree(repo, head), tree, conflicts)
+
+    if head in bases:
+        ref_update_head(repo, other)
+        print("Fast-forward")
+    elif conflicts:
+        with open(repo_file(repo, "MERGE_HEAD"), "w") as f:
+            f.write(other + "\n")
+        for c in conflicts:
+            print("CONFLICT ({0}): {1}".format(c.kind,
+                c.path.decode("utf8", "replace")))
+        print("Automatic merge failed; fix conflicts and then "
+            "commit the result.")
+    else:
+        message = args.message or "Merge {0}".format(args.commit)
+        sha = commit_create(repo, tree, [ head, other ], message)
+        ref_update_head(repo, sha)
+        print("Merge made: [{0} {1}] {2}".format(ref_head_name(repo),
+            sha[:7], message.split("\n", 1)[0]))
+
+# Bring the index and the worktree from the tree old to the
+# tree new, which only touches the files that differ.  The
+# paths of conflicts get their base, our and their versions
+# in the index, as stages 1, 2 and 3.
+def merge_checkout(repo, old, new, conflicts):
+    worktree = os.path.realpath(repo.worktree)
+    index = index_read(repo)
+
+    changes = list(tree_diff(repo, old, new, recursive=True))
+    removed = set()
+    entries = list()
+
+    # Files go before new ones take their place, a directory
+    # replacing a file for example
+    for change in changes:
+        if change.new is not None:
+            continue
+        removed.add(change.path)
+        path = os.path.join(worktree, os.fsdecode(change.path))
+        if os.path.lexists(path):
+            os.unlink(path)
+        parent = os.path.dirname(path)
+        while parent != worktree:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    for change in changes:
+        leaf = change.new
+        if leaf is None:
+            continue
+        path = os.path.join(worktree, os.fsdecode(change.path))
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if leaf.mode == b'160000':
+            # Submodules are left to be checked out
+            os.makedirs(path, exist_ok=True)
+            entries.append(GitIndexEntry(change.path, INDEX_STAT.pack(
+                0, 0, 0, 0, 0, 0, 0o160000, 0, 0, 0) + leaf.binsha))
+            continue
+
+        data = object_read(repo, leaf.sha).blobdata
+        if leaf.mode == b'120000':
+            os.symlink(data, path)
+        else:
+            with open(path, "wb") as f:
+                f.write(data)
+            if leaf.mode == b'100755':
+                os.chmod(path, os.stat(path).st_mode | 0o111)
+        entries.append(index_entry_stat(change.path, leaf.binsha,
+            path))
+
+    for c in conflicts:
+        for stage, leaf in enumerate((c.base, c.ours, c.theirs), 1):
+            if leaf is None or tree_leaf_fmt(leaf.mode) == b'tree':
+                continue
+            e = GitIndexEntry(c.path, INDEX_STAT.pack(0, 0, 0, 0, 0, 0,
+                int(leaf.mode, 8), 0, 0, 0) + leaf.binsha)
+            e.flag_stage = stage
+            entries.append(e)
+
+    # Unmerged paths have no stage 0
+    unmerged = set(e.name for e in entries if e.flag_stage)
+    entries = [ e for e in entries
+                if e.flag_stage or e.name not in unmerged ]
+
+    names = set(e.name for e in entries)
+    index.entries = [ e for e in index.entries
+                      if e.name not in removed or e.name in names ]
+    for name in removed:
+        index_invalidate_tree(index, name)
+    index_update(index, sorted(entries,
+        key=lambda e: (e.name, e.flag_stage)))
+    index_write(repo, index)
 
 # }}
 
@@ -899,17 +6438,929 @@ def show_ref(repo, refs, with_hash=True, prefix=""):
 # Rev-Parse {{
 
 def cmd_rev_parse(args):
+    fmt = None
     if args.type:
         fmt = args.type.encode()
 
     repo = repo_find()
 
     print (object_find(
-        repo, args.name, args.type, follow=True
+        repo, args.name, fmt, follow=True
     ))
 
 # }}
 
+# Pack-Refs {{
+
+def cmd_pack_refs(args):
+    repo = repo_find()
+    pack_refs(repo, all_refs=args.all_refs, prune=args.prune)
+
+# }}
+
+# Commit-Graph {{
+
+def cmd_commit_graph(args):
+    repo = repo_find()
+    count = commit_graph_write(repo)
+    print("Wrote a commit-graph with {0} commits".format(count))
+
+# }}
+
+# Daemon {{
+
+# pvc daemon runs commands sent by the pvc script over a
+# Unix socket, one at a time.  A command runs as if pvc had
+# been started in the client's directory, with its
+# environment, except that repo_find hands out the
+# repositories of earlier commands, with their object
+# caches, packs, refs and commit-graph already loaded.
+#
+# A request is a line of JSON with argv, cwd and env.  The
+# answer is a series of frames: a byte for the channel (1
+# for the standard output, 2 for the standard error, 0 for
+# the exit status), the length of the data as 4 bytes, big
+# endian, and the data.  Commands don't get the client's
+# standard input: those that need it are run by the client.
+#
+# Clients have DAEMON_REQUEST_TIMEOUT seconds to send their
+# request, and the frames are sent from a thread of each
+# connection, so that a client reading its output slowly
+# doesn't hold the others up.  At most DAEMON_SEND_FRAMES
+# frames wait for a client: a command whose client made no
+# room for one in DAEMON_SEND_TIMEOUT seconds is stopped, as
+# if the client had gone away, so that a client which stops
+# reading, like a pager left open, holds the others up for
+# that long at most, and doesn't make the daemon keep all of
+# the output in memory.
+#
+# Only the user running the daemon may connect: the socket
+# is created for them alone, and the credentials of each
+# client are checked where the system gives them.
+DAEMON_REQUEST_TIMEOUT = 5
+DAEMON_SEND_FRAMES = 64
+DAEMON_SEND_TIMEOUT = 5
+
+class GitDaemon(object):
+    cache_bytes = None
+    """Size of the object cache of each repository"""
+    repos = None
+    """Worktrees => their GitRepository"""
+    stamps = None
+    """Worktrees => the daemon_stamps of their repository"""
+    checked = None
+    """Worktrees checked for changes during this command"""
+
+    def __init__(self, cache_bytes):
+        self.cache_bytes = cache_bytes
+        self.repos = dict()
+        self.stamps = dict()
+        self.checked = set()
+
+def cmd_daemon(args):
+    global daemon
+
+    path = args.socket or os.environ.get("PVC_DAEMON") \
+        or os.path.join(tempfile.gettempdir(),
+            "pvc-{0}.sock".format(os.getuid()))
+
+    # A socket left behind by a daemon that died is removed,
+    # one that answers isn't.
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            raise Exception("A daemon is already listening on {0}"
+                .format(path))
+        except ConnectionRefusedError:
+            os.unlink(path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    print("Listening on {0}".format(path), flush=True)
+
+    # Stopping it with kill cleans up like ^C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    daemon = GitDaemon(args.cache_mb * 1024 * 1024)
+    try:
+        while True:
+            conn, _ = server.accept()
+            if not daemon_peer_allowed(conn):
+                print("Refused a client of another user", flush=True)
+                conn.close()
+                continue
+            try:
+                daemon_serve(daemon, conn)
+            except Exception:
+                # A bad request: it is no reason to stop
+                traceback.print_exc()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon = None
+        server.close()
+        os.unlink(path)
+
+# Whether the client on conn runs as the user of the daemon.
+# Without SO_PEERCRED, the mode of the socket is all there is.
+def daemon_peer_allowed(conn):
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+        struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid == os.getuid()
+
+# Run the command of one request, sending back its output
+# and its exit status.  conn is closed once all is sent.
+def daemon_serve(daemon, conn):
+    conn.settimeout(DAEMON_REQUEST_TIMEOUT)
+    try:
+        line = conn.makefile("rb").readline()
+        request = json.loads(line) if line else None
+    except socket.timeout:
+        print("Dropped a client which sent no request",
+            flush=True)
+        request = None
+    except BaseException:
+        conn.close()
+        raise
+    if request is None:
+        # Empty lines come from the probes of daemons
+        # starting on the same socket
+        conn.close()
+        return
+    conn.settimeout(None)
+    sender = GitDaemonSender(conn)
+
+    streams = [ sys.stdin, sys.stdout, sys.stderr ]
+    environ = dict(os.environ)
+    cwd = os.getcwd()
+
+    out = io.TextIOWrapper(io.BufferedWriter(
+        GitDaemonStream(sender, 1)), encoding="utf8")
+    err = io.TextIOWrapper(io.BufferedWriter(
+        GitDaemonStream(sender, 2)), encoding="utf8",
+        line_buffering=True)
+
+    status = 0
+    try:
+        sys.stdin = io.TextIOWrapper(io.BytesIO())
+        sys.stdout, sys.stderr = out, err
+        os.environ.clear()
+        os.environ.update(request["env"])
+        os.chdir(request["cwd"])
+        daemon.checked.clear()
+
+        main(request["argv"])
+    except SystemExit as e:
+        # From argparse, for --help or bad arguments
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            err.write("{0}\n".format(e.code))
+            status = 1
+    except BrokenPipeError:
+        # The client went away
+        status = None
+    except Exception:
+        traceback.print_exc(file=err)
+        status = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = streams
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(cwd)
+
+        if status is not None:
+            try:
+                out.flush()
+                err.flush()
+                sender.send(0, str(status).encode())
+            except BrokenPipeError:
+                pass
+        sender.close()
+
+# Sends the frames of a command to its client from a thread,
+# which closes the connection once they are all sent.
+# Up to DAEMON_SEND_FRAMES frames wait in memory while the
+# client is slow to read them.  Once the client has gone
+# away, or hasn't made room for a frame in
+# DAEMON_SEND_TIMEOUT seconds, sending raises
+# BrokenPipeError, as writing to a closed pipe does, to stop
+# the command.
+class GitDaemonSender(object):
+    __slots__ = ("conn", "frames", "failed", "thread")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.frames = queue.Queue(maxsize=DAEMON_SEND_FRAMES)
+        self.failed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send(self, channel, data):
+        if self.failed:
+            raise BrokenPipeError("The client went away")
+        self._put(struct.pack(">BI", channel, len(data)) + data)
+
+    def close(self):
+        if self.failed:
+            return
+        try:
+            self._put(None)
+        except BrokenPipeError:
+            pass
+
+    def _put(self, frame):
+        try:
+            self.frames.put(frame, timeout=DAEMON_SEND_TIMEOUT)
+        except queue.Full:
+            # Unblock the thread, which then closes conn
+            self.failed = True
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            raise BrokenPipeError("The client stopped reading")
+
+    def _run(self):
+        with self.conn:
+            try:
+                for frame in iter(self.frames.get, None):
+                    self.conn.sendall(frame)
+            except OSError:
+                self.failed = True
+
+# What commands write to their standard output and error,
+# as frames to the client
+class GitDaemonStream(io.RawIOBase):
+    def __init__(self, sender, channel):
+        self.sender = sender
+        self.channel = channel
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sender.send(self.channel, bytes(data))
+        return len(data)
+
+# The repository of the worktree path, kept from earlier
+# commands unless it changed.  Objects never change, so the
+# cached ones stay good: what can go stale is what comes
+# from files that get rewritten, and is dropped when one of
+# them has changed since it was last checked.  Each
+# repository is checked once per command.
+def daemon_repo(daemon, path):
+    repo = daemon.repos.get(path)
+    if repo is not None and path in daemon.checked:
+        return repo
+
+    stamps = daemon_stamps(path)
+    old = daemon.stamps.get(path)
+    if repo is None or old["config"] != stamps["config"]:
+        repo = daemon.repos[path] = GitRepository(path,
+            cache_bytes=daemon.cache_bytes)
+    else:
+        if old["refs"] != stamps["refs"]:
+            ref_invalidate(repo)
+        if old["packs"] != stamps["packs"]:
+            pack_list(repo, refresh=True)
+        if old["commit-graph"] != stamps["commit-graph"]:
+            repo.commit_graph = None
+        if old["oid-index"] != stamps["oid-index"]:
+            repo.oid_index = None
+
+    daemon.stamps[path] = stamps
+    daemon.checked.add(path)
+    return repo
+
+# The stat data of the files a repository handle loads
+# things from, by what they make stale.  Refs are rewritten
+# in place or renamed over, so every loose ref is stat'ed,
+# but not the locks they are written through.
+def daemon_stamps(path):
+    gitdir = os.path.join(path, ".git")
+
+    def stamp(*names):
+        try:
+            st = os.stat(os.path.join(gitdir, *names))
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_ctime_ns, st.st_size,
+                st.st_ino)
+
+    refs = [ stamp("HEAD"), stamp("packed-refs") ]
+    stack = [ os.path.join(gitdir, "refs") ]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.name.endswith(".lock"):
+                continue
+            st = entry.stat(follow_symlinks=False)
+            refs.append((entry.path, st.st_mtime_ns, st.st_ctime_ns,
+                         st.st_size, st.st_ino))
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+
+    return { "config": stamp("config"),
+             "refs": refs,
+             "packs": stamp("objects", "pack"),
+             "commit-graph": stamp("objects", "info", "commit-graph"),
+             "oid-index": stamp("objects", "info", "pvc-oid-index") }
+
+# }}
+
+# Object ID Index {{
+
+def cmd_oid_index(args):
+    repo = repo_find()
+    count = oid_index_write(repo)
+    if count is None:
+        raise Exception("The object index is being written")
+    print("Wrote an object index with {0} objects".format(count))
+
+# }}
+
+# Repack {{
+
+def cmd_repack(args):
+    repo = repo_find()
+
+    before = objects_usage(repo)
+    pack, objects = repack(repo, window=args.window,
+        depth=args.depth)
+    repack_prune(repo, pack)
+    after = objects_usage(repo)
+
+    print("Packed {0} objects into {1}.pack".format(
+        len(objects), os.path.basename(pack.path)))
+    for label, usage in (("before", before), ("after", after)):
+        print("{0}: {1} loose objects ({2} KiB), "
+              "{3} packed objects ({4} KiB)".format(
+                  label,
+                  usage[0][0], usage[0][1] // 1024,
+                  usage[1][0], usage[1][1] // 1024))
+
+    # Like Git, gc also packs the refs and refreshes the
+    # commit-graph
+    if args.command == "gc":
+        pack_refs(repo, all_refs=True)
+        count = commit_graph_write(repo)
+        print("Wrote a commit-graph with {0} commits".format(
+            count))
+
+# }}
+
+# Fast-Import {{
+
+# Reads a stream in the format of git fast-import (blob,
+# commit, tag, reset, checkpoint and progress commands, with
+# marks) and writes its objects to one pack, with its index
+# written at the end, rather than to one loose file each.
+# The trees of the branches are kept in memory, as
+# GitImportTree, and only the ones above changed files are
+# written again.  Objects the stream repeats, or that the
+# repository already has, are written once.
+#
+# A branch the repository has goes on from its commit when
+# the stream doesn't say where it starts, and a branch isn't
+# moved to a commit that doesn't contain its old one unless
+# forced, so that an import can't lose history.
+
+# The escapes of C-style quoted paths
+FAST_IMPORT_ESCAPES = { ord('a'): 7, ord('b'): 8, ord('f'): 12,
+                        ord('n'): 10, ord('r'): 13, ord('t'): 9,
+                        ord('v'): 11, ord('"'): 34, ord('\\'): 92 }
+
+FAST_IMPORT_NULL_SHA = "0" * 40
+
+# A directory of a branch being imported.  binsha is None
+# once something under the directory changed, and entries is
+# None until the tree of binsha is needed.
+class GitImportTree(object):
+    __slots__ = ("binsha", "entries")
+
+    def __init__(self, binsha=None, entries=None):
+        self.binsha = binsha
+        self.entries = entries
+        # Name => [ mode, binsha, GitImportTree or None ],
+        # the GitImportTree of subdirectories being created
+        # as paths go through them
+
+class GitFastImport(object):
+    marks = None
+    """Mark number => hex SHA"""
+    branches = None
+    """Ref => [ GitImportTree, hex SHA of the head or None ]"""
+    tags = None
+    """Tag name => hex SHA of the tag object"""
+    commits = None
+    """Hex SHA => hex SHA of the tree, of the commits imported"""
+    seen = None
+    """Binary SHAs of the objects imported or found"""
+    counts = None
+    """Number of objects written, by type"""
+    refused = None
+    """Refs left alone as their update wasn't a fast-forward"""
+    duplicates = 0
+
+    def __init__(self, repo, inp, loose=False, force=False):
+        self.repo = repo
+        self.inp = inp
+        self.loose = loose
+        self.force = force
+        self.writer = None if loose else GitPackWriter(repo)
+        self.marks = dict()
+        self.branches = dict()
+        self.tags = dict()
+        self.commits = dict()
+        self.seen = set()
+        self.counts = collections.Counter()
+        self.refused = set()
+        self.pushback = None
+
+    def run(self, export_marks=None):
+        while True:
+            line = self.line()
+            if line is None or line == b'done':
+                break
+            cmd, _, arg = line.partition(b' ')
+            if   cmd == b'blob'       : self.blob()
+            elif cmd == b'commit'     : self.commit(arg.decode())
+            elif cmd == b'tag'        : self.tag(arg.decode())
+            elif cmd == b'reset'      : self.reset(arg.decode())
+            elif cmd == b'checkpoint' : self.checkpoint(export_marks)
+            elif cmd == b'progress'   : print(line.decode())
+            elif cmd == b'option'     : pass
+            elif cmd == b'feature':
+                if arg not in (b'done', b'date-format=raw'):
+                    raise Exception("Unsupported feature {0}"
+                        .format(arg.decode()))
+            else:
+                raise Exception("Unsupported command {0}"
+                    .format(line.decode()))
+
+        self.checkpoint(export_marks, last=True)
+
+    def line(self):
+        # The next line that isn't a comment or empty,
+        # without its LF, or None at the end of the stream
+        if self.pushback is not None:
+            line, self.pushback = self.pushback, None
+            return line
+        while True:
+            line = self.inp.readline()
+            if not line:
+                return None
+            line = line.rstrip(b'\n')
+            if line and not line.startswith(b'#'):
+                return line
+
+    def fields(self, names):
+        # The "name value" lines for names, up to the first
+        # other line, which is returned too
+        ret = collections.defaultdict(list)
+        while True:
+            line = self.line()
+            name, _, value = (line or b'').partition(b' ')
+            if name not in names:
+                return ret, line
+            ret[name].append(value)
+
+    def data(self, line):
+        # The contents of a data command, with either an
+        # exact byte count or a delimiter
+        if line is None or not line.startswith(b'data '):
+            raise Exception("Expected data, not {0}".format(line))
+
+        if line.startswith(b'data <<'):
+            delim = line[7:] + b'\n'
+            lines = list()
+            for l in iter(self.inp.readline, b''):
+                if l == delim:
+                    return b''.join(lines)
+                lines.append(l)
+            raise Exception("Unterminated data <<{0}"
+                .format(delim.decode().strip()))
+
+        size = int(line[5:])
+        data = self.inp.read(size)
+        if len(data) != size:
+            raise Exception("Truncated data")
+        return data
+
+    def store(self, fmt, data):
+        # The hex SHA of an object, which is only written the
+        # first time it is seen
+        sha = hashlib.sha1(fmt + b' ' + str(len(data)).encode()
+            + b'\x00')
+        sha.update(data)
+        binsha = sha.digest()
+        if binsha in self.seen:
+            self.duplicates += 1
+            return binsha.hex()
+        self.seen.add(binsha)
+
+        sha = binsha.hex()
+        if object_exists(self.repo, sha):
+            self.duplicates += 1
+        elif self.loose:
+            object_write(object_class(fmt)(self.repo, data))
+            self.counts[fmt] += 1
+        else:
+            self.writer.add(binsha, fmt, data)
+            self.counts[fmt] += 1
+        return sha
+
+    def read(self, sha):
+        # The type and contents of an object, which may be in
+        # the pack being written
+        binsha = bytes.fromhex(sha)
+        if self.writer is not None and binsha in self.writer.entries:
+            return self.writer.read(binsha)
+        return object_read_raw(self.repo, sha)
+
+    def mark(self, fields, sha):
+        for mark in fields.get(b'mark', ()):
+            self.marks[self.mark_number(mark)] = sha
+
+    def mark_number(self, mark):
+        if not mark.startswith(b':'):
+            raise Exception("Bad mark {0}".format(mark.decode()))
+        return int(mark[1:])
+
+    def dataref(self, ref):
+        # The hex SHA of a mark or of a full SHA
+        if ref.startswith(b':'):
+            try:
+                return self.marks[self.mark_number(ref)]
+            except KeyError:
+                raise Exception("Unknown mark {0}".format(
+                    ref.decode()))
+        if len(ref) != 40:
+            raise Exception("Bad object {0}".format(ref.decode()))
+        return ref.decode("ascii")
+
+    def commitish(self, ref):
+        # The hex SHA of the commit of a from or merge command
+        if ref.startswith(b':') or len(ref) == 40:
+            return self.dataref(ref)
+        name = ref.decode()
+        if name.endswith("^0"):
+            name = name[:-2]
+        branch = self.branches.get(name)
+        if branch and branch[1]:
+            return branch[1]
+        return object_find(self.repo, name, fmt=b'commit')
+
+    def tree_of(self, commit):
+        # A GitImportTree for the tree of a commit
+        if commit is None:
+            return GitImportTree(entries=dict())
+        tree = self.commits.get(commit)
+        if tree is None:
+            tree = commit_tree(self.repo, commit)
+        return GitImportTree(bytes.fromhex(tree))
+
+    def blob(self):
+        fields, line = self.fields((b'mark', b'original-oid'))
+        self.mark(fields, self.store(b'blob', self.data(line)))
+
+    def commit(self, ref):
+        fields, line = self.fields((b'mark', b'original-oid',
+            b'author', b'committer', b'encoding'))
+        if b'committer' not in fields:
+            raise Exception("Commit to {0} has no committer"
+                .format(ref))
+        message = self.data(line)
+
+        parents, line = self.fields((b'from', b'merge'))
+        root, head = self.branches.get(ref, (None, None))
+        if ref not in self.branches:
+            head = ref_resolve(self.repo, ref)
+        if b'from' in parents:
+            sha = self.commitish(parents[b'from'][0])
+            if sha == FAST_IMPORT_NULL_SHA:
+                sha = None
+            # Branching from the branch itself keeps its tree
+            if sha != head or root is None:
+                root = self.tree_of(sha)
+            head = sha
+        elif root is None:
+            root = self.tree_of(head)
+
+        while line is not None and self.change(root, line):
+            line = self.line()
+        self.pushback = line
+
+        commit = GitCommit(self.repo)
+        commit.kvlm = collections.OrderedDict()
+        tree = self.tree_write(root, top=True)
+        commit.kvlm[b'tree'] = tree.encode()
+        parents = ([ head ] if head else []) + \
+            [ self.commitish(m) for m in parents[b'merge'] ]
+        if parents:
+            commit.kvlm[b'parent'] = [ p.encode() for p in parents ]
+        commit.kvlm[b'author'] = (fields[b'author'] or
+                                  fields[b'committer'])[0]
+        commit.kvlm[b'committer'] = fields[b'committer'][0]
+        if b'encoding' in fields:
+            commit.kvlm[b'encoding'] = fields[b'encoding'][0]
+        commit.kvlm[b''] = message
+
+        sha = self.store(b'commit', commit.serialize())
+        self.commits[sha] = tree
+        self.branches[ref] = [ root, sha ]
+        self.mark(fields, sha)
+
+    def change(self, root, line):
+        # Apply a file command of a commit to root, returning
+        # False if line is no file command
+        if line == b'deleteall':
+            root.binsha = None
+            root.entries = dict()
+            return True
+
+        cmd, _, arg = line.partition(b' ')
+        if cmd == b'M':
+            mode, dataref, path = arg.split(b' ', 2)
+            path = fast_import_path(path)[0]
+            mode = { b'644': b'100644', b'755': b'100755',
+                     b'040000': b'40000' }.get(mode, mode)
+            if dataref == b'inline':
+                sha = self.store(b'blob', self.data(self.line()))
+            else:
+                sha = self.dataref(dataref)
+            if not path:
+                # A whole new tree
+                root.binsha = bytes.fromhex(sha)
+                root.entries = None
+            else:
+                self.tree_set(root, path.split(b'/'), mode,
+                    bytes.fromhex(sha))
+        elif cmd == b'D':
+            path = fast_import_path(arg)[0]
+            self.tree_set(root, path.split(b'/'), None, None)
+        elif cmd in (b'C', b'R'):
+            src, rest = fast_import_path(arg, last=False)
+            dst = fast_import_path(rest)[0]
+            entry = self.tree_get(root, src.split(b'/'))
+            if entry is None:
+                raise Exception("No such path {0}".format(
+                    src.decode(errors="replace")))
+            if cmd == b'R':
+                self.tree_set(root, src.split(b'/'), None, None)
+            self.tree_set(root, dst.split(b'/'), *entry)
+        elif cmd == b'N':
+            raise Exception("Notes are not supported")
+        else:
+            return False
+        return True
+
+    def tree_entries(self, node):
+        if node.entries is None:
+            fmt, raw = self.read(node.binsha.hex())
+            if fmt != b'tree':
+                raise Exception("{0} is no tree".format(
+                    node.binsha.hex()))
+            node.entries = { leaf.path: [ leaf.mode, leaf.binsha,
+                                          None ]
+                             for leaf in GitTree(self.repo, raw) }
+        return node.entries
+
+    def tree_get(self, node, parts):
+        # The mode and binary SHA at parts under node, or None
+        entries = self.tree_entries(node)
+        entry = entries.get(parts[0])
+        if entry is None:
+            return None
+        if len(parts) == 1:
+            if entry[2] is not None:
+                sha = self.tree_write(entry[2])
+                if sha is None:
+                    return None
+                entry[1] = bytes.fromhex(sha)
+            return entry[0], entry[1]
+        if not entry[0].startswith(b'4'):
+            return None
+        if entry[2] is None:
+            entry[2] = GitImportTree(entry[1])
+        return self.tree_get(entry[2], parts[1:])
+
+    def tree_set(self, node, parts, mode, binsha):
+        # Set the file at parts under node, or remove it if
+        # mode is None
+        entries = self.tree_entries(node)
+        name = parts[0]
+        if len(parts) == 1:
+            if mode is not None:
+                entries[name] = [ mode, binsha, None ]
+            elif entries.pop(name, None) is None:
+                return
+            node.binsha = None
+            return
+
+        entry = entries.get(name)
+        if entry is None or not entry[0].startswith(b'4'):
+            if mode is None:
+                return
+            entry = entries[name] = [ b'40000', None,
+                                      GitImportTree(entries=dict()) ]
+        elif entry[2] is None:
+            entry[2] = GitImportTree(entry[1])
+        node.binsha = None
+        self.tree_set(entry[2], parts[1:], mode, binsha)
+
+    def tree_write(self, node, top=False):
+        # The hex SHA of the tree of node, written if it
+        # changed.  Empty directories are left out, like Git
+        # does, and give None.
+        if node.binsha is not None:
+            return node.binsha.hex()
+
+        leaves = list()
+        for name, entry in list(node.entries.items()):
+            if entry[2] is not None:
+                sha = self.tree_write(entry[2])
+                if sha is None:
+                    del node.entries[name]
+                    continue
+                entry[1] = bytes.fromhex(sha)
+            leaves.append(GitTreeLeaf(entry[0], name, entry[1]))
+        if not leaves and not top:
+            return None
+
+        leaves.sort(key=tree_leaf_key)
+        sha = self.store(b'tree', tree_serialize(leaves))
+        node.binsha = bytes.fromhex(sha)
+        return sha
+
+    def tag(self, name):
+        fields, line = self.fields((b'mark', b'from',
+            b'original-oid', b'tagger'))
+        if b'from' not in fields:
+            raise Exception("Tag {0} has no from".format(name))
+        message = self.data(line)
+
+        target = self.commitish(fields[b'from'][0])
+        if target in self.commits:
+            fmt = b'commit'
+        else:
+            fmt = self.read(target)[0]
+
+        tag = GitTag(self.repo)
+        tag.kvlm = collections.OrderedDict()
+        tag.kvlm[b'object'] = target.encode()
+        tag.kvlm[b'type'] = fmt
+        tag.kvlm[b'tag'] = name.encode()
+        if b'tagger' in fields:
+            tag.kvlm[b'tagger'] = fields[b'tagger'][0]
+        tag.kvlm[b''] = message
+
+        sha = self.store(b'tag', tag.serialize())
+        self.tags[name] = sha
+        self.mark(fields, sha)
+
+    def reset(self, ref):
+        fields, self.pushback = self.fields((b'from',))
+        head = None
+        if b'from' in fields:
+            head = self.commitish(fields[b'from'][0])
+            if head == FAST_IMPORT_NULL_SHA:
+                head = None
+        self.branches[ref] = [ self.tree_of(head), head ]
+
+    def checkpoint(self, export_marks, last=False):
+        # Finish the pack and update the refs and the marks,
+        # starting another pack unless this is the end
+        if self.writer is not None:
+            if self.writer.entries:
+                self.writer.finish()
+                # Have the object index cover the pack
+                self.repo.oid_index = None
+                index = oid_index(self.repo)
+                if index:
+                    oid_index_merge(self.repo, index)
+            else:
+                self.writer.abort()
+            self.writer = None if last else GitPackWriter(self.repo)
+
+        for ref, (_, head) in self.branches.items():
+            if head:
+                self.update(ref, head)
+        for name, sha in self.tags.items():
+            ref_create(self.repo, "refs/tags/" + name, sha)
+
+        if export_marks:
+            fast_import_marks_write(export_marks, self.marks)
+
+    def update(self, ref, head):
+        # Move the branch ref to head, unless it would lose
+        # the commits of ref
+        old = ref_resolve(self.repo, ref)
+        if old == head:
+            return
+        if old and not self.force and \
+                not commit_is_ancestor(self.repo, old, head):
+            if ref not in self.refused:
+                sys.stderr.write("warning: Not updating {0} (new tip "
+                    "{1} does not contain {2})\n".format(ref, head, old))
+                self.refused.add(ref)
+            return
+        ref_create(self.repo, ref, head)
+        self.refused.discard(ref)
+
+def cmd_fast_import(args):
+    repo = repo_find()
+
+    imp = GitFastImport(repo, sys.stdin.buffer, loose=args.loose,
+        force=args.force)
+    marks = args.import_marks or args.import_marks_if_exists
+    if marks and (args.import_marks or os.path.exists(marks)):
+        imp.marks = fast_import_marks_read(marks)
+
+    start = time.perf_counter()
+    try:
+        imp.run(args.export_marks)
+    except BaseException:
+        if imp.writer is not None:
+            imp.writer.abort()
+        raise
+    elapsed = time.perf_counter() - start
+
+    if not args.quiet:
+        total = sum(imp.counts.values())
+        print("Imported {0} objects ({1} blobs, {2} trees, "
+              "{3} commits, {4} tags), {5} duplicates".format(
+                  total, imp.counts[b'blob'], imp.counts[b'tree'],
+                  imp.counts[b'commit'], imp.counts[b'tag'],
+                  imp.duplicates))
+        print("{0:.2f}s, {1:.0f} objects/s".format(elapsed,
+            total / elapsed if elapsed else 0))
+
+    if imp.refused:
+        sys.exit(1)
+
+# The path at the start of text, C-style quoted or not, and
+# what follows it.  An unquoted path runs to the end of text
+# if last, and to the first space otherwise.
+def fast_import_path(text, last=True):
+    if not text.startswith(b'"'):
+        if last:
+            return text, b''
+        path, _, rest = text.partition(b' ')
+        return path, rest
+
+    ret = bytearray()
+    i = 1
+    try:
+        while text[i] != ord('"'):
+            if text[i] != ord('\\'):
+                ret.append(text[i])
+                i += 1
+            elif text[i+1] in b'01234567':
+                ret.append(int(text[i+1:i+4], 8))
+                i += 4
+            else:
+                ret.append(FAST_IMPORT_ESCAPES[text[i+1]])
+                i += 2
+    except (IndexError, KeyError, ValueError):
+        raise Exception("Bad quoted path {0}".format(
+            text.decode(errors="replace")))
+    return bytes(ret), text[i+1:].lstrip(b' ')
+
+# Marks files have a ":mark sha" line per mark, like Git's
+def fast_import_marks_read(path):
+    marks = dict()
+    with open(path) as f:
+        for line in f:
+            mark, sha = line.split()
+            marks[int(mark.lstrip(":"))] = sha
+    return marks
+
+def fast_import_marks_write(path, marks):
+    with open(path + ".lock", "w") as f:
+        for mark in sorted(marks):
+            f.write(":{0} {1}\n".format(mark, marks[mark]))
+    os.rename(path + ".lock", path)
+
+# }}
+
 # }}}
 
 # Main Function {{{
@@ -918,20 +7369,46 @@ def main(argv=sys.argv[1:]):
     # Get arguments
     args = argparser.parse_args(argv)
 
+    # Tracing starts before anything is read.  The
+    # variables are looked up now rather than when the parser
+    # is built, as the daemon runs commands for clients with
+    # their own environment.
+    trace = args.trace_perf or os.environ.get("PVC_TRACE_PERF")
+    chrome = (args.trace_perf_format or os.environ.get(
+        "PVC_TRACE_PERF_FORMAT", "summary")) == "chrome"
+    if trace:
+        perf_enable(chrome)
+
     # Call appropriate function based on command
-    if   args.command == "add"        : cmd_add(args)
-    elif args.command == "cat-file"   : cmd_cat_file(args)
-    elif args.command == "checkout"   : cmd_checkout(args)
-    elif args.command == "commit"     : cmd_commit(args)
-    elif args.command == "hash-object": cmd_hash_obj(args)
-    elif args.command == "init"       : cmd_init(args)
-    elif args.command == "log"        : cmd_log(args)
-    elif args.command == "ls-tree"    : cmd_ls_tree(args)
-    elif args.command == "merge"      : cmd_merge(args)
-    elif args.command == "rebase"     : cmd_rebase(args)
-    elif args.command == "rev-parse"  : cmd_rev_parse(args)
-    elif args.command == "rm"         : cmd_rm(args)
-    elif args.command == "show-ref"   : cmd_show_ref(args)
-    elif args.command == "tag"        : cmd_tag(args)
+    try:
+        if   args.command == "add"        : cmd_add(args)
+        elif args.command == "bench"      : cmd_bench(args)
+        elif args.command == "cat-file"   : cmd_cat_file(args)
+        elif args.command == "checkout"   : cmd_checkout(args)
+        elif args.command == "commit"     : cmd_commit(args)
+        elif args.command == "commit-graph": cmd_commit_graph(args)
+        elif args.command == "daemon"     : cmd_daemon(args)
+        elif args.command == "diff-tree"  : cmd_diff_tree(args)
+        elif args.command == "fast-import": cmd_fast_import(args)
+        elif args.command == "gc"         : cmd_repack(args)
+        elif args.command == "hash-object": cmd_hash_object(args)
+        elif args.command == "init"       : cmd_init(args)
+        elif args.command == "log"        : cmd_log(args)
+        elif args.command == "ls-tree"    : cmd_ls_tree(args)
+        elif args.command == "merge"      : cmd_merge(args)
+        elif args.command == "oid-index"  : cmd_oid_index(args)
+        elif args.command == "pack-refs"  : cmd_pack_refs(args)
+        elif args.command == "rebase"     : cmd_rebase(args)
+        elif args.command == "repack"     : cmd_repack(args)
+        elif args.command == "rev-parse"  : cmd_rev_parse(args)
+        elif args.command == "rm"         : cmd_rm(args)
+        elif args.command == "show-ref"   : cmd_show_ref(args)
+        elif args.command == "status"     : cmd_status(args)
+        elif args.command == "tag"        : cmd_tag(args)
+        elif args.command == "write-tree" : cmd_write_tree(args)
+    finally:
+        if trace:
+            perf_write(trace, chrome, argv)
+            perf_disable()
 
 # }}}
@@ -0,0 +1,38 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+# Git and pvc both run with a fixed identity and dates, and
+# without the configuration of whoever runs the tests
+@pytest.fixture(autouse=True)
+def environment(tmp_path, monkeypatch):
+    if shutil.which("git") is None:
+        pytest.skip("git is not installed")
+
+    home = tmp_path / "home"
+    home.mkdir()
+    (home / ".gitconfig").write_text(
+        "[user]\n"
+        "name = Test\n"
+        "email = test@example.com\n"
+        "[init]\n"
+        "defaultBranch = master\n"
+        "[gc]\n"
+        "auto = 0\n")
+    monkeypatch.setenv("HOME", str(home))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(home / ".config"))
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    for who in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv("GIT_{0}_NAME".format(who), "Test")
+        monkeypatch.setenv("GIT_{0}_EMAIL".format(who),
+            "test@example.com")
+        monkeypatch.setenv("GIT_{0}_DATE".format(who),
+            "1500000000 +0000")
+    for var in ("PVC_DAEMON", "PVC_TRACE_PERF",
+                "PVC_TRACE_PERF_FORMAT"):
+        monkeypatch.delenv(var, raising=False)
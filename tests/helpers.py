@@ -0,0 +1,68 @@
+# Running git and pvc on scratch repositories, so that what
+# pvc reads and writes can be checked against Git itself.
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PVC = os.path.join(ROOT, "pvc")
+
+def git(cwd, *args, input=None, check=True):
+    return subprocess.run([ "git" ] + list(args), cwd=cwd,
+        input=input, stdout=subprocess.PIPE, check=check).stdout
+
+def pvc(cwd, *args, input=None, check=True):
+    return subprocess.run([ sys.executable, PVC ] + list(args),
+        cwd=cwd, input=input, stdout=subprocess.PIPE,
+        check=check).stdout
+
+def write(path, data, mode=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data.encode() if isinstance(data, str) else data)
+    if mode is not None:
+        os.chmod(path, mode)
+
+# The objects of a repository according to Git, as a dict
+# from SHAs to (type, contents)
+def git_objects(cwd):
+    out = git(cwd, "cat-file", "--batch-all-objects", "--batch")
+    ret = dict()
+    pos = 0
+    while pos < len(out):
+        end = out.index(b'\n', pos)
+        sha, fmt, size = out[pos:end].split()
+        start = end + 1
+        ret[sha.decode()] = (fmt, out[start:start + int(size)])
+        pos = start + int(size) + 1
+    return ret
+
+# A Git repository at path with a few commits that each
+# change a little of many similar files, which makes for
+# deltas once packed, and an annotated tag
+def make_history(path, commits=6, files=8):
+    git(None, "init", "-q", path)
+    for rev in range(commits):
+        for i in range(files):
+            write(os.path.join(path, "src", "f{0}.txt".format(i)),
+                "".join("line {0} of file {1}\n".format(j, i)
+                        for j in range(200))
+                + "revision {0}\n".format(rev))
+        write(os.path.join(path, "README"),
+            "revision {0}\n".format(rev))
+        git(path, "add", "-A")
+        git(path, "commit", "-q", "-m", "Revision {0}".format(rev))
+    git(path, "tag", "-a", "v1", "-m", "Version 1")
+
+# A worktree at path with names which sort differently as
+# files and as directories, an executable, a symbolic link
+# and an empty file
+def make_worktree(path):
+    git(None, "init", "-q", path)
+    for name in ("a", "a.b", "a-b", "a0/x", "ab/y", "b/c/d/e.txt",
+                 "b/c.txt", "empty"):
+        write(os.path.join(path, name),
+            "" if name == "empty" else name + "\n")
+    write(os.path.join(path, "run.sh"), "#!/bin/sh\n", mode=0o755)
+    os.symlink("a.b", os.path.join(path, "link"))
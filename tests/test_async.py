@@ -0,0 +1,22 @@
+import asyncio
+
+import libpvc
+from helpers import git, make_history
+
+def test_write_object_leaves_obj_alone(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=1, files=1)
+    other = libpvc.repo_create(str(tmp_path / "other"))
+    blob = libpvc.GitBlob(other, b'hello\n')
+
+    async def write():
+        async with libpvc.AsyncRepository(path) as repo:
+            sha = await repo.write_object(blob)
+            assert (await repo.read_object(sha)).blobdata == b'hello\n'
+            return sha
+
+    sha = asyncio.run(write())
+    assert blob.repo is other
+    assert git(path, "cat-file", "blob", sha) == b'hello\n'
+    assert sha == git(path, "hash-object", "--stdin",
+        input=b'hello\n').decode().strip()
@@ -0,0 +1,87 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import libpvc
+from helpers import PVC, git, pvc, write
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    path = str(tmp_path / "pvc.sock")
+    proc = subprocess.Popen([ sys.executable, PVC, "daemon",
+        "--socket", path ], stdout=subprocess.PIPE)
+    try:
+        assert proc.stdout.readline().startswith(b'Listening')
+        monkeypatch.setenv("PVC_DAEMON", path)
+        yield path
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def test_commands_match_git(tmp_path, daemon):
+    path = str(tmp_path / "repo")
+    git(None, "init", "-q", path)
+    write(os.path.join(path, "f"), "f\n")
+    git(path, "add", "f")
+    git(path, "commit", "-q", "-m", "First")
+
+    for _ in range(2):
+        assert pvc(path, "ls-tree", "-r", "HEAD") \
+            == git(path, "ls-tree", "-r", "HEAD")
+
+# A client that doesn't read what it asked for holds the
+# others up until its command is stopped, no longer
+def test_stalled_client(tmp_path, daemon):
+    path = str(tmp_path / "repo")
+    git(None, "init", "-q", path)
+    write(os.path.join(path, "big"), os.urandom(16 << 20))
+    sha = git(path, "hash-object", "-w", "big").decode().strip()
+
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        stalled.connect(daemon)
+        stalled.sendall(json.dumps({ "argv": [ "cat-file", "blob",
+            sha ], "cwd": path, "env": dict(os.environ) }).encode()
+            + b'\n')
+        start = time.monotonic()
+        assert subprocess.run([ sys.executable, PVC, "cat-file",
+            "-t", sha ], cwd=path, stdout=subprocess.PIPE,
+            timeout=30, check=True).stdout == b'blob\n'
+        assert time.monotonic() - start \
+            < libpvc.DAEMON_SEND_TIMEOUT + 5
+    finally:
+        stalled.close()
+
+def test_socket_is_private(daemon):
+    assert os.stat(daemon).st_mode & 0o077 == 0
+
+@pytest.mark.skipif(not hasattr(socket, "SO_PEERCRED"),
+    reason="no SO_PEERCRED")
+def test_other_users_are_refused(monkeypatch):
+    a, b = socket.socketpair()
+    with a, b:
+        assert libpvc.daemon_peer_allowed(a)
+        uid = os.getuid()
+        monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+        assert not libpvc.daemon_peer_allowed(a)
+
+# A client that doesn't read gets its command stopped once a
+# bounded number of frames waits for it
+def test_frames_are_bounded(monkeypatch):
+    monkeypatch.setattr(libpvc, "DAEMON_SEND_TIMEOUT", 0.2)
+    a, b = socket.socketpair()
+    with b:
+        sender = libpvc.GitDaemonSender(a)
+        frame = b'x' * 65536
+        with pytest.raises(BrokenPipeError):
+            for sent in range(1000):
+                sender.send(1, frame)
+        assert sent < libpvc.DAEMON_SEND_FRAMES + 64
+        sender.close()
+        sender.thread.join(5)
+        assert not sender.thread.is_alive()
@@ -0,0 +1,47 @@
+import os
+import shutil
+
+import pytest
+
+from helpers import git, pvc, write
+
+@pytest.fixture
+def history(tmp_path):
+    path = str(tmp_path / "repo")
+    git(None, "init", "-q", path)
+    for name in ("kept", "changed", "removed", "to-exec", "t",
+                 "dir/a", "dir/sub/b", "gone/c"):
+        write(os.path.join(path, name), name + "\n")
+    os.symlink("kept", os.path.join(path, "link"))
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "First")
+
+    write(os.path.join(path, "changed"), "new\n")
+    os.unlink(os.path.join(path, "removed"))
+    os.chmod(os.path.join(path, "to-exec"), 0o755)
+    # A file which becomes a directory, and the other way
+    os.unlink(os.path.join(path, "t"))
+    write(os.path.join(path, "t", "x"), "x\n")
+    shutil.rmtree(os.path.join(path, "gone"))
+    write(os.path.join(path, "gone"), "file\n")
+    write(os.path.join(path, "dir", "sub", "b"), "b2\n")
+    write(os.path.join(path, "dir", "new"), "new\n")
+    os.unlink(os.path.join(path, "link"))
+    os.symlink("changed", os.path.join(path, "link"))
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "Second")
+    return path
+
+@pytest.mark.parametrize("args", [ [], [ "-r" ] ])
+def test_trees_match_git(history, args):
+    old = git(history, "rev-parse", "HEAD^").decode().strip()
+    new = git(history, "rev-parse", "HEAD").decode().strip()
+    assert pvc(history, "diff-tree", *args, old, new) \
+        == git(history, "diff-tree", *args, old, new)
+    assert pvc(history, "diff-tree", *args, new, old) \
+        == git(history, "diff-tree", *args, new, old)
+
+def test_commit_against_parent_matches_git(history):
+    new = git(history, "rev-parse", "HEAD").decode().strip()
+    assert pvc(history, "diff-tree", "-r", new) \
+        == git(history, "diff-tree", "-r", new)
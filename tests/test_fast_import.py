@@ -0,0 +1,190 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from helpers import PVC, git, git_objects, make_history, pvc
+
+# Marks, quoted paths, inline data, copies and renames, a
+# merge, a tag, a reset, deleteall and a checkpoint
+EDGE = (
+    b'feature done\n'
+    b'blob\n'
+    b'mark :1\n'
+    b'data 6\n'
+    b'hello\n'
+    b'\n'
+    b'blob\n'
+    b'mark :2\n'
+    b'data <<END\n'
+    b'multi\n'
+    b'line\n'
+    b'END\n'
+    b'\n'
+    b'# a comment\n'
+    b'commit refs/heads/main\n'
+    b'mark :10\n'
+    b'author A U <a@u> 1700000000 +0100\n'
+    b'committer C <c@c> 1700000001 -0230\n'
+    b'data 5\n'
+    b'init\n'
+    b'M 100644 :1 a/b/c.txt\n'
+    b'M 755 :2 "sp ace/q\\"uo\\\\te\\303\\251.sh"\n'
+    b'M 120000 inline link\n'
+    b'data 8\n'
+    b'a/b/c.tx\n'
+    b'M 644 :1 top\n'
+    b'\n'
+    b'commit refs/heads/main\n'
+    b'mark :11\n'
+    b'committer C <c@c> 1700000002 +0000\n'
+    b'data 3\n'
+    b'cp\n'
+    b'C a/b "x y/z"\n'
+    b'R top a/b/moved\n'
+    b'D "sp ace/q\\"uo\\\\te\\303\\251.sh"\n'
+    b'\n'
+    b'checkpoint\n'
+    b'\n'
+    b'commit refs/heads/side\n'
+    b'mark :12\n'
+    b'committer C <c@c> 1700000003 +0000\n'
+    b'data 5\n'
+    b'side\n'
+    b'from :10\n'
+    b'D a/b/c.txt\n'
+    b'M 100644 :2 new\n'
+    b'\n'
+    b'commit refs/heads/main\n'
+    b'mark :13\n'
+    b'committer C <c@c> 1700000004 +0000\n'
+    b'data 6\n'
+    b'merge\n'
+    b'merge :12\n'
+    b'M 100644 :1 m\n'
+    b'\n'
+    b'tag v1\n'
+    b'from :13\n'
+    b'tagger T <t@t> 1700000005 +0000\n'
+    b'data 4\n'
+    b'tag\n'
+    b'\n'
+    b'reset refs/heads/empty\n'
+    b'from :11\n'
+    b'\n'
+    b'commit refs/heads/wipe\n'
+    b'committer C <c@c> 1700000006 +0000\n'
+    b'data 5\n'
+    b'wipe\n'
+    b'from refs/heads/main\n'
+    b'deleteall\n'
+    b'M 100644 :2 only\n'
+    b'\n'
+    b'progress done here\n'
+    b'done\n'
+)
+
+def refs(path):
+    return git(path, "show-ref", "--head", check=False)
+
+def import_both(tmp_path, stream, *args):
+    ours = str(tmp_path / "ours")
+    theirs = str(tmp_path / "theirs")
+    for path in (ours, theirs):
+        git(None, "init", "-q", path)
+    out = pvc(ours, "fast-import", *args, "--export-marks",
+        os.path.join(ours, ".git", "marks"), input=stream)
+    git(theirs, "fast-import", "--quiet", "--export-marks="
+        + os.path.join(theirs, ".git", "marks"), input=stream)
+    return ours, theirs, out
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+@pytest.mark.parametrize("args", [ [], [ "--loose" ] ])
+def test_edge_cases_match_git(tmp_path, args):
+    ours, theirs, out = import_both(tmp_path, EDGE, *args)
+    assert b'progress done here' in out
+    assert refs(ours) == refs(theirs)
+    assert read(os.path.join(ours, ".git", "marks")) \
+        == read(os.path.join(theirs, ".git", "marks"))
+    assert git_objects(ours) == git_objects(theirs)
+    git(ours, "fsck", "--strict", "--full")
+
+def test_fast_export_round_trip(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path)
+    stream = git(path, "fast-export", "--all")
+
+    ours, theirs, _ = import_both(tmp_path, stream)
+    assert refs(ours) == refs(path)
+    assert refs(theirs) == refs(path)
+    assert git_objects(ours) == git_objects(theirs)
+
+    # Everything is known already the second time
+    out = pvc(ours, "fast-import", input=stream)
+    assert out.startswith(b'Imported 0 objects')
+
+def test_resume_with_marks(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path)
+    marks = str(tmp_path / "marks")
+    first = git(path, "fast-export", "--export-marks=" + marks,
+        "master~3")
+    second = git(path, "fast-export", "--import-marks=" + marks,
+        "--all")
+
+    ours = str(tmp_path / "ours")
+    git(None, "init", "-q", ours)
+    ours_marks = os.path.join(ours, ".git", "marks")
+    pvc(ours, "fast-import", "--export-marks", ours_marks,
+        input=first)
+    pvc(ours, "fast-import", "--import-marks", ours_marks,
+        input=second)
+    assert refs(ours) == refs(path)
+    git(ours, "fsck", "--strict")
+
+def import_into(path, stream, *args):
+    return subprocess.run([ sys.executable, PVC, "fast-import",
+        "--quiet" ] + list(args), cwd=path, input=stream,
+        stderr=subprocess.PIPE)
+
+# No from: the branch goes on from the commit it has
+def test_existing_branch_continues(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=2, files=2)
+    old = git(path, "rev-parse", "master").decode().strip()
+
+    assert import_into(path, b'commit refs/heads/master\n'
+        b'committer C <c@c> 1700000000 +0000\n'
+        b'data 5\nnext\nM 100644 inline new\ndata 4\nnew\n\n'
+        ).returncode == 0
+    assert git(path, "rev-parse", "master^").decode().strip() == old
+    assert git(path, "ls-tree", "-r", "--name-only", "master") \
+        == b'README\nnew\nsrc/f0.txt\nsrc/f1.txt\n'
+    git(path, "fsck", "--strict")
+
+# A branch restarted by reset would lose its history
+def test_non_fast_forward_is_refused(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=2, files=2)
+    old = git(path, "rev-parse", "master")
+    stream = (b'reset refs/heads/master\n'
+              b'commit refs/heads/master\n'
+              b'committer C <c@c> 1700000000 +0000\n'
+              b'data 5\nroot\nM 100644 inline new\ndata 4\nnew\n\n'
+              b'commit refs/heads/other\n'
+              b'committer C <c@c> 1700000000 +0000\n'
+              b'data 6\nother\nM 100644 inline o\ndata 2\no\n\n')
+
+    proc = import_into(path, stream)
+    assert proc.returncode == 1
+    assert b'Not updating refs/heads/master' in proc.stderr
+    assert git(path, "rev-parse", "master") == old
+    assert git(path, "ls-tree", "--name-only", "other") == b'o\n'
+
+    assert import_into(path, stream, "--force").returncode == 0
+    assert git(path, "rev-list", "master") \
+        == git(path, "rev-parse", "master")
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+import libpvc
+from helpers import git, pvc, write
+
+@pytest.mark.parametrize("size", [ 0, 1000, 3 << 20 ])
+def test_hash_object_matches_git(tmp_path, size):
+    path = str(tmp_path / "repo")
+    git(None, "init", "-q", path)
+    data = os.urandom(size)
+    write(os.path.join(path, "f"), data)
+
+    sha = pvc(path, "hash-object", "-w", "f")
+    assert sha == git(path, "hash-object", "f")
+    assert git(path, "cat-file", "blob", sha.decode().strip()) == data
+
+# An object the repository has is neither compressed nor
+# written again, however large
+def test_known_large_file_is_not_written(tmp_path, monkeypatch):
+    repo = libpvc.repo_create(str(tmp_path / "repo"))
+    path = os.path.join(repo.worktree, "f")
+    write(path, os.urandom(3 << 20))
+    sha = libpvc.object_hash_file(path, b'blob', repo)
+
+    def fail(*args):
+        raise AssertionError("compressed again")
+    monkeypatch.setattr(libpvc, "object_tempfile", fail)
+    monkeypatch.setattr(libpvc, "perf_compress", fail)
+    assert libpvc.object_hash_file(path, b'blob', repo) == sha
@@ -0,0 +1,48 @@
+import os
+
+from helpers import git, make_worktree, pvc, write
+
+def test_add_matches_git(tmp_path):
+    path = str(tmp_path / "repo")
+    make_worktree(path)
+
+    pvc(path, "add", ".")
+    ours = git(path, "ls-files", "-s")
+    git(path, "diff-files", "--quiet")
+
+    os.unlink(os.path.join(path, ".git", "index"))
+    git(path, "add", "-A")
+    assert git(path, "ls-files", "-s") == ours
+
+def test_add_updates_git_index(tmp_path):
+    path = str(tmp_path / "repo")
+    make_worktree(path)
+    git(path, "add", "-A")
+
+    write(os.path.join(path, "a"), "changed\n")
+    write(os.path.join(path, "new/file"), "new\n")
+    pvc(path, "add", "a", "new")
+    ours = git(path, "ls-files", "-s")
+
+    git(path, "add", "-A")
+    assert git(path, "ls-files", "-s") == ours
+
+def test_rm_matches_git(tmp_path):
+    path = str(tmp_path / "repo")
+    make_worktree(path)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "First")
+
+    pvc(path, "rm", "a.b")
+    pvc(path, "rm", "--cached", "run.sh")
+    pvc(path, "rm", "-r", "b")
+    ours = git(path, "ls-files", "-s")
+    assert not os.path.exists(os.path.join(path, "a.b"))
+    assert not os.path.exists(os.path.join(path, "b"))
+    assert os.path.exists(os.path.join(path, "run.sh"))
+
+    git(path, "reset", "-q", "--hard")
+    git(path, "rm", "-q", "a.b")
+    git(path, "rm", "-q", "--cached", "run.sh")
+    git(path, "rm", "-q", "-r", "b")
+    assert git(path, "ls-files", "-s") == ours
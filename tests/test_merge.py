@@ -0,0 +1,90 @@
+import os
+import shutil
+
+import pytest
+
+from helpers import git, pvc, write
+
+LINES = "".join("line {0}\n".format(i) for i in range(20))
+
+# master and theirs both change from base: conflict.txt on
+# the same line, and other files without overlapping
+@pytest.fixture
+def branches(tmp_path):
+    path = str(tmp_path / "repo")
+    git(None, "init", "-q", path)
+    for name in ("conflict.txt", "both.txt", "ours.txt", "theirs.txt"):
+        write(os.path.join(path, name), LINES)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "Base")
+
+    git(path, "checkout", "-q", "-b", "theirs")
+    write(os.path.join(path, "conflict.txt"),
+        LINES.replace("line 5\n", "theirs 5\n"))
+    write(os.path.join(path, "both.txt"),
+        LINES.replace("line 18\n", "theirs 18\n"))
+    write(os.path.join(path, "theirs.txt"), LINES + "theirs\n")
+    write(os.path.join(path, "added.txt"), "added\n")
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "Theirs")
+
+    git(path, "checkout", "-q", "-b", "clean", "master")
+    write(os.path.join(path, "ours.txt"), "clean\n" + LINES)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "Clean")
+
+    git(path, "checkout", "-q", "master")
+    write(os.path.join(path, "conflict.txt"),
+        LINES.replace("line 5\n", "ours 5\n"))
+    write(os.path.join(path, "both.txt"),
+        LINES.replace("line 1\n", "ours 1\n"))
+    os.unlink(os.path.join(path, "ours.txt"))
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "Ours")
+    return path
+
+def test_clean_merge_tree_matches_git(branches):
+    tree = git(branches, "merge-tree", "--write-tree", "clean",
+        "theirs").split(b'\n')[0]
+    git(branches, "checkout", "-q", "clean")
+    assert pvc(branches, "merge", "theirs").strip() == tree
+
+def test_conflict_stages_match_git(branches, tmp_path):
+    other = str(tmp_path / "other")
+    shutil.copytree(branches, other, symlinks=True)
+
+    out = pvc(branches, "merge", "--apply", "theirs")
+    assert b'CONFLICT (content): conflict.txt' in out
+    git(other, "merge", "-q", "theirs", check=False)
+
+    assert git(branches, "ls-files", "-s") == git(other, "ls-files", "-s")
+    for name in ("conflict.txt", "both.txt", "theirs.txt",
+                 "added.txt"):
+        with open(os.path.join(branches, name), "rb") as f, \
+                open(os.path.join(other, name), "rb") as g:
+            assert f.read() == g.read()
+    assert not os.path.exists(os.path.join(branches, "ours.txt"))
+    with open(os.path.join(branches, ".git", "MERGE_HEAD")) as f:
+        assert f.read().strip() == git(branches, "rev-parse",
+            "theirs").decode().strip()
+
+def test_commit_concludes_merge(branches):
+    pvc(branches, "merge", "--apply", "theirs")
+    write(os.path.join(branches, "conflict.txt"), "resolved\n")
+    pvc(branches, "add", "conflict.txt")
+    pvc(branches, "commit", "-m", "Merge theirs")
+
+    parents = git(branches, "log", "-1", "--format=%P").split()
+    assert parents == [ git(branches, "rev-parse", rev).strip()
+                        for rev in ("HEAD^1", "theirs") ]
+    assert git(branches, "status", "--porcelain") == b''
+    git(branches, "fsck", "--strict")
+
+def test_merge_base_matches_git(branches):
+    import libpvc
+    repo = libpvc.repo_find(branches)
+    for a, b in (("master", "theirs"), ("clean", "theirs"),
+                 ("master", "clean")):
+        shas = [ libpvc.object_find(repo, r) for r in (a, b) ]
+        assert sorted(libpvc.merge_base(repo, *shas)) == sorted(
+            git(branches, "merge-base", "--all", a, b).decode().split())
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import time
+
+import libpvc
+from helpers import git, git_objects, make_history, pvc
+
+# Two blobs whose SHAs start with the same four digits
+def colliding_blobs():
+    seen = dict()
+    i = 0
+    while True:
+        data = "blob {0}\n".format(i).encode()
+        sha = hashlib.sha1(b'blob %d\x00' % len(data)
+            + data).hexdigest()
+        if sha[:4] in seen:
+            return seen[sha[:4]], data, sha[:4]
+        seen[sha[:4]] = data
+        i += 1
+
+def test_prefix_sees_objects_written_by_git(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=2, files=2)
+    first, second, prefix = colliding_blobs()
+    git(path, "hash-object", "-w", "--stdin", input=first)
+    git(path, "gc", "-q")
+    pvc(path, "oid-index", "write")
+
+    # Written behind the back of the index
+    sha = git(path, "hash-object", "-w", "--stdin",
+        input=second).decode().strip()
+    repo = libpvc.repo_find(path)
+    assert libpvc.oid_index(repo)
+    assert len(libpvc.object_resolve(repo, prefix)) == 2
+    assert libpvc.object_resolve(repo, sha[:12]) == [ sha ]
+
+def test_stale_lock_is_broken(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=2, files=2)
+    repo = libpvc.repo_find(path)
+    lock = os.path.join(path, ".git", "objects", "info",
+        "pvc-oid-index.lock")
+    os.makedirs(os.path.dirname(lock), exist_ok=True)
+    open(lock, "wb").close()
+
+    assert libpvc.oid_index_write(repo) is None
+    old = time.time() - libpvc.OID_INDEX_LOCK_STALE - 1
+    os.utime(lock, (old, old))
+    assert libpvc.oid_index_write(repo)
+    assert not os.path.exists(lock)
+
+# Writing objects costs the table nothing, and they are
+# found by listing the directories they went to
+def test_writes_leave_the_table_alone(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=2, files=2)
+    repo = libpvc.repo_find(path)
+    libpvc.oid_index_write(repo)
+    table = os.path.join(path, ".git", "objects", "info",
+        "pvc-oid-index")
+    before = os.stat(table)
+
+    shas = [ libpvc.object_write(libpvc.GitBlob(repo,
+                 "{0}\n".format(i).encode()))
+             for i in range(10) ]
+    after = os.stat(table)
+    assert (after.st_mtime_ns, after.st_size) \
+        == (before.st_mtime_ns, before.st_size)
+    assert os.listdir(os.path.dirname(table)) == [ "pvc-oid-index" ]
+    for sha in shas:
+        assert libpvc.object_resolve(repo, sha[:10]) == [ sha ]
+
+    # Merging brings the table up to date
+    libpvc.oid_index_merge(repo, libpvc.oid_index(repo))
+    index = libpvc.oid_index(repo)
+    for sha in shas:
+        assert index.lookup(bytes.fromhex(sha)) \
+            == libpvc.OID_INDEX_LOOSE
+
+# Directories that didn't change since the table was written
+# aren't listed, those that did are
+def test_lookups_bisect_the_table(tmp_path, monkeypatch):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=2, files=2)
+    git(path, "hash-object", "-w", "--stdin", input=b'gone\n')
+    repo = libpvc.repo_find(path)
+    time.sleep(0.01)
+    libpvc.oid_index_write(repo)
+    shas = list(git_objects(path))
+
+    listed = list()
+    listdir = os.listdir
+    def counted(path):
+        listed.append(path)
+        return listdir(path)
+    monkeypatch.setattr(os, "listdir", counted)
+    for sha in shas:
+        assert libpvc.object_resolve(repo, sha[:8]) == [ sha ]
+    assert listed == []
+
+    gone = git(path, "hash-object", "--stdin",
+        input=b'gone\n').decode().strip()
+    os.unlink(os.path.join(path, ".git", "objects", gone[:2],
+        gone[2:]))
+    assert libpvc.object_resolve(repo, gone[:8]) == []
+    assert listed == [ os.path.join(path, ".git", "objects",
+        gone[:2]) ]
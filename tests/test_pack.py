@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+import libpvc
+from helpers import git, git_objects, make_history, pvc, write
+
+# Objects in packs Git wrote, with offset deltas (the
+# default) or deltas naming their base by SHA
+@pytest.mark.parametrize("offset", [ "true", "false" ])
+def test_read_git_pack(tmp_path, offset):
+    path = str(tmp_path / "repo")
+    make_history(path)
+    git(path, "-c", "repack.useDeltaBaseOffset=" + offset,
+        "repack", "-a", "-d", "-f", "-q")
+    assert b'count: 0' in git(path, "count-objects", "-v")
+
+    idx = [ f for f in os.listdir(os.path.join(path, ".git",
+                "objects", "pack")) if f.endswith(".idx") ]
+    verify = git(path, "verify-pack", "-v",
+        os.path.join(path, ".git", "objects", "pack", idx[0]))
+    assert b'chain length' in verify
+
+    repo = libpvc.repo_find(path)
+    for sha, (fmt, data) in git_objects(path).items():
+        assert libpvc.object_read_raw(repo, sha) == (fmt, data)
+        assert libpvc.object_header(repo, sha) == (fmt, len(data))
+        fmt2, size, chunks = libpvc.object_stream(repo, sha)
+        assert (fmt2, size) == (fmt, len(data))
+        assert b''.join(chunks) == data
+
+def test_short_hashes_in_pack(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=2, files=2)
+    git(path, "gc", "-q")
+
+    head = git(path, "rev-parse", "HEAD").decode().strip()
+    assert pvc(path, "rev-parse", head[:7]).decode().strip() == head
+
+# A window sliding over the lines of a file makes each
+# revision closest to the next, hence long delta chains.
+# Each object is parsed as well as read.
+def test_deep_delta_chains(tmp_path):
+    path = str(tmp_path / "repo")
+    git(None, "init", "-q", path)
+    for rev in range(40):
+        write(os.path.join(path, "f"), "".join("line {0}\n".format(i)
+            for i in range(rev * 10, rev * 10 + 300)))
+        git(path, "add", "f")
+        git(path, "commit", "-q", "-m", "Revision {0}".format(rev))
+    git(path, "repack", "-a", "-d", "-f", "-q", "--depth=50",
+        "--window=50")
+    pack = os.path.join(path, ".git", "objects", "pack")
+    idx = [ f for f in os.listdir(pack) if f.endswith(".idx") ]
+    verify = git(path, "verify-pack", "-v", os.path.join(pack, idx[0]))
+    depths = [ int(line.split(b'=')[1].split(b':')[0])
+               for line in verify.split(b'\n')
+               if line.startswith(b'chain length = ') ]
+    assert max(depths) >= 20
+
+    repo = libpvc.repo_find(path)
+    for sha, (fmt, data) in git_objects(path).items():
+        obj = libpvc.object_read(repo, sha)
+        assert obj.fmt == fmt
+        assert obj.serialize() == data
@@ -0,0 +1,33 @@
+import json
+import os
+
+from helpers import git, make_history, pvc, write
+
+def trace(path, *args):
+    out = os.path.join(path, "perf.json")
+    pvc(path, "--trace-perf", out, *args)
+    with open(out) as f:
+        return json.load(f)["stats"]
+
+# The compressed bytes counted are those on disk
+def test_hash_object_counts_zlib(tmp_path):
+    path = str(tmp_path / "repo")
+    git(None, "init", "-q", path)
+    write(os.path.join(path, "f"),
+        "".join("{0}\n".format(i) for i in range(5000)))
+
+    stats = trace(path, "hash-object", "-w", "f")
+    sha = git(path, "hash-object", "f").decode().strip()
+    loose = os.path.join(path, ".git", "objects", sha[:2], sha[2:])
+    assert stats["zlib.compress"]["compressed"] \
+        == os.path.getsize(loose)
+
+def test_cat_file_counts_zlib(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path)
+    git(path, "gc", "-q")
+
+    sha = git(path, "rev-parse", "HEAD:src/f0.txt").decode().strip()
+    stats = trace(path, "cat-file", "blob", sha)
+    size = len(git(path, "cat-file", "blob", sha))
+    assert stats["zlib.decompress"]["inflated"] >= size
@@ -0,0 +1,30 @@
+import os
+import shutil
+
+import libpvc
+from helpers import git, make_history, pvc
+
+def test_show_ref_matches_git(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=2, files=1)
+    git(path, "branch", "topic")
+    git(path, "pack-refs", "--all")
+    git(path, "branch", "loose")
+    assert pvc(path, "show-ref") == git(path, "show-ref")
+
+# The locks of refs being written, or left by a crash
+def test_locks_are_no_refs(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path, commits=2, files=1)
+    heads = os.path.join(path, ".git", "refs", "heads")
+    shutil.copy(os.path.join(heads, "master"),
+        os.path.join(heads, "master.lock"))
+
+    assert b'.lock' not in pvc(path, "show-ref")
+    assert not any(stamp[0].endswith(".lock")
+                   for stamp in libpvc.daemon_stamps(path)["refs"][2:])
+
+    pvc(path, "pack-refs", "--all")
+    assert os.path.exists(os.path.join(heads, "master.lock"))
+    os.unlink(os.path.join(heads, "master.lock"))
+    assert pvc(path, "show-ref") == git(path, "show-ref")
@@ -0,0 +1,35 @@
+import hashlib
+import os
+
+import libpvc
+from helpers import git, git_objects, make_history, pvc
+
+def test_repack_is_valid_for_git(tmp_path):
+    path = str(tmp_path / "repo")
+    make_history(path)
+    before = git_objects(path)
+
+    pvc(path, "repack")
+    git(path, "fsck", "--strict", "--full")
+    assert b'count: 0' in git(path, "count-objects", "-v")
+    for f in os.listdir(os.path.join(path, ".git", "objects", "pack")):
+        if f.endswith(".idx"):
+            git(path, "verify-pack",
+                os.path.join(path, ".git", "objects", "pack", f))
+    assert git_objects(path) == before
+
+def test_pack_writers_in_one_process(tmp_path):
+    repo = libpvc.repo_create(str(tmp_path / "repo"))
+
+    writers = [ libpvc.GitPackWriter(repo) for _ in range(2) ]
+    shas = list()
+    for writer, data in zip(writers, (b'one\n', b'two\n')):
+        binsha = hashlib.sha1(b'blob %d\x00' % len(data)
+            + data).digest()
+        writer.add(binsha, b'blob', data)
+        shas.append(binsha.hex())
+    packs = [ writer.finish() for writer in writers ]
+
+    assert packs[0].path != packs[1].path
+    for sha, data in zip(shas, (b'one\n', b'two\n')):
+        assert git(repo.worktree, "cat-file", "blob", sha) == data
@@ -0,0 +1,43 @@
+import os
+
+from helpers import git, make_worktree, pvc, write
+
+def test_status_matches_git(tmp_path):
+    path = str(tmp_path / "repo")
+    make_worktree(path)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "First")
+
+    write(os.path.join(path, "a"), "changed\n")
+    write(os.path.join(path, "new/file"), "new\n")
+    os.unlink(os.path.join(path, "b", "c.txt"))
+    write(os.path.join(path, "staged"), "staged\n")
+    git(path, "add", "staged")
+
+    assert pvc(path, "status") == git(path, "status", "--short")
+
+def test_status_ignores(tmp_path):
+    path = str(tmp_path / "repo")
+    make_worktree(path)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "First")
+
+    for name in ("src/__pycache__/m.pyc", "build/out", "docs/_build/i",
+                 "logs/a.log", "logs/important.log", "a0/c/f.tmp",
+                 "a0/c/f.txt", "deep/x/y/z.o", "sp ace.txt", "#hash",
+                 "q[1].txt", "top.swp", "keep/sub/a.bak",
+                 "keep/sub/b.txt", "mine", "only/__pycache__/x"):
+        write(os.path.join(path, name), "x\n")
+    write(os.path.join(path, ".gitignore"),
+        "__pycache__/\n*.log\n!important.log\n/build\n"
+        "docs/_build/\n**/c/*.tmp\ndeep/**\nsp\\ ace.txt   \n"
+        "\\#hash\nq\\[1].txt\n")
+    write(os.path.join(path, ".git", "info", "exclude"), "*.swp\n")
+    write(os.path.join(path, "keep", ".gitignore"), "*.bak\n")
+    write(os.path.join(path, "excludes"), "mine\n")
+    git(path, "config", "core.excludesFile",
+        os.path.join(path, "excludes"))
+
+    status = pvc(path, "status")
+    assert b'__pycache__' not in status
+    assert status == git(path, "status", "--short")
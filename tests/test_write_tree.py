@@ -0,0 +1,26 @@
+import os
+
+from helpers import git, make_worktree, pvc, write
+
+def test_write_tree_matches_git(tmp_path):
+    path = str(tmp_path / "repo")
+    make_worktree(path)
+
+    pvc(path, "add", ".")
+    sha = pvc(path, "write-tree").strip()
+    assert git(path, "write-tree").strip() == sha
+
+    # Again through the cached trees, after a change deep down
+    write(os.path.join(path, "b", "c", "d", "e.txt"), "changed\n")
+    pvc(path, "add", "b")
+    sha = pvc(path, "write-tree").strip()
+    assert git(path, "write-tree").strip() == sha
+
+def test_commit_leaves_git_status_clean(tmp_path):
+    path = str(tmp_path / "repo")
+    make_worktree(path)
+
+    pvc(path, "add", ".")
+    pvc(path, "commit", "-m", "First")
+    assert git(path, "status", "--porcelain") == b''
+    git(path, "fsck", "--strict")